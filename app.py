@@ -12,8 +12,12 @@ from flask import (
     flash,
     session,
     jsonify,
+    Response,
+    stream_with_context,
+    has_request_context,
 )
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.pagination import Pagination
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from authlib.integrations.flask_client import OAuth
 from werkzeug.utils import secure_filename
@@ -22,6 +26,13 @@ from PIL import Image
 from pdf2image import convert_from_path
 import boto3
 from botocore.exceptions import ClientError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as SessionBase
+from markupsafe import Markup, escape
+from google.api_core import exceptions as google_exceptions
 from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
 from azure.core.exceptions import AzureError
 from datetime import timedelta
@@ -31,13 +42,39 @@ import google.generativeai as genai
 import PyPDF2
 import pytesseract
 from docx import Document as DocxDocument
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import (
+    CountVectorizer, HashingVectorizer, TfidfTransformer, TfidfVectorizer, ENGLISH_STOP_WORDS
+)
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from scipy import sparse
 import nltk
 from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
 import re
 import io
+import numpy as np
+import zlib
+import base64
+import binascii
+import hashlib
+import json
+import random
+import threading
+import time
+import multiprocessing
+import itertools
+import bisect
+import mmap
+import struct
+import math
+from abc import ABC, abstractmethod
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 # Load environment variables from .env file
 load_dotenv()
@@ -124,12 +161,15 @@ if app.config['STORAGE_TYPE'] == 'azure' and app.config['AZURE_STORAGE_ACCOUNT_N
 # ============================================================================
 
 # Google Gemini Configuration (FREE - Primary AI Provider)
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
+OPENAI_MODEL_NAME = 'gpt-3.5-turbo'
+
 app.config['GEMINI_API_KEY'] = os.environ.get('GEMINI_API_KEY', '')
 gemini_model = None
 if app.config['GEMINI_API_KEY']:
     try:
         genai.configure(api_key=app.config['GEMINI_API_KEY'])
-        gemini_model = genai.GenerativeModel('gemini-2.0-flash')
+        gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
         print(f"✓ Google Gemini AI initialized")
     except Exception as e:
         print(f"⚠ Failed to initialize Gemini: {e}")
@@ -158,7 +198,123 @@ app.config['AI_SUMMARY_MAX_LENGTH'] = int(os.environ.get('AI_SUMMARY_MAX_LENGTH'
 app.config['AI_TAGS_COUNT'] = int(os.environ.get('AI_TAGS_COUNT', 5))
 app.config['OCR_LANGUAGE'] = os.environ.get('OCR_LANGUAGE', 'eng')
 app.config['SEARCH_RESULTS_LIMIT'] = int(os.environ.get('SEARCH_RESULTS_LIMIT', 50))
+app.config['SEARCH_INDEX_BODY_CHARS'] = int(os.environ.get('SEARCH_INDEX_BODY_CHARS', 500000))  # Text indexed per document
+# Typo tolerance: when exact matches return fewer than SEARCH_FUZZY_MIN_RESULTS, misspelled words are
+# expanded to indexed words with at least SEARCH_FUZZY_THRESHOLD trigram similarity (0-1, like pg_trgm)
+app.config['SEARCH_FUZZY_MIN_RESULTS'] = int(os.environ.get('SEARCH_FUZZY_MIN_RESULTS', 3))
+app.config['SEARCH_FUZZY_THRESHOLD'] = float(os.environ.get('SEARCH_FUZZY_THRESHOLD', 0.4))
+app.config['SEARCH_FUZZY_EXPANSIONS'] = int(os.environ.get('SEARCH_FUZZY_EXPANSIONS', 3))  # Similar words tried per typo
+# Ranked result ids per (user, query), so paging and polling slice a list instead of re-running the search.
+# Entries are dropped when the user's search_generation changes (their readable documents changed) or expire
+app.config['SEARCH_CACHE_TTL_SECONDS'] = float(os.environ.get('SEARCH_CACHE_TTL_SECONDS', 60))
+app.config['SEARCH_CACHE_MAX_ENTRIES'] = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 1000))  # 0 disables the cache
+app.config['SEARCH_CACHE_MAX_IDS'] = int(os.environ.get('SEARCH_CACHE_MAX_IDS', 500))  # Deeper pages query directly
+# Semantic search: a hashing vectorizer + TruncatedSVD model fitted by migrate_add_semantic_vectors.py maps text
+# to SEMANTIC_DIMENSIONS floats, stored per document; queries are scored against the user's vector matrix
+app.config['SEMANTIC_MODEL_PATH'] = os.environ.get('SEMANTIC_MODEL_PATH', os.path.join(basedir, 'semantic_model.npz'))
+app.config['SEMANTIC_DIMENSIONS'] = int(os.environ.get('SEMANTIC_DIMENSIONS', 128))
+app.config['SEMANTIC_HASH_FEATURES'] = int(os.environ.get('SEMANTIC_HASH_FEATURES', 2 ** 15))  # Model size: dims x this
+app.config['SEMANTIC_MIN_SCORE'] = float(os.environ.get('SEMANTIC_MIN_SCORE', 0.2))  # Cosine similarity cut-off
+app.config['SEMANTIC_ANN_MIN_DOCUMENTS'] = int(os.environ.get('SEMANTIC_ANN_MIN_DOCUMENTS', 20000))  # Exact scan below
+app.config['SEMANTIC_ANN_PROBES'] = int(os.environ.get('SEMANTIC_ANN_PROBES', 8))  # Clusters scanned per query
+# Clusters are refitted in the background once a library's size drifts this far from the one they were fitted on
+app.config['SEMANTIC_ANN_REFIT_DRIFT'] = float(os.environ.get('SEMANTIC_ANN_REFIT_DRIFT', 0.25))
+# Fit the first model in the background after the first analysis (else run migrate_add_semantic_vectors.py)
+app.config['SEMANTIC_AUTO_FIT'] = os.environ.get('SEMANTIC_AUTO_FIT', 'true').lower() == 'true'
+app.config['SEMANTIC_CACHE_USERS'] = int(os.environ.get('SEMANTIC_CACHE_USERS', 16))  # Vector matrices kept in memory
+# Typeahead: snapshot file shared (mmap'd) by all workers, plus the change log applied on top of it
+app.config['SUGGEST_INDEX_PATH'] = os.environ.get('SUGGEST_INDEX_PATH', os.path.join(basedir, 'suggest_index.bin'))
+app.config['SUGGEST_REFRESH_SECONDS'] = float(os.environ.get('SUGGEST_REFRESH_SECONDS', 1.0))  # Change-log poll interval
+app.config['SUGGEST_COMPACT_AFTER'] = int(os.environ.get('SUGGEST_COMPACT_AFTER', 2000))  # Changed docs before a new snapshot
+# Longest a logged change may take to commit: the log is re-read this far back and only pruned past it
+app.config['SUGGEST_CHANGE_WINDOW_SECONDS'] = float(os.environ.get('SUGGEST_CHANGE_WINDOW_SECONDS', 300))
+app.config['SUGGEST_RESULTS_LIMIT'] = int(os.environ.get('SUGGEST_RESULTS_LIMIT', 8))
 app.config['RECOMMENDATIONS_COUNT'] = int(os.environ.get('RECOMMENDATIONS_COUNT', 5))
+# Recommendations use a TF-IDF model fitted once per user and stored with every document's vector; new and
+# re-analyzed documents are transformed with it, and it is refitted once they exceed RECOMMENDATIONS_REFIT_DRIFT
+# of the fitted library or the fit is RECOMMENDATIONS_REFIT_DAYS old
+app.config['RECOMMENDATIONS_MAX_FEATURES'] = int(os.environ.get('RECOMMENDATIONS_MAX_FEATURES', 100))
+app.config['RECOMMENDATIONS_REFIT_DRIFT'] = float(os.environ.get('RECOMMENDATIONS_REFIT_DRIFT', 0.25))
+app.config['RECOMMENDATIONS_REFIT_DAYS'] = float(os.environ.get('RECOMMENDATIONS_REFIT_DAYS', 7))
+app.config['RECOMMENDATIONS_CACHE_USERS'] = int(os.environ.get('RECOMMENDATIONS_CACHE_USERS', 32))  # Matrices in memory
+
+# LLM response cache (summaries / smart tags)
+app.config['LLM_CACHE_ENABLED'] = os.environ.get('LLM_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['LLM_CACHE_TTL_HOURS'] = int(os.environ.get('LLM_CACHE_TTL_HOURS', 24 * 30))
+app.config['LLM_CACHE_MAX_ENTRIES'] = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 5000))
+
+# LLM rate limiting (shared by interactive routes and bulk analysis)
+app.config['GEMINI_RPM'] = float(os.environ.get('GEMINI_RPM', 15))  # Free tier gemini-2.0-flash quota
+app.config['AI_MAX_CONCURRENT_CALLS'] = int(os.environ.get('AI_MAX_CONCURRENT_CALLS', 4))
+app.config['AI_MAX_RETRIES'] = int(os.environ.get('AI_MAX_RETRIES', 5))
+app.config['AI_BACKOFF_BASE_SECONDS'] = float(os.environ.get('AI_BACKOFF_BASE_SECONDS', 2))
+# Web worker processes sharing the account (gunicorn reads the same WEB_CONCURRENCY variable)
+app.config['AI_WORKER_PROCESSES'] = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+
+# Bulk analysis: runs started from the web extract text inline in one thread, so large libraries go to
+# bulk_analyze.py; a 'running' run without a heartbeat for BULK_ANALYSIS_STALE_MINUTES is marked failed
+app.config['BULK_ANALYSIS_WEB_MAX_DOCUMENTS'] = int(os.environ.get('BULK_ANALYSIS_WEB_MAX_DOCUMENTS', 200))
+app.config['BULK_ANALYSIS_STALE_MINUTES'] = float(os.environ.get('BULK_ANALYSIS_STALE_MINUTES', 30))
+
+# AI provider layer: 'auto' (Gemini, then OpenAI), 'gemini', 'openai' or 'stub' (offline, deterministic)
+app.config['AI_PROVIDER'] = os.environ.get('AI_PROVIDER', 'auto').lower()
+app.config['AI_TIMEOUT_SECONDS'] = float(os.environ.get('AI_TIMEOUT_SECONDS', 30))
+app.config['AI_CALL_THREADS'] = int(os.environ.get('AI_CALL_THREADS', 16))
+app.config['AI_BREAKER_FAILURES'] = int(os.environ.get('AI_BREAKER_FAILURES', 5))
+app.config['AI_BREAKER_RESET_SECONDS'] = float(os.environ.get('AI_BREAKER_RESET_SECONDS', 30))
+app.config['AI_HEDGE_AFTER_SECONDS'] = float(os.environ.get('AI_HEDGE_AFTER_SECONDS', 0))  # 0 = no hedged requests
+app.config['AI_STUB_LATENCY_MS'] = int(os.environ.get('AI_STUB_LATENCY_MS', 0))
+
+# AI call metrics (one ai_call_metric row per LLM call or cache hit, written in batches)
+app.config['AI_METRICS_ENABLED'] = os.environ.get('AI_METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['AI_METRICS_FLUSH_SIZE'] = int(os.environ.get('AI_METRICS_FLUSH_SIZE', 50))
+app.config['AI_METRICS_FLUSH_SECONDS'] = float(os.environ.get('AI_METRICS_FLUSH_SECONDS', 10))
+app.config['AI_METRICS_RETENTION_DAYS'] = int(os.environ.get('AI_METRICS_RETENTION_DAYS', 30))
+app.config['AI_DAILY_TOKEN_QUOTA'] = int(os.environ.get('AI_DAILY_TOKEN_QUOTA', 0))  # Per user, 0 = unlimited
+
+# Background analysis jobs (POST /document/<id>/analyze)
+app.config['ANALYSIS_WORKERS'] = int(os.environ.get('ANALYSIS_WORKERS', 2))
+app.config['ANALYSIS_EVENT_POLL_SECONDS'] = float(os.environ.get('ANALYSIS_EVENT_POLL_SECONDS', 0.5))
+app.config['ANALYSIS_EVENT_TIMEOUT_SECONDS'] = int(os.environ.get('ANALYSIS_EVENT_TIMEOUT_SECONDS', 600))
+# Queued/running jobs not updated for this long lost their worker (the in-process queue does not survive restarts)
+app.config['ANALYSIS_JOB_STALE_SECONDS'] = int(os.environ.get('ANALYSIS_JOB_STALE_SECONDS', 900))
+
+# Long-lived streams (SSE progress, streamed chat) each hold a server thread for their whole duration, so
+# they need threaded workers (Procfile: gunicorn --worker-class gthread --threads 8) and are capped per
+# worker; when all slots are taken, clients fall back to polling / plain JSON
+app.config['STREAM_MAX_CONCURRENT'] = int(os.environ.get('STREAM_MAX_CONCURRENT', 4))
+
+# Ask for summary, tags and key terms in one JSON response (falls back to two calls if it can't be parsed)
+app.config['AI_STRUCTURED_ANALYSIS'] = os.environ.get('AI_STRUCTURED_ANALYSIS', 'true').lower() in ('1', 'true', 'yes')
+
+# Map-reduce summaries for documents longer than one LLM input (chunk summaries are cached)
+app.config['AI_SUMMARY_HIERARCHICAL'] = os.environ.get('AI_SUMMARY_HIERARCHICAL', 'true').lower() in ('1', 'true', 'yes')
+app.config['AI_SUMMARY_CHUNK_CHARS'] = int(os.environ.get('AI_SUMMARY_CHUNK_CHARS', 12000))
+app.config['AI_SUMMARY_MAX_CHUNKS'] = int(os.environ.get('AI_SUMMARY_MAX_CHUNKS', 32))
+app.config['AI_SUMMARY_WORKERS'] = int(os.environ.get('AI_SUMMARY_WORKERS', app.config['AI_MAX_CONCURRENT_CALLS']))
+
+# Quiz bank: questions are generated ahead of time and sampled; the LLM is only called when a bank runs low
+app.config['QUIZ_SET_SIZE'] = int(os.environ.get('QUIZ_SET_SIZE', 10))
+app.config['QUIZ_BANK_MIN_QUESTIONS'] = int(os.environ.get('QUIZ_BANK_MIN_QUESTIONS', 20))
+app.config['QUIZ_PREGENERATE_DIFFICULTIES'] = [d.strip() for d in os.environ.get('QUIZ_PREGENERATE_DIFFICULTIES', 'medium').split(',') if d.strip()]
+
+# Chat prompt assembly: recent turns are sent verbatim, older ones as a rolling summary
+app.config['CHAT_HISTORY_MESSAGES'] = int(os.environ.get('CHAT_HISTORY_MESSAGES', 10))
+app.config['CHAT_PROMPT_TOKEN_BUDGET'] = int(os.environ.get('CHAT_PROMPT_TOKEN_BUDGET', 3000))
+app.config['CHAT_DOCUMENT_TOKENS'] = int(os.environ.get('CHAT_DOCUMENT_TOKENS', 800))
+app.config['CHAT_SUMMARY_MAX_TOKENS'] = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', 300))
+
+# Chunk retrieval for chat / quiz context (per-document BM25 indexes cached in memory)
+app.config['RETRIEVAL_TOP_K'] = int(os.environ.get('RETRIEVAL_TOP_K', 4))
+app.config['RETRIEVAL_CACHE_DOCUMENTS'] = int(os.environ.get('RETRIEVAL_CACHE_DOCUMENTS', 32))
+
+# Admin users (comma-separated emails) may run maintenance jobs across all users
+app.config['ADMIN_EMAILS'] = [e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
+
+# Compressed storage for extracted text / summaries (opt-in, see migrate_compress_text.py)
+app.config['COMPRESS_TEXT_COLUMNS'] = os.environ.get('COMPRESS_TEXT_COLUMNS', 'false').lower() in ('1', 'true', 'yes')
+app.config['COMPRESS_TEXT_MIN_LENGTH'] = int(os.environ.get('COMPRESS_TEXT_MIN_LENGTH', 1024))
+app.config['COMPRESS_TEXT_LEVEL'] = int(os.environ.get('COMPRESS_TEXT_LEVEL', 6))
 
 # Initialize NLTK stopwords
 try:
@@ -181,11 +337,67 @@ google = oauth.register(
 )
 
 
+# ============================================================================
+# Compressed Text Storage
+# ============================================================================
+
+COMPRESSED_TEXT_PREFIX = 'zlib:'
+
+
+def compress_text(text, level=None):
+    """Return text zlib-compressed and base64-encoded, tagged with COMPRESSED_TEXT_PREFIX."""
+    if level is None:
+        level = app.config['COMPRESS_TEXT_LEVEL']
+    data = zlib.compress(text.encode('utf-8'), level)
+    return COMPRESSED_TEXT_PREFIX + base64.b64encode(data).decode('ascii')
+
+
+def decompress_text(value):
+    """
+    Inverse of compress_text(); plain (uncompressed) values are returned unchanged,
+    including plain text that merely starts with COMPRESSED_TEXT_PREFIX.
+    """
+    if value and value.startswith(COMPRESSED_TEXT_PREFIX):
+        try:
+            data = base64.b64decode(value[len(COMPRESSED_TEXT_PREFIX):], validate=True)
+            return zlib.decompress(data).decode('utf-8')
+        except (binascii.Error, zlib.error, UnicodeDecodeError):
+            return value
+    return value
+
+
+class CompressedText(db.TypeDecorator):
+    """
+    Text column that transparently compresses long values.
+    Compression only happens on write when COMPRESS_TEXT_COLUMNS is enabled, but reads
+    always decompress, so plain and compressed rows can live side by side in an ordinary
+    TEXT column (no schema change on SQLite or PostgreSQL).
+    Note: SQL LIKE/ILIKE cannot see inside compressed values.
+    """
+    impl = db.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not app.config['COMPRESS_TEXT_COLUMNS']:
+            return value
+        if len(value) < app.config['COMPRESS_TEXT_MIN_LENGTH']:
+            return value
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+    def coerce_compared_value(self, op, value):
+        # Search patterns compared against the column must never be compressed
+        return db.Text()
+
+
 # Models
 # Association table for many-to-many relationship between Document and Tag
 document_tags = db.Table('document_tags',
     db.Column('document_id', db.Integer, db.ForeignKey('document.id'), primary_key=True),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Index('ix_document_tags_tag', 'tag_id')  # Tag facet filter: documents of one tag
 )
 
 # Association table for many-to-many relationship between Document and Collection
@@ -210,6 +422,8 @@ class User(UserMixin, db.Model):
     google_id = db.Column(db.String(255), unique=True, nullable=False)
     profile_pic = db.Column(db.String(512), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped whenever the documents this user can search change; cached search results of older generations are stale
+    search_generation = db.Column(db.Integer, default=0, nullable=False, server_default='0')
     
     documents = db.relationship('Document', backref='owner', lazy=True)
     shared_with_me = db.relationship('SharePermission', foreign_keys='SharePermission.shared_with_id', backref='recipient', lazy=True)
@@ -272,10 +486,13 @@ class Document(db.Model):
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     
     # AI-powered features
-    summary = db.Column(db.Text, nullable=True)  # AI-generated summary
-    extracted_text = db.Column(db.Text, nullable=True)  # Extracted text from PDF/images (OCR)
+    # The large text columns are deferred (group 'content') so list queries only fetch
+    # card metadata; routes that really need them use db.undefer(...) / db.undefer_group('content').
+    summary = db.deferred(db.Column(CompressedText, nullable=True), group='content')  # AI-generated summary
+    extracted_text = db.deferred(db.Column(CompressedText, nullable=True), group='content')  # Extracted text from PDF/images (OCR)
     ai_tags = db.Column(db.String(512), nullable=True)  # AI-suggested tags (comma-separated)
-    content_vector = db.Column(db.Text, nullable=True)  # TF-IDF vector for recommendations (JSON)
+    key_terms = db.Column(db.String(1024), nullable=True)  # AI-extracted key terms (comma-separated)
+    content_vector = db.deferred(db.Column(db.LargeBinary, nullable=True), group='content')  # Semantic vector (see SemanticModel)
     last_analyzed = db.Column(db.DateTime, nullable=True)  # Last AI analysis timestamp
     
     # Analytics tracking
@@ -285,6 +502,12 @@ class Document(db.Model):
     
     # Many-to-many relationship with Tag
     tag_objects = db.relationship('Tag', secondary=document_tags, back_populates='documents')
+    
+    # Facet filters and counts (year page, search) are equality tests on these
+    __table_args__ = (
+        db.Index('ix_document_user_year_subject', 'user_id', 'year', 'subject'),
+        db.Index('ix_document_user_mimetype', 'user_id', 'mimetype'),
+    )
 
     def tag_list(self):
         """Return list of tag names (from tag_objects relationship)."""
@@ -296,16 +519,23 @@ class Document(db.Model):
         return [t.strip() for t in self.tags.split(',') if t.strip()]
     
     def get_tags(self):
-        """Return list of tag objects with name and slug."""
+        """Return list of tag objects with name and slug (memoized per instance, templates call it repeatedly)."""
+        cached = getattr(self, '_cached_tags', None)
+        if cached is not None:
+            return cached
         if self.tag_objects:
-            return [{'name': tag.name, 'slug': tag.slug} for tag in self.tag_objects]
-        # Fallback for old comma-separated tags
-        if not self.tags:
-            return []
-        return [{'name': t.strip(), 'slug': Tag.slugify(t.strip())} for t in self.tags.split(',') if t.strip()]
+            tags = [{'name': tag.name, 'slug': tag.slug} for tag in self.tag_objects]
+        elif not self.tags:
+            tags = []
+        else:
+            # Fallback for old comma-separated tags
+            tags = [{'name': t.strip(), 'slug': Tag.slugify(t.strip())} for t in self.tags.split(',') if t.strip()]
+        self._cached_tags = tags
+        return tags
     
     def set_tags_from_string(self, tags_string):
         """Parse comma-separated tags and create/associate Tag objects."""
+        self._cached_tags = None
         if not tags_string or not tags_string.strip():
             self.tag_objects = []
             return
@@ -377,6 +607,27 @@ class SharePermission(db.Model):
         return f'<SharePermission {self.permission} for {self.document_id or self.collection_id}>'
 
 
+class DocumentAccess(db.Model):
+    """
+    Maintained "who can read what" index: one row per (user, document, reason), where the reason is
+    ownership (share_id 0) or a SharePermission on the document or on a collection containing it.
+    Kept current on every flush, so permission-aware queries join one indexed table.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    document_id = db.Column(db.Integer, nullable=False)
+    share_id = db.Column(db.Integer, default=0, nullable=False)  # 0: owner
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'document_id', 'share_id', name='uq_document_access'),
+        db.Index('ix_document_access_document', 'document_id'),
+        db.Index('ix_document_access_share', 'share_id'),
+    )
+    
+    def __repr__(self):
+        return f'<DocumentAccess user={self.user_id} doc={self.document_id} share={self.share_id}>'
+
+
 class Comment(db.Model):
     """Model for comments/annotations on documents."""
     id = db.Column(db.Integer, primary_key=True)
@@ -446,6 +697,8 @@ class ChatSession(db.Model):
     title = db.Column(db.String(256), default='New Chat')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    history_summary = db.Column(db.Text, nullable=True)  # Rolling summary of turns older than the history window
+    summarized_until_id = db.Column(db.Integer, default=0)  # Last ChatMessage.id folded into history_summary
     
     # Relationships
     user = db.relationship('User', backref='chat_sessions')
@@ -463,7 +716,7 @@ class ChatSession(db.Model):
 class ChatMessage(db.Model):
     """Model for individual messages in a chat session."""
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False, index=True)
     role = db.Column(db.String(16), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -489,6 +742,181 @@ class ActivityLog(db.Model):
         return f'<ActivityLog {self.activity_type} by User {self.user_id}>'
 
 
+class QuizSet(db.Model):
+    """A batch of generated quiz questions for one document and difficulty (the quiz bank)."""
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False)
+    difficulty = db.Column(db.String(16), nullable=False)  # 'easy', 'medium', 'hard'
+    content_hash = db.Column(db.String(64), nullable=False)  # sha256 of the extracted text the questions came from
+    questions = db.Column(db.Text, nullable=False)  # JSON list of {question, options, correct_answer, explanation}
+    question_count = db.Column(db.Integer, default=0)
+    served_count = db.Column(db.Integer, default=0)  # Questions from this set handed out so far (least served first)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    document = db.relationship('Document', backref=db.backref('quiz_sets', lazy='dynamic', cascade='all, delete-orphan'))
+    
+    __table_args__ = (db.Index('ix_quiz_set_bank', 'document_id', 'difficulty', 'content_hash'),)
+    
+    def __repr__(self):
+        return f'<QuizSet {self.id} doc {self.document_id} {self.difficulty} ({self.question_count})>'
+
+
+class AICallMetric(db.Model):
+    """One LLM call (or LLM cache hit): who triggered it, where, how long it took and how many tokens it used."""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # None = system / admin job
+    route = db.Column(db.String(64), nullable=False)  # Flask endpoint, or background job name
+    operation = db.Column(db.String(32), nullable=False)  # 'complete', 'chat', 'stream_chat', or cache kind
+    provider = db.Column(db.String(16), nullable=False)  # 'gemini', 'openai', 'stub', 'cache'
+    model = db.Column(db.String(64), nullable=False)
+    outcome = db.Column(db.String(16), nullable=False)  # 'ok', 'error', 'timeout', 'queue_timeout', 'rate_limited', 'quota'
+    cache_hit = db.Column(db.Boolean, default=False)
+    latency_ms = db.Column(db.Float, nullable=False)
+    chars_in = db.Column(db.Integer, default=0)
+    chars_out = db.Column(db.Integer, default=0)
+    tokens_in = db.Column(db.Integer, default=0)
+    tokens_out = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (db.Index('ix_ai_call_metric_user_day', 'user_id', 'created_at'),)
+    
+    def __repr__(self):
+        return f'<AICallMetric {self.route} {self.provider} {self.outcome} {self.latency_ms:.0f}ms>'
+
+
+class KeywordStat(db.Model):
+    """Document frequency of a candidate keyword across one user's analyzed documents (IDF for local tags)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    term = db.Column(db.String(96), nullable=False)  # Word or two-word phrase
+    doc_freq = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (db.UniqueConstraint('user_id', 'term', name='uq_keyword_stat_user_term'),)
+    
+    def __repr__(self):
+        return f'<KeywordStat {self.term!r} df={self.doc_freq}>'
+
+
+class SearchChange(db.Model):
+    """Change log of document inserts, edits and deletes, applied by each worker's typeahead index."""
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, nullable=False)  # No FK: deletes are logged too
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Workers track the highest id they applied, so ids must never be reused after old rows are pruned.
+    # Ids are not committed in order (PostgreSQL sequences), hence the re-read window in apply_search_changes()
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    def __repr__(self):
+        return f'<SearchChange {self.id} doc={self.document_id}>'
+
+
+class RecommendationModel(db.Model):
+    """One user's fitted TF-IDF vocabulary and IDF weights for recommendations (see get_recommendation_matrix)."""
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, default=1, nullable=False)  # Bumped on every refit; vectors record it
+    vocabulary = db.Column(db.Text, nullable=False)  # JSON list: the term of each feature index
+    idf = db.Column(db.LargeBinary, nullable=False)  # float32 weight per feature
+    fitted_documents = db.Column(db.Integer, default=0, nullable=False)
+    changed_documents = db.Column(db.Integer, default=0, nullable=False)  # Transformed since the fit (drift)
+    fitted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<RecommendationModel user={self.user_id} v{self.version}>'
+
+
+class RecommendationVector(db.Model):
+    """A document's TF-IDF vector under a version of its owner's RecommendationModel."""
+    document_id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # No FK: dropped in before_flush
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    version = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)  # Sparse row: int32 feature indices, then float32 weights
+    
+    def __repr__(self):
+        return f'<RecommendationVector doc={self.document_id} v{self.version}>'
+
+
+class LLMCacheEntry(db.Model):
+    """Persistent cache of LLM responses, keyed by answering model, prompt version, input hash and parameters."""
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False, index=True)  # SHA-256 hex
+    kind = db.Column(db.String(32), nullable=False)  # 'summary', 'tags', ...
+    model = db.Column(db.String(64), nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    hit_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<LLMCacheEntry {self.kind} {self.cache_key[:12]}>'
+
+
+class AnalysisJob(db.Model):
+    """Background AI analysis of one document; clients poll it or stream its progress events."""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False)
+    status = db.Column(db.String(16), default='queued')  # 'queued', 'running', 'done', 'failed'
+    stage = db.Column(db.String(32), default='queued')  # 'extracting', 'summarizing', 'tagging', 'done'
+    current = db.Column(db.Integer, nullable=True)  # e.g. page N ...
+    total = db.Column(db.Integer, nullable=True)  # ... of M
+    seq = db.Column(db.Integer, default=0)  # Bumped on every update, used as the SSE event id
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    document = db.relationship('Document', backref=db.backref('analysis_jobs', lazy='dynamic', cascade='all, delete-orphan'))
+    
+    def __repr__(self):
+        return f'<AnalysisJob {self.id} {self.status}/{self.stage}>'
+    
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'document_id': self.document_id,
+            'status': self.status,
+            'stage': self.stage,
+            'current': self.current,
+            'total': self.total,
+            'error': self.error
+        }
+
+
+class AnalysisRun(db.Model):
+    """Progress record for a bulk AI analysis run (resumable from last_document_id)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # None = all users
+    status = db.Column(db.String(16), default='pending')  # 'pending', 'running', 'completed', 'failed'
+    total = db.Column(db.Integer, default=0)
+    processed = db.Column(db.Integer, default=0)
+    succeeded = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    last_document_id = db.Column(db.Integer, default=0)  # Cursor: documents with id <= this are done
+    docs_per_minute = db.Column(db.Float, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Heartbeat: every batch commit
+    
+    def __repr__(self):
+        return f'<AnalysisRun {self.id} {self.status} {self.processed}/{self.total}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'docs_per_minute': self.docs_per_minute,
+            'error': self.error,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -530,6 +958,11 @@ def get_subject_color_class(subject: str) -> str:
     return 'default'
 
 
+def is_admin_user(user):
+    """Check if user is listed in ADMIN_EMAILS."""
+    return bool(user and user.is_authenticated and user.email and user.email.lower() in app.config['ADMIN_EMAILS'])
+
+
 def can_access_document(user, document):
     """Check if user can access a document (owner or has share permission)."""
     if document.user_id == user.id:
@@ -586,6 +1019,138 @@ def can_edit_collection(user, collection):
     return share is not None
 
 
+# ============================================================================
+# Document Access Index
+# ============================================================================
+
+known_tables = {}  # (database URL, table name) -> whether the table exists; old databases need migrations
+
+
+def database_has_table(connection, table_name):
+    """True if table_name exists in this database (checked once per database)."""
+    key = (str(connection.engine.url), table_name)
+    if key not in known_tables:
+        known_tables[key] = db.inspect(connection).has_table(table_name)
+    return known_tables[key]
+
+
+def document_access_available(connection):
+    return database_has_table(connection, DocumentAccess.__tablename__)
+
+
+def accessible_document_ids(user_id):
+    """Subquery of the ids of every document user_id may read (owned or shared), for `Document.id.in_(...)`."""
+    return db.select(DocumentAccess.document_id).where(DocumentAccess.user_id == user_id)
+
+
+def _grant_access(connection, rows):
+    """Insert access rows, ignoring ones that already exist."""
+    if not rows:
+        return
+    insert = postgresql_insert if connection.dialect.name == 'postgresql' else sqlite_insert
+    connection.execute(insert(DocumentAccess.__table__).values(rows).on_conflict_do_nothing(
+        index_elements=['user_id', 'document_id', 'share_id']
+    ))
+
+
+def refresh_share_access(connection, share_id):
+    """Rewrite the rows granted by one share from its current row (gone, document, or collection members)."""
+    access = DocumentAccess.__table__
+    connection.execute(access.delete().where(access.c.share_id == share_id))
+    share = connection.execute(
+        db.select(SharePermission.shared_with_id, SharePermission.document_id, SharePermission.collection_id)
+        .where(SharePermission.id == share_id)
+    ).first()
+    if share is None:
+        return
+    if share.document_id is not None:
+        _grant_access(connection, [{'user_id': share.shared_with_id, 'document_id': share.document_id,
+                                    'share_id': share_id}])
+    if share.collection_id is not None:
+        connection.execute(access.insert().from_select(
+            ['user_id', 'document_id', 'share_id'],
+            db.select(db.literal(share.shared_with_id), document_collections.c.document_id, db.literal(share_id))
+            .where(document_collections.c.collection_id == share.collection_id)
+        ))
+
+
+def rebuild_document_access(connection):
+    """Recompute the whole index from documents and shares (migration / repair)."""
+    access = DocumentAccess.__table__
+    connection.execute(access.delete())
+    connection.execute(access.insert().from_select(
+        ['user_id', 'document_id', 'share_id'], db.select(Document.user_id, Document.id, db.literal(0))
+    ))
+    for (share_id,) in connection.execute(db.select(SharePermission.id)).all():
+        refresh_share_access(connection, share_id)
+
+
+@event.listens_for(Collection.documents, 'append')
+def _stage_collection_append(collection, document, initiator):
+    _stage_membership(collection, document, True)
+
+
+@event.listens_for(Collection.documents, 'remove')
+def _stage_collection_remove(collection, document, initiator):
+    _stage_membership(collection, document, False)
+
+
+def _stage_membership(collection, document, added):
+    # Applied after the flush that writes the document_collections row (ids may not exist yet)
+    session = db.object_session(collection) or db.object_session(document)
+    if session is not None:
+        session.info.setdefault('collection_membership', []).append((collection, document, added))
+
+
+@event.listens_for(SessionBase, 'after_flush')
+def _maintain_document_access(session, flush_context):
+    membership = session.info.pop('collection_membership', [])
+    connection = session.connection()
+    if not document_access_available(connection):
+        return
+    access = DocumentAccess.__table__
+    
+    shares = set()
+    for obj in session.new:
+        if isinstance(obj, Document):
+            _grant_access(connection, [{'user_id': obj.user_id, 'document_id': obj.id, 'share_id': 0}])
+        elif isinstance(obj, SharePermission):
+            shares.add(obj.id)
+    for obj in session.dirty:
+        state = db.inspect(obj)
+        if isinstance(obj, Document) and state.attrs.user_id.history.has_changes():
+            connection.execute(access.update().where(access.c.document_id == obj.id, access.c.share_id == 0)
+                               .values(user_id=obj.user_id))
+        elif isinstance(obj, SharePermission) and any(
+            state.attrs[name].history.has_changes() for name in ('shared_with_id', 'document_id', 'collection_id')
+        ):
+            shares.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Document):
+            connection.execute(access.delete().where(access.c.document_id == obj.id))
+        elif isinstance(obj, SharePermission):
+            connection.execute(access.delete().where(access.c.share_id == obj.id))
+    
+    for collection, document, added in membership:
+        if collection.id is None or document.id is None:
+            continue
+        collection_shares = connection.execute(
+            db.select(SharePermission.id, SharePermission.shared_with_id)
+            .where(SharePermission.collection_id == collection.id)
+        ).all()
+        if added:
+            _grant_access(connection, [{'user_id': user_id, 'document_id': document.id, 'share_id': share_id}
+                                       for share_id, user_id in collection_shares if share_id not in shares])
+        elif collection_shares:
+            connection.execute(access.delete().where(
+                access.c.document_id == document.id,
+                access.c.share_id.in_([share_id for share_id, _ in collection_shares])
+            ))
+    
+    for share_id in shares:
+        refresh_share_access(connection, share_id)
+
+
 def create_notification(user_id, title, message, notification_type='info', link=None):
     """Helper function to create a notification for a user."""
     notification = Notification(
@@ -975,14 +1540,17 @@ def logout():
 # AI Helper Functions
 # ============================================================================
 
-def extract_text_from_pdf(file_path):
-    """Extract text from PDF file."""
+def extract_text_from_pdf(file_path, progress=None):
+    """Extract text from PDF file; progress('extracting', page, total) is called per page."""
     try:
         text = ""
         with open(file_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
+            total_pages = len(pdf_reader.pages)
+            for page_number, page in enumerate(pdf_reader.pages, start=1):
                 text += page.extract_text() + "\n"
+                if progress:
+                    progress('extracting', page_number, total_pages)
         return text.strip()
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
@@ -1015,10 +1583,29 @@ def extract_text_from_image(file_path):
         return None
 
 
-def extract_text_from_document(file_path, mimetype):
+def extract_text_from_txt(file_path):
+    """Read a plain-text file (notes and .txt uploads)."""
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read().strip()
+    except Exception as e:
+        print(f"Error reading text file: {e}")
+        return None
+
+
+def plain_text_content(file_path, mimetype, filename):
+    """Content of a .txt upload, read once at write time so search never opens the file (None for other types)."""
+    if mimetype == 'text/plain' or filename.lower().endswith('.txt'):
+        return extract_text_from_txt(file_path)
+    return None
+
+
+def extract_text_from_document(file_path, mimetype, progress=None):
     """Extract text from document based on file type."""
+    if mimetype == 'text/plain':
+        return extract_text_from_txt(file_path)
     if mimetype == 'application/pdf':
-        return extract_text_from_pdf(file_path)
+        return extract_text_from_pdf(file_path, progress=progress)
     elif mimetype == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
         return extract_text_from_docx(file_path)
     elif mimetype.startswith('image/'):
@@ -1026,236 +1613,3459 @@ def extract_text_from_document(file_path, mimetype):
     return None
 
 
-def generate_summary(text, max_length=None):
-    """Generate AI summary of text using Google Gemini."""
-    if not gemini_model and not openai_client:
-        return None
-    
-    if not text:
+# ============================================================================
+# LLM Response Cache
+# ============================================================================
+
+# Bump these when the corresponding prompt template changes so stale answers are not reused
+SUMMARY_PROMPT_VERSION = 1
+TAGS_PROMPT_VERSION = 1
+ANALYSIS_PROMPT_VERSION = 1
+CHUNK_SUMMARY_PROMPT_VERSION = 1
+
+llm_cache_stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stores': 0, 'evictions': 0}
+
+
+def llm_cache_key(kind, prompt_version, text, **params):
+    """Build the request key from prompt template version, SHA-256 of the input and parameters (see llm_model_cache_key)."""
+    payload = json.dumps({
+        'kind': kind,
+        'prompt_version': prompt_version,
+        'input_sha256': hashlib.sha256(text.encode('utf-8')).hexdigest(),
+        'params': params,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def llm_model_cache_key(cache_key, model):
+    """Stored key of a request answered by `model`: a fallback provider's answer is not filed under the primary."""
+    return hashlib.sha256(f"{model}:{cache_key}".encode('utf-8')).hexdigest()
+
+
+def llm_cache_get(cache_key):
+    """
+    Return the cached response for cache_key, or None on a miss / expired entry.
+    Answers of every configured provider count, the first provider's preferred. The cache
+    uses its own session so the caller's pending changes are neither committed nor rolled back.
+    """
+    if not app.config['LLM_CACHE_ENABLED']:
         return None
-    
-    if max_length is None:
-        max_length = app.config['AI_SUMMARY_MAX_LENGTH']
-    
+    started = time.monotonic()
+    models = list(dict.fromkeys(provider.model_name for provider in ai_providers()))
+    keys = {llm_model_cache_key(cache_key, model): rank for rank, model in enumerate(models)}
     try:
-        # Truncate text if too long
-        max_input_chars = 12000
-        if len(text) > max_input_chars:
-            text = text[:max_input_chars] + "..."
-        
-        # Try Gemini first (free)
-        if gemini_model:
-            try:
-                prompt = f"Summarize the following academic document in {max_length} characters or less. Be concise and focus on key points:\n\n{text}"
-                response = gemini_model.generate_content(prompt)
-                summary = response.text.strip()
-                return summary[:max_length]
-            except Exception as e:
-                print(f"Gemini summary error: {e}")
-                # Fall through to OpenAI if available
-        
-        # Fallback to OpenAI if Gemini fails
-        if openai_client:
-            response = openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that summarizes academic documents concisely."},
-                    {"role": "user", "content": f"Summarize the following document in {max_length} characters or less:\n\n{text}"}
-                ],
-                max_tokens=200,
-                temperature=0.5
-            )
-            summary = response.choices[0].message.content.strip()
-            return summary[:max_length]
-        
-        return None
+        with SessionBase(db.engine) as session:
+            entries = session.query(LLMCacheEntry).filter(LLMCacheEntry.cache_key.in_(keys)).all()
+            if not entries:
+                llm_cache_stats['misses'] += 1
+                return None
+            entry = min(entries, key=lambda e: keys[e.cache_key])
+            if entry.created_at < datetime.utcnow() - timedelta(hours=app.config['LLM_CACHE_TTL_HOURS']):
+                session.delete(entry)
+                session.commit()
+                llm_cache_stats['misses'] += 1
+                llm_cache_stats['evictions'] += 1
+                return None
+            entry.hit_count = (entry.hit_count or 0) + 1
+            entry.last_used_at = datetime.utcnow()
+            kind, model, response = entry.kind, entry.model, entry.response
+            session.commit()
+        llm_cache_stats['hits'] += 1
+        record_ai_call(kind, 'cache', model, 'ok', started, output_text=response, cache_hit=True)
+        return response
     except Exception as e:
-        print(f"Error generating summary: {e}")
+        print(f"LLM cache read error: {e}")
         return None
 
 
-def generate_smart_tags(text, subject=None):
-    """Generate smart tags using Google Gemini and NLP."""
-    if not text:
-        return []
-    
-    tags = []
-    
-    # Method 1: Extract key terms using NLP
+def llm_cache_set(cache_key, kind, response, model):
+    """
+    Store the response `model` gave and evict expired / least recently used entries beyond
+    LLM_CACHE_MAX_ENTRIES (in the cache's own session, like llm_cache_get).
+    """
+    if not app.config['LLM_CACHE_ENABLED'] or response is None:
+        return
+    stored_key = llm_model_cache_key(cache_key, model)
     try:
-        # Tokenize and remove stopwords
-        words = word_tokenize(text.lower())
-        words = [w for w in words if w.isalnum() and w not in stop_words and len(w) > 3]
-        
-        # Get most common words
-        from collections import Counter
-        word_freq = Counter(words)
-        common_words = [word for word, _ in word_freq.most_common(10)]
-        tags.extend(common_words[:3])
-    except:
-        pass
-    
-    # Method 2: Use Gemini for better tags (free)
-    if gemini_model and len(text) > 50:
-        try:
-            # Truncate text if too long
-            max_input_chars = 6000
-            if len(text) > max_input_chars:
-                text = text[:max_input_chars] + "..."
+        with SessionBase(db.engine) as session:
+            entry = session.query(LLMCacheEntry).filter_by(cache_key=stored_key).first()
+            if entry is None:
+                entry = LLMCacheEntry(cache_key=stored_key, kind=kind, model=model, response=response)
+                session.add(entry)
+            else:
+                entry.response = response
+                entry.created_at = datetime.utcnow()
+            entry.last_used_at = datetime.utcnow()
+            session.commit()
+            llm_cache_stats['stores'] += 1
             
-            prompt = f"Extract {app.config['AI_TAGS_COUNT']} relevant keywords/tags from this academic document."
-            if subject:
-                prompt += f" Subject: {subject}."
-            prompt += f"\n\nDocument:\n{text}\n\nProvide only the tags, comma-separated, lowercase:"
+            # TTL eviction
+            expired_before = datetime.utcnow() - timedelta(hours=app.config['LLM_CACHE_TTL_HOURS'])
+            evicted = session.query(LLMCacheEntry).filter(LLMCacheEntry.created_at < expired_before)\
+                .delete(synchronize_session=False)
             
-            response = gemini_model.generate_content(prompt)
-            ai_tags = response.text.strip()
-            # Parse comma-separated tags
-            ai_tags_list = [tag.strip().lower() for tag in ai_tags.split(',') if tag.strip()]
-            tags.extend(ai_tags_list)
-        except Exception as e:
-            print(f"Gemini tags error: {e}")
-            # Try OpenAI fallback
-            if openai_client:
-                try:
-                    prompt = f"Extract {app.config['AI_TAGS_COUNT']} relevant keywords/tags from this academic document."
-                    if subject:
-                        prompt += f" Subject: {subject}."
-                    prompt += f"\n\nDocument:\n{text}\n\nProvide only the tags, comma-separated:"
-                    
-                    response = openai_client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[
-                            {"role": "system", "content": "You are a helpful assistant that extracts relevant keywords from academic content."},
-                            {"role": "user", "content": prompt}
-                        ],
-                        max_tokens=50,
-                        temperature=0.3
-                    )
-                    
-                    ai_tags = response.choices[0].message.content.strip()
-                    ai_tags_list = [tag.strip() for tag in ai_tags.split(',') if tag.strip()]
-                    tags.extend(ai_tags_list)
-                except Exception as e2:
-                    print(f"Error generating AI tags: {e2}")
-    
-    # Remove duplicates and limit count
-    tags = list(dict.fromkeys(tags))  # Preserve order while removing duplicates
-    return tags[:app.config['AI_TAGS_COUNT']]
+            # Size eviction: keep the most recently used LLM_CACHE_MAX_ENTRIES
+            overflow = session.query(LLMCacheEntry).count() - app.config['LLM_CACHE_MAX_ENTRIES']
+            if overflow > 0:
+                oldest_ids = [row.id for row in session.query(LLMCacheEntry.id)
+                              .order_by(LLMCacheEntry.last_used_at.asc()).limit(overflow)]
+                evicted += session.query(LLMCacheEntry).filter(LLMCacheEntry.id.in_(oldest_ids))\
+                    .delete(synchronize_session=False)
+            
+            llm_cache_stats['evictions'] += evicted
+            # Always end the transaction: even a DELETE of zero rows holds SQLite's write lock
+            session.commit()
+    except Exception as e:
+        print(f"LLM cache write error: {e}")
 
 
-def analyze_document(document_id):
-    """Run full AI analysis on a document: extract text, generate summary, generate tags."""
-    document = Document.query.get(document_id)
-    if not document:
-        return False
-    
-    # Get file path
-    if document.storage_type == 'local':
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], document.stored_filename)
-        if not os.path.exists(file_path):
-            return False
-    else:
-        # For S3/Azure, would need to download file first
-        return False
-    
-    # Extract text
-    extracted_text = extract_text_from_document(file_path, document.mimetype)
-    if extracted_text:
-        document.extracted_text = extracted_text
-        
-        # Generate summary
-        summary = generate_summary(extracted_text)
-        if summary:
-            document.summary = summary
-        
-        # Generate smart tags
-        smart_tags = generate_smart_tags(extracted_text, document.subject)
-        if smart_tags:
-            document.ai_tags = ', '.join(smart_tags)
-        
-        # Update timestamp
-        document.last_analyzed = datetime.utcnow()
-        
-        db.session.commit()
+# ============================================================================
+# LLM Rate Limiting
+# ============================================================================
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate_per_minute` tokens refill continuously up to `capacity`."""
+    
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 4)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, timeout=None):
+        """
+        Block until a token is available, then take it and return True. With a timeout, return False
+        straight away if the next token won't arrive within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+# Every worker process has its own bucket, so each gets an equal share of the account's RPM
+llm_rate_limiter = TokenBucket(app.config['GEMINI_RPM'] / app.config['AI_WORKER_PROCESSES'])
+llm_concurrency = threading.BoundedSemaphore(app.config['AI_MAX_CONCURRENT_CALLS'])
+
+
+def is_rate_limit_error(error):
+    """True for HTTP 429 / quota errors from Gemini or OpenAI."""
+    if isinstance(error, (google_exceptions.ResourceExhausted, openai.RateLimitError)):
         return True
-    
-    return False
+    return '429' in str(error)
 
 
-def search_documents_fulltext(query, user_id, limit=None):
-    """Search documents by full-text search in extracted text and summaries."""
-    if limit is None:
-        limit = app.config['SEARCH_RESULTS_LIMIT']
-    
-    # Search in extracted_text, summary, original_filename, subject, tags
-    search_pattern = f"%{query}%"
-    
-    results = Document.query.filter(
-        Document.user_id == user_id,
-        db.or_(
-            Document.extracted_text.ilike(search_pattern),
-            Document.summary.ilike(search_pattern),
-            Document.original_filename.ilike(search_pattern),
-            Document.subject.ilike(search_pattern),
-            Document.tags.ilike(search_pattern),
-            Document.ai_tags.ilike(search_pattern)
-        )
-    ).limit(limit).all()
-    
-    return results
+# ============================================================================
+# AI Call Metrics
+# ============================================================================
 
+ai_metrics_buffer = []  # Rows waiting for the next batched INSERT
+ai_metrics_lock = threading.Lock()
+ai_metrics_last_flush = [time.monotonic()]
+ai_metrics_executor = ThreadPoolExecutor(max_workers=1)
+ai_call_context = threading.local()
 
-def get_document_recommendations(document_id, count=None):
-    """Get recommended documents based on content similarity."""
-    if count is None:
-        count = app.config['RECOMMENDATIONS_COUNT']
+
+# Background routes that may wait for the rate limiter as long as it takes; everything else
+# (requests, chat summaries, quiz top-ups) counts local queueing against AI_TIMEOUT_SECONDS
+AI_QUEUED_ROUTES = ('analysis_job', 'bulk_analysis')
+
+
+@contextmanager
+def ai_call_scope(route, user_id=None):
+    """Attribute AI calls made by this thread to `route` / `user_id` (background jobs and worker pools)."""
+    previous = getattr(ai_call_context, 'scope', None)
+    ai_call_context.scope = (route, user_id)
+    try:
+        yield
+    finally:
+        ai_call_context.scope = previous
+
+
+def current_ai_scope():
+    """(route, user_id) that an AI call made right now is recorded under."""
+    scope = getattr(ai_call_context, 'scope', None)
+    if scope:
+        return scope
+    if has_request_context():
+        return request.endpoint or 'request', current_user.id if current_user.is_authenticated else None
+    return 'background', None
+
+
+def record_ai_call(operation, provider, model, outcome, started, input_text='', output_text='', cache_hit=False, scope=None):
+    """Buffer one metrics row; the buffer is written by the metrics worker once it is full or stale."""
+    if not app.config['AI_METRICS_ENABLED']:
+        return
+    route, user_id = scope or current_ai_scope()
+    row = {
+        'created_at': datetime.utcnow(),
+        'user_id': user_id,
+        'route': route[:64],
+        'operation': operation[:32],
+        'provider': provider,
+        'model': model[:64],
+        'outcome': outcome,
+        'cache_hit': cache_hit,
+        'latency_ms': round((time.monotonic() - started) * 1000, 1),
+        'chars_in': len(input_text or ''),
+        'chars_out': len(output_text or ''),
+        'tokens_in': estimate_tokens(input_text) if input_text else 0,
+        'tokens_out': estimate_tokens(output_text) if output_text else 0,
+    }
+    with ai_metrics_lock:
+        ai_metrics_buffer.append(row)
+        due = (len(ai_metrics_buffer) >= app.config['AI_METRICS_FLUSH_SIZE']
+               or time.monotonic() - ai_metrics_last_flush[0] >= app.config['AI_METRICS_FLUSH_SECONDS'])
+        if due:
+            ai_metrics_last_flush[0] = time.monotonic()
+    if due:
+        ai_metrics_executor.submit(_flush_ai_metrics_in_context)
+
+
+def flush_ai_metrics():
+    """
+    Write buffered rows in one INSERT and drop rows older than AI_METRICS_RETENTION_DAYS.
+    Uses its own connection so it never commits (or waits on) a caller's session. Returns rows written.
+    """
+    with ai_metrics_lock:
+        rows = list(ai_metrics_buffer)
+        ai_metrics_buffer.clear()
+    if not rows:
+        return 0
+    expired_before = datetime.utcnow() - timedelta(days=app.config['AI_METRICS_RETENTION_DAYS'])
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(AICallMetric.__table__.insert(), rows)
+            connection.execute(AICallMetric.__table__.delete().where(AICallMetric.created_at < expired_before))
+    except Exception as e:
+        print(f"AI metrics write error: {e}")
+        return 0
+    return len(rows)
+
+
+def _flush_ai_metrics_in_context():
+    """Metrics worker entry point."""
+    with app.app_context():
+        flush_ai_metrics()
+
+
+def ai_tokens_today(user_id):
+    """Provider tokens (in + out) used for user_id since midnight UTC; cache hits are free."""
+    midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    stored = db.session.query(db.func.sum(AICallMetric.tokens_in + AICallMetric.tokens_out)).filter(
+        AICallMetric.user_id == user_id,
+        AICallMetric.created_at >= midnight,
+        AICallMetric.cache_hit.is_(False)
+    ).scalar() or 0
+    with ai_metrics_lock:
+        pending = sum(row['tokens_in'] + row['tokens_out'] for row in ai_metrics_buffer
+                      if row['user_id'] == user_id and not row['cache_hit'] and row['created_at'] >= midnight)
+    return int(stored) + pending
+
+
+def _ai_call_input(method, args, kwargs):
+    """Prompt text sent by a provider call, for character / token accounting."""
+    if method == 'complete':
+        return (kwargs.get('system') or '') + args[0]
+    history, message = args[0], args[1]
+    return ''.join(part for turn in history for part in turn['parts']) + message
+
+
+def _metered_stream(first, rest, provider, started, input_text, scope):
+    """Pass a streamed reply through and record its metrics row once the stream ends."""
+    parts = [first]
+    outcome = 'error'
+    try:
+        for chunk in rest:
+            parts.append(chunk)
+            yield chunk
+        outcome = 'ok'
+    finally:
+        record_ai_call('stream_chat', provider.name, provider.model_name, outcome, started,
+                       input_text, ''.join(p for p in parts if p), scope=scope)
+
+
+def ai_metrics_by(column, since):
+    """Calls, cache hits, failures, tokens and provider latency p50/p95/p99 for each value of `column`."""
+    rows = db.session.query(
+        column, AICallMetric.outcome, AICallMetric.cache_hit, AICallMetric.latency_ms,
+        AICallMetric.tokens_in, AICallMetric.tokens_out
+    ).filter(AICallMetric.created_at >= since).all()
+    
+    groups = {}
+    for key, outcome, cache_hit, latency_ms, tokens_in, tokens_out in rows:
+        group = groups.setdefault(key, {'calls': 0, 'cache_hits': 0, 'failures': 0,
+                                        'tokens_in': 0, 'tokens_out': 0, 'latencies': []})
+        group['calls'] += 1
+        if cache_hit:
+            group['cache_hits'] += 1
+            continue
+        if outcome != 'ok':
+            group['failures'] += 1
+        group['tokens_in'] += tokens_in or 0
+        group['tokens_out'] += tokens_out or 0
+        group['latencies'].append(latency_ms)
+    
+    result = []
+    for key, group in sorted(groups.items(), key=lambda item: -item[1]['calls']):
+        latencies = group.pop('latencies')
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).round(1).tolist() if latencies else (None, None, None)
+        result.append({'name': key, **group, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99})
+    return result
+
+
+def ai_daily_usage(since):
+    """Per-day, per-user AI call and provider token totals (the numbers AI_DAILY_TOKEN_QUOTA is checked against)."""
+    day = db.func.date(AICallMetric.created_at)
+    provider_tokens = db.case((AICallMetric.cache_hit.is_(False), AICallMetric.tokens_in + AICallMetric.tokens_out), else_=0)
+    rows = db.session.query(
+        day, AICallMetric.user_id, User.email,
+        db.func.count(AICallMetric.id), db.func.sum(db.case((AICallMetric.cache_hit.is_(True), 1), else_=0)),
+        db.func.sum(provider_tokens)
+    ).outerjoin(User, User.id == AICallMetric.user_id)\
+        .filter(AICallMetric.created_at >= since)\
+        .group_by(day, AICallMetric.user_id, User.email)\
+        .order_by(day.desc(), db.func.sum(provider_tokens).desc()).all()
+    return [{
+        'date': str(date),
+        'user_id': user_id,
+        'email': email,
+        'calls': calls,
+        'cache_hits': int(cache_hits or 0),
+        'tokens': int(tokens or 0)
+    } for date, user_id, email, calls, cache_hits, tokens in rows]
+
+
+# ============================================================================
+# AI Providers
+# ============================================================================
+
+class AIProviderError(Exception):
+    """No provider produced an answer (not configured, circuit open, timed out or failed)."""
+    status_code = 503
+
+
+class AIQuotaExceededError(AIProviderError):
+    """The user has used up AI_DAILY_TOKEN_QUOTA for today."""
+    status_code = 429
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures so callers fail fast instead of
+    waiting on a provider that is down; after `reset_seconds` one trial call is let through.
+    """
     
-    document = Document.query.get(document_id)
-    if not document or not document.extracted_text:
-        return []
+    def __init__(self, failure_threshold=None, reset_seconds=None):
+        self.failure_threshold = failure_threshold or app.config['AI_BREAKER_FAILURES']
+        self.reset_seconds = reset_seconds if reset_seconds is not None else app.config['AI_BREAKER_RESET_SECONDS']
+        self.state = 'closed'  # 'closed', 'open', 'half_open'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+    
+    def allow(self):
+        """True if a call may be attempted now."""
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = 'half_open'  # Let exactly one trial call through
+                return True
+            return self.state == 'closed'
+    
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+    
+    def record_inconclusive(self):
+        """The call said nothing about the provider's health (rate limited): a half-open trial may be retried."""
+        with self.lock:
+            if self.state == 'half_open':
+                self.state = 'open'
+                self.opened_at = time.monotonic() - self.reset_seconds
+
+
+class AIProvider(ABC):
+    """
+    One LLM backend. complete() answers a single prompt, chat() continues a conversation
+    given Gemini-style history ([{'role': 'user'|'model', 'parts': [text]}]).
+    Methods make one SDK call: rate limiting, retries and deadlines are applied by _call_provider().
+    """
+    name = 'base'
+    model_name = 'none'
+    throttled = True  # Share llm_rate_limiter / llm_concurrency (remote APIs only)
+    
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+    
+    @abstractmethod
+    def configured(self):
+        """True if the provider has credentials / a client."""
+    
+    @abstractmethod
+    def complete(self, prompt, system=None, json_mode=False, max_tokens=None, temperature=None, timeout=None):
+        """Answer one prompt and return the text."""
+    
+    @abstractmethod
+    def chat(self, history, message, stream=False, timeout=None):
+        """Continue a conversation; with stream=True return an iterator of text chunks."""
+    
+    def stream_chat(self, history, message, timeout=None):
+        """Start a streamed reply and return (first_chunk, remaining_chunks), so deadlines cover time to first token."""
+        chunks = iter(self.chat(history, message, stream=True, timeout=timeout))
+        for chunk in chunks:
+            if chunk:
+                return chunk, chunks
+        return '', chunks
+
+
+class GeminiProvider(AIProvider):
+    name = 'gemini'
+    model_name = GEMINI_MODEL_NAME
+    
+    def configured(self):
+        return gemini_model is not None
+    
+    def complete(self, prompt, system=None, json_mode=False, max_tokens=None, temperature=None, timeout=None):
+        kwargs = {'request_options': {'timeout': timeout}} if timeout else {}
+        if json_mode:
+            kwargs['generation_config'] = {'response_mime_type': 'application/json'}
+        return gemini_model.generate_content(prompt, **kwargs).text
+    
+    def chat(self, history, message, stream=False, timeout=None):
+        chat = gemini_model.start_chat(history=history)
+        kwargs = {'request_options': {'timeout': timeout}} if timeout else {}
+        if stream:
+            response = chat.send_message(message, stream=True, **kwargs)
+            return (getattr(chunk, 'text', '') for chunk in response)
+        return chat.send_message(message, **kwargs).text
+
+
+class OpenAIProvider(AIProvider):
+    name = 'openai'
+    model_name = OPENAI_MODEL_NAME
+    
+    def configured(self):
+        return openai_client is not None
+    
+    def _create(self, messages, timeout, **kwargs):
+        if timeout:
+            kwargs['timeout'] = timeout
+        return openai_client.chat.completions.create(model=OPENAI_MODEL_NAME, messages=messages, **kwargs)
+    
+    def complete(self, prompt, system=None, json_mode=False, max_tokens=None, temperature=None, timeout=None):
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": prompt})
+        kwargs = {}
+        if max_tokens:
+            kwargs['max_tokens'] = max_tokens
+        if temperature is not None:
+            kwargs['temperature'] = temperature
+        if json_mode:
+            kwargs['response_format'] = {"type": "json_object"}
+        return self._create(messages, timeout, **kwargs).choices[0].message.content
+    
+    def chat(self, history, message, stream=False, timeout=None):
+        messages = [{"role": 'assistant' if turn['role'] == 'model' else 'user', "content": ''.join(turn['parts'])}
+                    for turn in history]
+        messages.append({"role": "user", "content": message})
+        if stream:
+            response = self._create(messages, timeout, stream=True)
+            return (chunk.choices[0].delta.content or '' for chunk in response if chunk.choices)
+        return self._create(messages, timeout).choices[0].message.content
+
+
+class StubProvider(AIProvider):
+    """
+    Deterministic offline provider for load tests and demos (AI_PROVIDER=stub).
+    Answers depend only on the prompt; AI_STUB_LATENCY_MS simulates a network round trip.
+    """
+    name = 'stub'
+    model_name = 'stub'
+    throttled = False
     
-    # Get all documents from same user with extracted text
-    all_docs = Document.query.filter(
-        Document.user_id == document.user_id,
-        Document.id != document_id,
-        Document.extracted_text.isnot(None)
-    ).all()
+    def configured(self):
+        return True
     
-    if not all_docs:
-        return []
+    def _wait(self):
+        if app.config['AI_STUB_LATENCY_MS']:
+            time.sleep(app.config['AI_STUB_LATENCY_MS'] / 1000)
     
-    try:
-        # Create TF-IDF vectors
-        vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-        
-        # Prepare texts
-        texts = [document.extracted_text] + [doc.extracted_text for doc in all_docs]
-        tfidf_matrix = vectorizer.fit_transform(texts)
-        
-        # Calculate cosine similarity
-        similarities = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:]).flatten()
+    def complete(self, prompt, system=None, json_mode=False, max_tokens=None, temperature=None, timeout=None):
+        self._wait()
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        words = [w for w in re.findall(r'[A-Za-z]{5,}', prompt.rsplit('\n\n', 1)[-1].lower()) if w not in stop_words]
+        keywords = list(dict.fromkeys(words))[:10] or ['study', 'notes']
         
-        # Get top recommendations
-        top_indices = similarities.argsort()[-count:][::-1]
-        recommendations = [all_docs[i] for i in top_indices if similarities[i] > 0.1]
+        if '"questions"' in prompt:
+            match = re.search(r'generate (\d+)', prompt)
+            count = int(match.group(1)) if match else 5
+            return json.dumps({'questions': [{
+                'question': f"Stub question {digest[:6]}-{i + 1} about {keywords[i % len(keywords)]}?",
+                'options': [f"Option {letter}" for letter in 'ABCD'],
+                'correct_answer': int(digest[i], 16) % 4,
+                'explanation': 'Generated by the stub provider.'
+            } for i in range(count)]})
+        if '"daily_schedule"' in prompt:
+            return json.dumps({
+                'title': 'Stub Study Plan', 'overview': 'Deterministic plan from the stub provider.',
+                'daily_schedule': [{'day': 1, 'focus': keywords[0], 'tasks': ['Review notes'], 'documents': [], 'estimated_hours': 1}],
+                'tips': ['Take breaks']
+            })
+        summary = f"Stub summary {digest[:8]} covering " + ', '.join(keywords[:5]) + '.'
+        if json_mode or '"summary"' in prompt:
+            return json.dumps({'summary': summary, 'tags': keywords[:5], 'key_terms': keywords[5:10]})
+        if 'comma-separated' in prompt:
+            return ', '.join(keywords[:5])
+        return summary
+    
+    def chat(self, history, message, stream=False, timeout=None):
+        self._wait()
+        digest = hashlib.sha256(f"{len(history)}:{message}".encode('utf-8')).hexdigest()
+        reply = f"Stub reply {digest[:8]}: you asked about \"{message[:200]}\"."
+        if stream:
+            return iter(re.findall(r'\S+\s*', reply))
+        return reply
+
+
+gemini_provider = GeminiProvider()
+openai_provider = OpenAIProvider()
+stub_provider = StubProvider()
+
+ai_call_executor = ThreadPoolExecutor(max_workers=app.config['AI_CALL_THREADS'])
+ai_hedge_executor = ThreadPoolExecutor(max_workers=app.config['AI_CALL_THREADS'])
+ai_provider_stats = {'calls': 0, 'timeouts': 0, 'queue_timeouts': 0, 'failures': 0, 'rate_limited': 0, 'fallbacks': 0,
+                     'short_circuited': 0, 'hedged': 0}
+
+
+def ai_providers():
+    """Configured providers in the order they are tried for AI_PROVIDER."""
+    choice = app.config['AI_PROVIDER']
+    if choice == 'stub':
+        return [stub_provider]
+    order = [openai_provider, gemini_provider] if choice == 'openai' else [gemini_provider, openai_provider]
+    return [provider for provider in order if provider.configured()]
+
+
+def ai_available():
+    """True if any AI provider can be called."""
+    return bool(ai_providers())
+
+
+def _acquire_call_slot(deadline):
+    """Take a rate limiter token and a concurrency slot, waiting until `deadline` (None: for as long as it takes)."""
+    if not llm_rate_limiter.acquire(timeout=None if deadline is None else max(0.0, deadline - time.monotonic())):
+        return False
+    return llm_concurrency.acquire(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+
+def _call_provider(provider, method, args, kwargs, timeout, scope=None, queue=False):
+    """
+    Run one provider call on the AI thread pool and record its metrics. Waiting for the token bucket and
+    concurrency cap, 429 backoff and the call itself all share one `timeout` second deadline, so interactive
+    routes fail fast when the API is slow. With queue=True (analysis and bulk jobs) the local waits are
+    unbounded and only the call itself is limited to `timeout`. Local queueing is never a provider failure
+    for the circuit breaker.
+    """
+    input_text = _ai_call_input(method, args, kwargs)
+    deadline = None if queue else time.monotonic() + timeout
+    for attempt in range(app.config['AI_MAX_RETRIES'] + 1):
+        started = time.monotonic()
+        if provider.throttled and not _acquire_call_slot(deadline):
+            ai_provider_stats['queue_timeouts'] += 1
+            record_ai_call(method, provider.name, provider.model_name, 'queue_timeout', started, input_text, scope=scope)
+            raise AIProviderError(f"{provider.name} busy: no call slot within {timeout:g}s")
+        ai_provider_stats['calls'] += 1
+        started = time.monotonic()
+        call_timeout = timeout if deadline is None else max(0.0, deadline - started)
+        try:
+            future = ai_call_executor.submit(getattr(provider, method), *args, timeout=timeout, **kwargs)
+        except Exception:
+            if provider.throttled:
+                llm_concurrency.release()
+            raise
+        if provider.throttled:
+            # The slot is held until the SDK call returns, even if we stop waiting for it
+            future.add_done_callback(lambda _: llm_concurrency.release())
+        try:
+            result = future.result(timeout=call_timeout)
+        except FutureTimeoutError:
+            # The SDK call keeps its own timeout; we stop waiting for it now
+            future.cancel()
+            ai_provider_stats['timeouts'] += 1
+            if call_timeout >= timeout / 2:
+                provider.breaker.record_failure()
+            else:
+                provider.breaker.record_inconclusive()  # Most of the deadline went to local queueing
+            record_ai_call(method, provider.name, provider.model_name, 'timeout', started, input_text, scope=scope)
+            raise AIProviderError(f"{provider.name} timed out after {timeout:g}s")
+        except Exception as e:
+            if is_rate_limit_error(e):
+                ai_provider_stats['rate_limited'] += 1
+                record_ai_call(method, provider.name, provider.model_name, 'rate_limited', started, input_text, scope=scope)
+                delay = app.config['AI_BACKOFF_BASE_SECONDS'] * (2 ** attempt)
+                delay += random.uniform(0, delay / 2)
+                if attempt < app.config['AI_MAX_RETRIES'] and (deadline is None or time.monotonic() + delay < deadline):
+                    time.sleep(delay)
+                    continue
+                provider.breaker.record_inconclusive()
+                raise AIProviderError(f"{provider.name} rate limited: {e}")
+            ai_provider_stats['failures'] += 1
+            provider.breaker.record_failure()
+            record_ai_call(method, provider.name, provider.model_name, 'error', started, input_text, scope=scope)
+            raise
+        provider.breaker.record_success()
+        if method == 'stream_chat':
+            first, rest = result
+            return first, _metered_stream(first, rest, provider, started, input_text, scope)
+        record_ai_call(method, provider.name, provider.model_name, 'ok', started, input_text, result, scope=scope)
+        return result
+
+
+def _hedged_call(primary, backup, method, args, kwargs, timeout, hedge_after, scope=None, queue=False):
+    """
+    Start the primary; if it hasn't answered within hedge_after seconds, race the backup against it.
+    Returns (provider that answered, result).
+    """
+    errors = []
+    pending = {ai_hedge_executor.submit(_call_provider, primary, method, args, kwargs, timeout, scope, queue): primary}
+    done, _ = wait(pending, timeout=hedge_after)
+    for future in done:
+        try:
+            return primary, future.result()
+        except Exception as e:
+            errors.append(f"{primary.name}: {e}")
+            pending = {}
+    
+    if backup.breaker.allow():
+        ai_provider_stats['hedged' if pending else 'fallbacks'] += 1
+        pending[ai_hedge_executor.submit(_call_provider, backup, method, args, kwargs, timeout, scope, queue)] = backup
+    else:
+        ai_provider_stats['short_circuited'] += 1
+    
+    # Each _call_provider enforces its own deadline (for queued jobs, once it is past the local rate limiter)
+    for future in as_completed(pending):
+        try:
+            return pending[future], future.result()
+        except Exception as e:
+            errors.append(f"{pending[future].name}: {e}")
+    raise AIProviderError('; '.join(errors) or 'AI providers unavailable')
+
+
+def call_ai(method, *args, **kwargs):
+    """
+    Call `method` on the first healthy provider with a per-call deadline (AI_TIMEOUT_SECONDS).
+    Failures and open circuits fall through to the next provider; with AI_HEDGE_AFTER_SECONDS
+    set, a slow primary is raced against the fallback. Raises AIProviderError if nobody answers,
+    AIQuotaExceededError if the calling user is over AI_DAILY_TOKEN_QUOTA.
+    """
+    return call_ai_with_provider(method, *args, **kwargs)[1]
+
+
+def call_ai_with_provider(method, *args, **kwargs):
+    """call_ai() that returns (provider that answered, result), for callers that cache the answer."""
+    providers = ai_providers()
+    if not providers:
+        raise AIProviderError('AI not configured')
+    timeout = app.config['AI_TIMEOUT_SECONDS']
+    hedge_after = app.config['AI_HEDGE_AFTER_SECONDS']
+    
+    scope = current_ai_scope()
+    queue = scope[0] in AI_QUEUED_ROUTES
+    quota = app.config['AI_DAILY_TOKEN_QUOTA']
+    if quota and scope[1] is not None and ai_tokens_today(scope[1]) >= quota:
+        record_ai_call(method, providers[0].name, providers[0].model_name, 'quota', time.monotonic(), scope=scope)
+        raise AIQuotaExceededError(f"Daily AI quota of {quota} tokens used up; try again tomorrow")
+    
+    if hedge_after > 0 and len(providers) > 1 and providers[0].breaker.allow():
+        return _hedged_call(providers[0], providers[1], method, args, kwargs, timeout, hedge_after, scope, queue)
+    
+    errors = []
+    for i, provider in enumerate(providers):
+        if not provider.breaker.allow():
+            ai_provider_stats['short_circuited'] += 1
+            errors.append(f"{provider.name}: circuit open")
+            continue
+        if i > 0:
+            ai_provider_stats['fallbacks'] += 1
+        try:
+            return provider, _call_provider(provider, method, args, kwargs, timeout, scope, queue)
+        except Exception as e:
+            print(f"AI provider {provider.name} error: {e}")
+            errors.append(f"{provider.name}: {e}")
+    raise AIProviderError('; '.join(errors))
+
+
+def ai_complete(prompt, **kwargs):
+    """Single-prompt completion through the provider chain (see call_ai)."""
+    return call_ai('complete', prompt, **kwargs)
+
+
+def ai_complete_with_model(prompt, **kwargs):
+    """ai_complete() that also returns the model that answered: (model_name, text), for the LLM cache."""
+    provider, text = call_ai_with_provider('complete', prompt, **kwargs)
+    return provider.model_name, text
+
+
+def ai_provider_status():
+    """Circuit state of each configured provider, for the status endpoint."""
+    return [{
+        'name': provider.name,
+        'model': provider.model_name,
+        'state': provider.breaker.state,
+        'consecutive_failures': provider.breaker.failures
+    } for provider in ai_providers()]
+
+
+def generate_summary(text, max_length=None, use_cache=True):
+    """Generate AI summary of text through the AI provider chain (cached unless use_cache=False)."""
+    if not ai_available():
+        return None
+    
+    if not text:
+        return None
+    
+    if max_length is None:
+        max_length = app.config['AI_SUMMARY_MAX_LENGTH']
+    
+    try:
+        # Long documents are condensed chunk by chunk instead of only reading the first pages
+        max_input_chars = 12000
+        if app.config['AI_SUMMARY_HIERARCHICAL'] and len(text) > max_input_chars:
+            text = condense_text(text, max_input_chars, use_cache=use_cache)
+        
+        # Truncate text if too long
+        if len(text) > max_input_chars:
+            text = text[:max_input_chars] + "..."
+        
+        cache_key = llm_cache_key('summary', SUMMARY_PROMPT_VERSION, text, max_length=max_length)
+        if use_cache:
+            cached = llm_cache_get(cache_key)
+            if cached is not None:
+                return cached
+        else:
+            llm_cache_stats['bypassed'] += 1
+        
+        # Gemini first (free), OpenAI as fallback
+        prompt = f"Summarize the following academic document in {max_length} characters or less. Be concise and focus on key points:\n\n{text}"
+        model, summary = ai_complete_with_model(
+            prompt,
+            system="You are a helpful assistant that summarizes academic documents concisely.",
+            max_tokens=200,
+            temperature=0.5
+        )
+        summary = summary.strip()[:max_length]
+        llm_cache_set(cache_key, 'summary', summary, model)
+        return summary
+    except Exception as e:
+        print(f"Error generating summary: {e}")
+        return None
+
+
+# Local keyword extraction: regex tokens, words + repeated two-word phrases, tf-idf against the user's library
+KEYWORD_TOKEN_RE = re.compile(r"[a-z][a-z0-9]*(?:['-][a-z0-9]+)*")
+KEYWORD_NOISE_RE = re.compile(r"(?:https?://|www\.)\S+|\S+@\S+")  # URLs and e-mail addresses
+KEYWORD_STOP_WORDS = frozenset(stop_words) | ENGLISH_STOP_WORDS  # NLTK's list may not be downloaded
+KEYWORD_SCORED_TERMS = 200  # Most frequent candidates scored per document
+KEYWORD_INDEX_TERMS = 100  # Candidates per document counted into the library's document frequencies
+KEYWORD_PHRASE_WEIGHT = 1.5  # Phrases are rarer than their words but make better tags
+
+
+def keyword_candidates(text, limit=None):
+    """
+    Candidate keywords and their counts, most frequent first: non-stopwords of 4+ letters and
+    two-word phrases of non-stopwords that occur at least twice, e.g. {'entropy': 12, 'heat engine': 3}.
+    """
+    tokens = KEYWORD_TOKEN_RE.findall(KEYWORD_NOISE_RE.sub(' ', text.lower()))
+    content = [2 < len(token) <= 40 and token not in KEYWORD_STOP_WORDS for token in tokens]
+    counts = Counter(token for token, keep in zip(tokens, content) if keep and len(token) > 3)
+    phrases = Counter(f"{a} {b}" for a, b, keep_a, keep_b in zip(tokens, tokens[1:], content, content[1:])
+                      if keep_a and keep_b and a != b)
+    counts.update({phrase: n for phrase, n in phrases.items() if n >= 2})
+    return dict(counts.most_common(limit))
+
+
+def library_document_frequencies(user_id, terms):
+    """(number of analyzed documents, {term: document frequency}) for user_id's library."""
+    if user_id is None:
+        return 0, {}
+    n_docs = Document.query.filter(Document.user_id == user_id, Document.last_analyzed.isnot(None)).count()
+    rows = db.session.query(KeywordStat.term, KeywordStat.doc_freq)\
+        .filter(KeywordStat.user_id == user_id, KeywordStat.term.in_(terms)).all()
+    return n_docs, dict(rows)
+
+
+def update_keyword_stats(user_id, text, delta):
+    """Count one document's candidate terms into (delta=1) or out of (delta=-1) the user's document frequencies (caller commits)."""
+    terms = list(keyword_candidates(text or '', KEYWORD_INDEX_TERMS))
+    if not terms or user_id is None:
+        return
+    if delta > 0:
+        insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+        statement = insert(KeywordStat).values([{'user_id': user_id, 'term': term, 'doc_freq': 1} for term in terms])
+        # Upsert, so concurrent analysis workers never race on the unique (user_id, term) key
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'term'], set_={'doc_freq': KeywordStat.doc_freq + 1}
+        ))
+    else:
+        stats = KeywordStat.query.filter(KeywordStat.user_id == user_id, KeywordStat.term.in_(terms))
+        stats.update({KeywordStat.doc_freq: KeywordStat.doc_freq - 1}, synchronize_session=False)
+        stats.filter(KeywordStat.doc_freq <= 0).delete(synchronize_session=False)
+
+
+def keyword_tags(text, count=3, user_id=None):
+    """
+    Local smart tags: the text's candidate keywords ranked by tf-idf against user_id's library
+    (plain term frequency without a library). No LLM and no NLTK data needed.
+    """
+    candidates = keyword_candidates(text or '', KEYWORD_SCORED_TERMS)
+    if not candidates:
+        return []
+    terms = list(candidates)
+    n_docs, doc_freq = library_document_frequencies(user_id, terms)
+    
+    tf = np.fromiter(candidates.values(), dtype=float, count=len(terms))
+    df = np.fromiter((doc_freq.get(term, 0) for term in terms), dtype=float, count=len(terms))
+    is_phrase = np.fromiter((' ' in term for term in terms), dtype=bool, count=len(terms))
+    scores = (1 + np.log(tf)) * (np.log((1 + n_docs) / (1 + df)) + 1) * np.where(is_phrase, KEYWORD_PHRASE_WEIGHT, 1.0)
+    
+    tags = []
+    covered = set()
+    for i in np.argsort(-scores, kind='stable'):
+        words = terms[i].split()
+        # Skip a word already inside a chosen phrase, and a phrase around a chosen word
+        if covered.intersection(words):
+            continue
+        tags.append(terms[i])
+        covered.update(words)
+        if len(tags) == count:
+            break
+    return tags
+
+
+def generate_smart_tags(text, subject=None, use_cache=True, user_id=None):
+    """Generate smart tags using Google Gemini and NLP (LLM part cached unless use_cache=False)."""
+    if not text:
+        return []
+    
+    # Method 1: Local keyword extraction (all of the tags when no AI provider is configured)
+    tags = keyword_tags(text, count=3 if ai_available() else app.config['AI_TAGS_COUNT'], user_id=user_id)
+    
+    # Method 2: Use the AI provider for better tags
+    if ai_available() and len(text) > 50:
+        # Truncate text if too long
+        max_input_chars = 6000
+        if len(text) > max_input_chars:
+            text = text[:max_input_chars] + "..."
+        
+        cache_key = llm_cache_key('tags', TAGS_PROMPT_VERSION, text, subject=subject, count=app.config['AI_TAGS_COUNT'])
+        cached = None
+        if use_cache:
+            cached = llm_cache_get(cache_key)
+        else:
+            llm_cache_stats['bypassed'] += 1
+        
+        if cached is not None:
+            tags.extend(json.loads(cached))
+        else:
+            ai_tags_list = []
+            try:
+                prompt = f"Extract {app.config['AI_TAGS_COUNT']} relevant keywords/tags from this academic document."
+                if subject:
+                    prompt += f" Subject: {subject}."
+                prompt += f"\n\nDocument:\n{text}\n\nProvide only the tags, comma-separated, lowercase:"
+                
+                model, ai_tags = ai_complete_with_model(
+                    prompt,
+                    system="You are a helpful assistant that extracts relevant keywords from academic content.",
+                    max_tokens=50,
+                    temperature=0.3
+                )
+                ai_tags = ai_tags.strip()
+                # Parse comma-separated tags
+                ai_tags_list = [tag.strip().lower() for tag in ai_tags.split(',') if tag.strip()]
+            except Exception as e:
+                print(f"Error generating AI tags: {e}")
+            
+            if ai_tags_list:
+                llm_cache_set(cache_key, 'tags', json.dumps(ai_tags_list), model)
+            tags.extend(ai_tags_list)
+    
+    # Remove duplicates and limit count
+    tags = list(dict.fromkeys(tags))  # Preserve order while removing duplicates
+    return tags[:app.config['AI_TAGS_COUNT']]
+
+
+# The prompt asks for up to 10 key terms; longer lists and run-on "terms" are cut to what a key term is
+ANALYSIS_MAX_KEY_TERMS = 10
+ANALYSIS_MAX_TERM_LENGTH = 80
+
+
+def parse_structured_analysis(raw, max_length=None):
+    """Validate a JSON analysis response and normalise it; raises ValueError if it doesn't match the schema."""
+    text = raw.strip()
+    fenced = re.match(r'^```(?:json)?\s*(.*?)\s*```$', text, re.S)
+    if fenced:
+        text = fenced.group(1)
+    data = json.loads(text)  # json.JSONDecodeError is a ValueError
+    
+    if not isinstance(data, dict):
+        raise ValueError('analysis is not a JSON object')
+    summary = data.get('summary')
+    if not isinstance(summary, str) or not summary.strip():
+        raise ValueError('summary must be a non-empty string')
+    tags = data.get('tags')
+    if not isinstance(tags, list) or not tags or not all(isinstance(tag, str) for tag in tags):
+        raise ValueError('tags must be a non-empty list of strings')
+    key_terms = data.get('key_terms') or []
+    if not isinstance(key_terms, list) or not all(isinstance(term, str) for term in key_terms):
+        raise ValueError('key_terms must be a list of strings')
+    
+    return {
+        'summary': summary.strip()[:max_length],
+        'tags': [tag.strip().lower() for tag in tags if tag.strip()],
+        'key_terms': [term.strip()[:ANALYSIS_MAX_TERM_LENGTH] for term in key_terms if term.strip()][:ANALYSIS_MAX_KEY_TERMS]
+    }
+
+
+def generate_structured_analysis(text, subject=None, use_cache=True):
+    """
+    Summary, tags and key terms from a single JSON-mode LLM call.
+    Returns {'summary', 'tags', 'key_terms'}, or None if no provider answered with valid JSON.
+    """
+    if not text or not ai_available():
+        return None
+    
+    max_length = app.config['AI_SUMMARY_MAX_LENGTH']
+    count = app.config['AI_TAGS_COUNT']
+    
+    # Same input budget as the summary call; the tags call used to resend the first half of it
+    max_input_chars = 12000
+    if app.config['AI_SUMMARY_HIERARCHICAL'] and len(text) > max_input_chars:
+        text = condense_text(text, max_input_chars, use_cache=use_cache)
+    if len(text) > max_input_chars:
+        text = text[:max_input_chars] + "..."
+    
+    cache_key = llm_cache_key('analysis', ANALYSIS_PROMPT_VERSION, text, subject=subject, max_length=max_length, count=count)
+    if use_cache:
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+    else:
+        llm_cache_stats['bypassed'] += 1
+    
+    subject_hint = f" Subject: {subject}." if subject else ""
+    prompt = f"""Analyze the following academic document.{subject_hint}
+Respond with only a JSON object in this exact format:
+{{"summary": "...", "tags": ["...", "..."], "key_terms": ["...", "..."]}}
+
+- summary: {max_length} characters or less, concise and focused on key points
+- tags: {count} relevant keywords, lowercase
+- key_terms: up to 10 important terms or concepts the document explains
+
+Document:
+{text}"""
+    
+    try:
+        model, raw = ai_complete_with_model(
+            prompt,
+            system="You analyze academic documents and answer in JSON.",
+            json_mode=True,
+            max_tokens=400,
+            temperature=0.3
+        )
+    except Exception as e:
+        print(f"Structured analysis error: {e}")
+        return None
+    
+    try:
+        result = parse_structured_analysis(raw, max_length)
+    except ValueError as e:
+        print(f"Structured analysis parse error: {e}")
+        return None
+    
+    llm_cache_set(cache_key, 'analysis', json.dumps(result), model)
+    return result
+
+
+def analyze_document(document_id, use_cache=True, progress=None):
+    """Run full AI analysis on a document: extract text, generate summary, generate tags.
+
+    use_cache=False bypasses the LLM response cache (forced re-analysis).
+    progress(stage, current=None, total=None) is called as the analysis advances.
+    """
+    document = Document.query.get(document_id)
+    if not document:
+        return False
+    
+    # Get file path
+    if document.storage_type == 'local':
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], document.stored_filename)
+        if not os.path.exists(file_path):
+            return False
+    else:
+        # For S3/Azure, would need to download file first
+        return False
+    
+    # Extract text
+    if progress:
+        progress('extracting')
+    extracted_text = extract_text_from_document(file_path, document.mimetype, progress=progress)
+    if extracted_text:
+        summary, smart_tags, key_terms = generate_analysis(extracted_text, document.subject, use_cache=use_cache,
+                                                           progress=progress, user_id=document.user_id)
+        apply_analysis(document, extracted_text, summary, smart_tags, key_terms)
+        db.session.commit()
+        schedule_semantic_model_fit()
+        return True
+    
+    return False
+
+
+def generate_analysis(extracted_text, subject, use_cache=True, progress=None, user_id=None):
+    """
+    Run the LLM steps of an analysis and return (summary, smart_tags, key_terms).
+    One structured call is tried first; the separate summary and tags calls are only
+    used when it is disabled or its response can't be parsed.
+    """
+    if progress:
+        progress('summarizing')
+    
+    if app.config['AI_STRUCTURED_ANALYSIS']:
+        result = generate_structured_analysis(extracted_text, subject, use_cache=use_cache)
+        if result:
+            if progress:
+                progress('tagging')
+            smart_tags = list(dict.fromkeys(keyword_tags(extracted_text, user_id=user_id) + result['tags']))
+            return result['summary'], smart_tags[:app.config['AI_TAGS_COUNT']], result['key_terms']
+    
+    summary = generate_summary(extracted_text, use_cache=use_cache)
+    if progress:
+        progress('tagging')
+    smart_tags = generate_smart_tags(extracted_text, subject, use_cache=use_cache, user_id=user_id)
+    return summary, smart_tags, []
+
+
+def join_to_column(values, column):
+    """Comma-join whole values, dropping the ones that would overflow the String column's length."""
+    joined = ''
+    for value in values:
+        candidate = f"{joined}, {value}" if joined else value
+        if len(candidate) > column.type.length:
+            break
+        joined = candidate
+    return joined
+
+
+def apply_analysis(document, extracted_text, summary, smart_tags, key_terms=None):
+    """Store analysis results on a document and count its keywords into the owner's library statistics (caller commits)."""
+    if document.last_analyzed is not None:
+        update_keyword_stats(document.user_id, document.extracted_text, -1)
+    update_keyword_stats(document.user_id, extracted_text, 1)
+    document.extracted_text = extracted_text
+    if summary:
+        document.summary = summary
+    if smart_tags:
+        document.ai_tags = join_to_column(smart_tags, Document.__table__.c.ai_tags)
+    if key_terms:
+        document.key_terms = join_to_column(key_terms, Document.__table__.c.key_terms)
+    document.last_analyzed = datetime.utcnow()
+
+
+# ============================================================================
+# Map-Reduce Summarization
+# ============================================================================
+
+# Partial summaries are kept short so a whole textbook condenses into one reduce call
+CHUNK_SUMMARY_MAX_LENGTH = 600
+
+
+def summary_chunks(text, chunk_chars=None):
+    """
+    Split text into content-defined chunks for map-reduce summarization.
+    A chunk closes after a line whose hash hits a boundary once the chunk is half full (or when it is
+    full), so boundaries depend on nearby text only: an edit changes the chunks around it, and every
+    other chunk keeps its cache key.
+    """
+    chunk_chars = chunk_chars or app.config['AI_SUMMARY_CHUNK_CHARS']
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        pieces = [chunk for _, chunk in chunk_text(line, chunk_chars, overlap=0)] if len(line) > chunk_chars else [line]
+        for piece in pieces:
+            if current and size + len(piece) > chunk_chars:
+                chunks.append(''.join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece)
+            if size >= chunk_chars // 2 and hashlib.md5(piece.encode('utf-8')).digest()[0] % 8 == 0:
+                chunks.append(''.join(current))
+                current, size = [], 0
+    if current:
+        chunks.append(''.join(current))
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def summarize_chunk(chunk, use_cache=True):
+    """Map step: summarize one section (cached by content). Returns None if no provider answered."""
+    cache_key = llm_cache_key('chunk_summary', CHUNK_SUMMARY_PROMPT_VERSION, chunk, max_length=CHUNK_SUMMARY_MAX_LENGTH)
+    if use_cache:
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            return cached
+    else:
+        llm_cache_stats['bypassed'] += 1
+    
+    prompt = (f"Summarize this section of an academic document in {CHUNK_SUMMARY_MAX_LENGTH} characters or less. "
+              f"Keep key facts, definitions and results:\n\n{chunk}")
+    try:
+        model, summary = ai_complete_with_model(
+            prompt,
+            system="You are a helpful assistant that summarizes academic documents concisely.",
+            max_tokens=200,
+            temperature=0.5
+        )
+        summary = summary.strip()[:CHUNK_SUMMARY_MAX_LENGTH]
+    except Exception as e:
+        print(f"Chunk summary error: {e}")
+        return None
+    
+    if summary:
+        llm_cache_set(cache_key, 'chunk_summary', summary, model)
+    return summary
+
+
+def _summarize_chunk_in_context(chunk, use_cache, scope):
+    """Thread-pool entry point: summarize_chunk() with its own app context / DB session, billed to the caller's scope."""
+    with app.app_context(), ai_call_scope(*scope):
+        try:
+            return summarize_chunk(chunk, use_cache)
+        finally:
+            db.session.remove()
+
+
+def condense_text(text, max_chars, use_cache=True):
+    """
+    Map step(s) of map-reduce summarization: replace text with its chunk summaries, in order,
+    until it fits in max_chars. Chunks are summarized concurrently on a bounded thread pool
+    (the shared rate limiter still applies). The caller's prompt is the reduce step.
+    """
+    scope = current_ai_scope()
+    while len(text) > max_chars:
+        # Very long books get bigger chunks so one pass never needs more than AI_SUMMARY_MAX_CHUNKS calls
+        chunk_chars = max(app.config['AI_SUMMARY_CHUNK_CHARS'], -(-len(text) // app.config['AI_SUMMARY_MAX_CHUNKS']))
+        chunks = summary_chunks(text, chunk_chars)
+        
+        with ThreadPoolExecutor(max_workers=max(1, app.config['AI_SUMMARY_WORKERS'])) as pool:
+            partials = list(pool.map(_summarize_chunk_in_context, chunks, [use_cache] * len(chunks), [scope] * len(chunks)))
+        
+        # A failed section keeps its opening lines rather than disappearing from the summary
+        condensed = '\n\n'.join(partial or chunk[:CHUNK_SUMMARY_MAX_LENGTH] for partial, chunk in zip(partials, chunks))
+        if len(condensed) >= len(text):
+            break
+        text = condensed
+    return text
+
+
+# ============================================================================
+# Background Analysis Jobs
+# ============================================================================
+
+analysis_executor = ThreadPoolExecutor(max_workers=app.config['ANALYSIS_WORKERS'])
+
+
+def update_analysis_job(job_id, **fields):
+    """Persist a job update in its own short transaction (no-op if the job was deleted with its document)."""
+    job = db.session.get(AnalysisJob, job_id)
+    if job is None:
+        return
+    for key, value in fields.items():
+        setattr(job, key, value)
+    job.seq = (job.seq or 0) + 1
+    db.session.commit()
+
+
+def run_analysis_job(job_id, use_cache=True):
+    """Executor entry point: run analyze_document() for a job and record its progress."""
+    with app.app_context():
+        job = db.session.get(AnalysisJob, job_id)
+        if job is None or job.status != 'queued':
+            return  # Deleted with its document, or given up on as stale while it waited
+        document_id = job.document_id
+        user_id = job.user_id
+        scope = ('analysis_job', user_id)
+        update_analysis_job(job_id, status='running', stage='extracting')
+        last_write = [0.0]
+        
+        def progress(stage, current=None, total=None):
+            # Page ticks are throttled; stage changes are always written
+            now = time.monotonic()
+            if current is not None and current != total and now - last_write[0] < app.config['ANALYSIS_EVENT_POLL_SECONDS']:
+                return
+            last_write[0] = now
+            update_analysis_job(job_id, stage=stage, current=current, total=total)
+        
+        try:
+            with ai_call_scope(*scope):
+                success = analyze_document(document_id, use_cache=use_cache, progress=progress)
+            if success:
+                update_analysis_job(job_id, status='done', stage='done', current=None, total=None)
+                log_activity('analysis', document_id=document_id, user_id=user_id)
+                schedule_quiz_pregeneration(document_id)
+            else:
+                update_analysis_job(job_id, status='failed', error='Analysis failed')
+        except Exception as e:
+            print(f"Analysis job {job_id} failed: {e}")
+            db.session.rollback()
+            update_analysis_job(job_id, status='failed', error=str(e))
+
+
+def fail_stale_analysis_job(job):
+    """
+    Mark a queued or running job that has not been updated for ANALYSIS_JOB_STALE_SECONDS as failed:
+    its worker restarted and the in-process queue was lost. Returns True if the job was marked.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=app.config['ANALYSIS_JOB_STALE_SECONDS'])
+    if job.status not in ('queued', 'running') or (job.updated_at and job.updated_at >= stale_before):
+        return False
+    update_analysis_job(job.id, status='failed', error='Analysis was interrupted; please start it again')
+    return True
+
+
+# Each open stream holds a server thread; see STREAM_MAX_CONCURRENT
+stream_slots = threading.BoundedSemaphore(app.config['STREAM_MAX_CONCURRENT'])
+
+
+def acquire_stream_slot():
+    """Take one of this worker's stream slots without waiting; False if all are in use."""
+    return stream_slots.acquire(blocking=False)
+
+
+def event_stream_response(events):
+    """SSE response for a generator run under an acquired stream slot; the slot is freed when the stream ends or is closed."""
+    released = []
+    
+    def release():
+        if not released:
+            released.append(True)
+            stream_slots.release()
+    
+    def stream():
+        try:
+            yield from events
+        finally:
+            release()
+    
+    response = Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(release)  # Also when the generator never started
+    return response
+
+
+def sse_event(event, data, event_id=None):
+    """Format one Server-Sent Events frame with a JSON payload."""
+    frame = f"id: {event_id}\n" if event_id is not None else ""
+    return frame + f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def analysis_job_payload(job):
+    """Job state for the client; finished jobs include the analysis results."""
+    payload = job.to_dict()
+    if job.status == 'done':
+        document = Document.query.options(db.undefer_group('content')).get(job.document_id)
+        payload.update({
+            'summary': document.summary,
+            'ai_tags': document.ai_tags,
+            'key_terms': document.key_terms,
+            'extracted_text_length': len(document.extracted_text) if document.extracted_text else 0
+        })
+    return payload
+
+
+# ============================================================================
+# Bulk Analysis
+# ============================================================================
+
+def _extract_for_bulk(file_path, mimetype):
+    """Process-pool entry point: extract text from one file."""
+    return extract_text_from_document(file_path, mimetype or '')
+
+
+def _analyze_text_for_bulk(extracted_text, subject, user_id, use_cache, scope):
+    """Thread-pool entry point: LLM steps with their own app context / DB session."""
+    with app.app_context(), ai_call_scope(*scope):
+        return generate_analysis(extracted_text, subject, use_cache=use_cache, user_id=user_id)
+
+
+def pending_analysis_query(user_id=None):
+    """Local documents that have never been analyzed."""
+    q = Document.query.filter(
+        Document.last_analyzed.is_(None),
+        Document.storage_type == 'local'
+    )
+    if user_id is not None:
+        q = q.filter(Document.user_id == user_id)
+    return q
+
+
+def fail_stale_analysis_runs(user_id=None):
+    """
+    Mark 'running' runs without a heartbeat for BULK_ANALYSIS_STALE_MINUTES as failed (their process
+    crashed or restarted), so they can be resumed. Returns how many were marked.
+    """
+    stale_before = datetime.utcnow() - timedelta(minutes=app.config['BULK_ANALYSIS_STALE_MINUTES'])
+    stale = AnalysisRun.query.filter(
+        AnalysisRun.user_id == user_id,
+        AnalysisRun.status == 'running',
+        db.or_(AnalysisRun.updated_at.is_(None), AnalysisRun.updated_at < stale_before)
+    ).all()
+    for run in stale:
+        run.status = 'failed'
+        run.error = f"no progress for {app.config['BULK_ANALYSIS_STALE_MINUTES']:g} minutes (worker stopped)"
+    if stale:
+        db.session.commit()
+    return len(stale)
+
+
+def run_bulk_analysis(run_id, extract_workers=None, llm_workers=None, batch_size=20, limit=None, use_cache=True, progress=None):
+    """
+    Analyze every pending document for an AnalysisRun.
+
+    Text extraction runs on a process pool (extract_workers=0 extracts inline), the LLM
+    steps on a thread pool of llm_workers that all share the rate limiter in _call_provider(), and
+    results are committed after each batch together with the run cursor, so an
+    interrupted run resumes where it stopped.
+    """
+    run = AnalysisRun.query.get(run_id)
+    if extract_workers is None:
+        extract_workers = os.cpu_count() or 2
+    if llm_workers is None:
+        llm_workers = app.config['AI_MAX_CONCURRENT_CALLS']
+    
+    run.status = 'running'
+    run.started_at = run.started_at or datetime.utcnow()
+    run.updated_at = datetime.utcnow()
+    run.error = None
+    run.total = run.processed + pending_analysis_query(run.user_id).filter(Document.id > run.last_document_id).count()
+    if limit is not None:
+        run.total = min(run.total, run.processed + limit)
+    db.session.commit()
+    
+    started = time.monotonic()
+    processed_this_session = 0
+    # 'spawn' so that forking a multi-threaded web worker is never needed
+    extract_pool = ProcessPoolExecutor(
+        max_workers=extract_workers,
+        mp_context=multiprocessing.get_context('spawn')
+    ) if extract_workers else None
+    llm_pool = ThreadPoolExecutor(max_workers=llm_workers)
+    scope = ('bulk_analysis', run.user_id)
+    
+    try:
+        while limit is None or processed_this_session < limit:
+            size = batch_size if limit is None else min(batch_size, limit - processed_this_session)
+            batch = pending_analysis_query(run.user_id).filter(
+                Document.id > run.last_document_id
+            ).order_by(Document.id).limit(size).all()
+            if not batch:
+                break
+            
+            # Stage 1: text extraction (CPU-bound, process pool)
+            texts = {}
+            paths = {doc.id: os.path.join(app.config['UPLOAD_FOLDER'], doc.stored_filename) for doc in batch}
+            if extract_pool:
+                futures = {extract_pool.submit(_extract_for_bulk, paths[doc.id], doc.mimetype): doc.id
+                           for doc in batch if os.path.exists(paths[doc.id])}
+                for future in as_completed(futures):
+                    try:
+                        texts[futures[future]] = future.result()
+                    except Exception as e:
+                        print(f"Bulk extraction error for document {futures[future]}: {e}")
+            else:
+                for doc in batch:
+                    if os.path.exists(paths[doc.id]):
+                        texts[doc.id] = _extract_for_bulk(paths[doc.id], doc.mimetype)
+            
+            # Stage 2: LLM calls (I/O-bound, rate limited thread pool)
+            docs_by_id = {doc.id: doc for doc in batch}
+            futures = {llm_pool.submit(_analyze_text_for_bulk, text, docs_by_id[doc_id].subject,
+                                       docs_by_id[doc_id].user_id, use_cache, scope): doc_id
+                       for doc_id, text in texts.items() if text}
+            results = {}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Bulk analysis error for document {futures[future]}: {e}")
+                    run.failed += 1
+            # Written once every call of the batch is done: on SQLite the batch's write lock would
+            # otherwise stall the LLM cache writes of calls still running
+            for doc_id, (summary, smart_tags, key_terms) in results.items():
+                apply_analysis(docs_by_id[doc_id], texts[doc_id], summary, smart_tags, key_terms)
+                run.succeeded += 1
+            run.failed += len(batch) - len(futures)  # missing files / no extractable text
+            
+            run.processed += len(batch)
+            run.last_document_id = batch[-1].id
+            processed_this_session += len(batch)
+            elapsed_minutes = (time.monotonic() - started) / 60
+            run.docs_per_minute = round(processed_this_session / elapsed_minutes, 2) if elapsed_minutes else None
+            db.session.commit()
+            
+            if progress:
+                progress(run)
+        
+        run.status = 'completed'
+        run.finished_at = datetime.utcnow()
+        db.session.commit()
+        schedule_semantic_model_fit()
+    except Exception as e:
+        db.session.rollback()
+        run = AnalysisRun.query.get(run_id)
+        run.status = 'failed'
+        run.error = str(e)
+        db.session.commit()
+        raise
+    finally:
+        llm_pool.shutdown(wait=True)
+        if extract_pool:
+            extract_pool.shutdown(wait=True)
+    
+    return run
+
+
+# ============================================================================
+# Quiz Bank
+# ============================================================================
+
+QUIZ_DIFFICULTIES = ('easy', 'medium', 'hard')
+QUIZ_MAX_QUESTIONS = 20  # Per request
+
+quiz_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def parse_quiz_questions(raw):
+    """Extract and validate the questions from a quiz response; raises ValueError if none are usable."""
+    json_match = re.search(r'\{[\s\S]*\}', raw)
+    if not json_match:
+        raise ValueError('no JSON object in quiz response')
+    data = json.loads(json_match.group())
+    
+    questions = []
+    for item in data.get('questions') or []:
+        if not isinstance(item, dict):
+            continue
+        question = item.get('question')
+        options = item.get('options')
+        answer = item.get('correct_answer')
+        if (isinstance(question, str) and question.strip() and isinstance(options, list) and len(options) >= 2
+                and isinstance(answer, int) and 0 <= answer < len(options)):
+            questions.append({
+                'question': question.strip(),
+                'options': [str(option) for option in options],
+                'correct_answer': answer,
+                'explanation': str(item.get('explanation', ''))
+            })
+    if not questions:
+        raise ValueError('quiz response has no valid questions')
+    return questions
+
+
+def generate_quiz_questions(document, num_questions, difficulty, topic=None):
+    """
+    Ask the AI provider for quiz questions about a document.
+    Returns (questions, raw_response); questions is None when the response could not be parsed.
+    """
+    # Relevant chunks for a topic, otherwise a sample spread over the whole document
+    content = retrieve_document_context(document, topic or None, char_budget=4000)
+    if not content:
+        raise ValueError('Document has no extracted text. Please analyze it first.')
+    
+    focus = f"\nFocus on: {topic}" if topic else ""
+    prompt = f"""Based on the following document content, generate {num_questions} multiple-choice questions at {difficulty} difficulty level.
+
+Document: {document.original_filename}
+Subject: {document.subject}{focus}
+
+Content:
+{content}
+
+Generate questions in this exact JSON format:
+{{
+  "questions": [
+    {{
+      "question": "Question text here?",
+      "options": ["Option A", "Option B", "Option C", "Option D"],
+      "correct_answer": 0,
+      "explanation": "Why this answer is correct"
+    }}
+  ]
+}}
+
+Make the questions educational and test real understanding, not just memorization."""
+    
+    raw = ai_complete(prompt)
+    try:
+        return parse_quiz_questions(raw), raw
+    except ValueError as e:
+        print(f"Quiz parse error: {e}")
+        return None, raw
+
+
+def quiz_bank(document, difficulty):
+    """QuizSets for the document's current text; sets written from older text are ignored."""
+    content_hash = get_chunk_index(document).content_hash
+    return QuizSet.query.filter_by(document_id=document.id, difficulty=difficulty, content_hash=content_hash)\
+        .order_by(QuizSet.id).all()
+
+
+def add_quiz_set(document, difficulty, questions):
+    """Store newly generated questions, skipping ones already in the bank (caller commits)."""
+    seen = {q['question'].lower() for quiz_set in quiz_bank(document, difficulty) for q in json.loads(quiz_set.questions)}
+    fresh = [q for q in questions if q['question'].lower() not in seen]
+    if not fresh:
+        return None
+    quiz_set = QuizSet(
+        document_id=document.id,
+        difficulty=difficulty,
+        content_hash=get_chunk_index(document).content_hash,
+        questions=json.dumps(fresh),
+        question_count=len(fresh)
+    )
+    db.session.add(quiz_set)
+    return quiz_set
+
+
+def top_up_quiz_bank(document_id, difficulty):
+    """Background entry point: add one QuizSet if the bank is below QUIZ_BANK_MIN_QUESTIONS."""
+    with app.app_context():
+        try:
+            document = db.session.get(Document, document_id)
+            if not document or not ai_available():
+                return
+            if sum(s.question_count for s in quiz_bank(document, difficulty)) >= app.config['QUIZ_BANK_MIN_QUESTIONS']:
+                return
+            with ai_call_scope('quiz_pregeneration', document.user_id):
+                questions, _ = generate_quiz_questions(document, app.config['QUIZ_SET_SIZE'], difficulty)
+            if questions and add_quiz_set(document, difficulty, questions):
+                db.session.commit()
+        except Exception as e:
+            print(f"Quiz pre-generation error for document {document_id}: {e}")
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+
+def schedule_quiz_pregeneration(document_id, difficulties=None):
+    """Queue quiz bank top-ups for a freshly analyzed document."""
+    for difficulty in difficulties or app.config['QUIZ_PREGENERATE_DIFFICULTIES']:
+        quiz_executor.submit(top_up_quiz_bank, document_id, difficulty)
+
+
+def serve_quiz(document, num_questions, difficulty):
+    """
+    Return (questions, source, raw_response) with num_questions sampled from the bank, least
+    served sets first (random within a set), so new top-ups are seen before old questions repeat.
+    Generates synchronously only when the bank can't cover the request, and schedules a
+    background top-up when it holds fewer than QUIZ_BANK_MIN_QUESTIONS. questions is None
+    (with the model's raw_response) if a needed generation could not be parsed.
+    """
+    sets = quiz_bank(document, difficulty)
+    pool = [(quiz_set, question) for quiz_set in sets for question in json.loads(quiz_set.questions)]
+    source = 'bank'
+    
+    if len(pool) < num_questions:
+        questions, raw = generate_quiz_questions(document, max(num_questions, app.config['QUIZ_SET_SIZE']), difficulty)
+        if questions is None:
+            return None, 'generated', raw
+        quiz_set = add_quiz_set(document, difficulty, questions)
+        db.session.commit()
+        if quiz_set:
+            pool += [(quiz_set, question) for question in json.loads(quiz_set.questions)]
+        source = 'generated'
+    
+    random.shuffle(pool)
+    pool.sort(key=lambda item: item[0].served_count or 0)  # Stable: shuffled order kept within a count
+    picked = pool[:num_questions]
+    for quiz_set, _ in picked:
+        quiz_set.served_count = (quiz_set.served_count or 0) + 1
+    db.session.commit()
+    
+    if len(pool) < app.config['QUIZ_BANK_MIN_QUESTIONS']:
+        quiz_executor.submit(top_up_quiz_bank, document.id, difficulty)
+    
+    return [question for _, question in picked], source, None
+
+
+# ============================================================================
+# Document Retrieval (chunk index for chat / quiz context)
+# ============================================================================
+
+RETRIEVAL_CHUNK_CHARS = 800
+RETRIEVAL_CHUNK_OVERLAP = 150
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def chunk_text(text, chunk_chars=RETRIEVAL_CHUNK_CHARS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+    """Split text into overlapping chunks that break on whitespace. Returns [(offset, chunk), ...]."""
+    chunks = []
+    length = len(text)
+    start = 0
+    while start < length:
+        end = min(start + chunk_chars, length)
+        if end < length:
+            # Prefer a line break, then a space, in the second half of the window
+            cut = text.rfind('\n', start + chunk_chars // 2, end)
+            if cut == -1:
+                cut = text.rfind(' ', start + chunk_chars // 2, end)
+            if cut != -1:
+                end = cut
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append((start, chunk))
+        if end >= length:
+            break
+        next_start = max(end - overlap, start + 1)
+        space = text.find(' ', next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return chunks
+
+
+class DocumentChunkIndex:
+    """BM25 index over one document's chunks, stored as a sparse (chunk x term) weight matrix."""
+    
+    def __init__(self, text):
+        self.content_hash = hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+        self.chunks = chunk_text(text or '')
+        self.weights = None
+        self.vocabulary = {}
+        self.analyzer = None
+        if not self.chunks:
+            return
+        
+        vectorizer = CountVectorizer(stop_words='english', dtype=np.float32)
+        try:
+            tf = vectorizer.fit_transform([chunk for _, chunk in self.chunks]).tocsc()
+        except ValueError:  # Only stop words / no tokens
+            return
+        
+        # Precompute the BM25 weight of every (chunk, term) pair so a query is just a column sum
+        chunk_lengths = np.asarray(tf.sum(axis=1)).ravel()
+        avg_length = chunk_lengths.mean() or 1.0
+        doc_freq = np.diff(tf.indptr)
+        idf = np.log(1 + (len(self.chunks) - doc_freq + 0.5) / (doc_freq + 0.5))
+        term_ids = np.repeat(np.arange(tf.shape[1]), doc_freq)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk_lengths[tf.indices] / avg_length)
+        tf.data = (idf[term_ids] * tf.data * (BM25_K1 + 1) / (tf.data + norm)).astype(np.float32)
+        
+        self.weights = tf
+        self.vocabulary = vectorizer.vocabulary_
+        self.analyzer = vectorizer.build_analyzer()
+    
+    def search(self, query):
+        """Return chunk indices ordered by BM25 score (chunks sharing no terms are omitted)."""
+        if self.weights is None or not query:
+            return []
+        term_ids = sorted({self.vocabulary[t] for t in self.analyzer(query) if t in self.vocabulary})
+        if not term_ids:
+            return []
+        scores = np.asarray(self.weights[:, term_ids].sum(axis=1)).ravel()
+        matches = np.flatnonzero(scores)
+        return matches[np.argsort(-scores[matches], kind='stable')].tolist()
+    
+    def spread(self, count):
+        """Return `count` chunk indices spaced evenly through the document."""
+        count = max(1, min(count, len(self.chunks)))
+        return sorted(set(np.linspace(0, len(self.chunks) - 1, num=count).round().astype(int).tolist()))
+
+
+# document_id -> (last_analyzed, DocumentChunkIndex), least recently used first
+chunk_index_cache = OrderedDict()
+chunk_index_lock = threading.Lock()
+
+
+def get_chunk_index(document):
+    """Return the cached chunk index for a document, rebuilding it when the document is re-analyzed."""
+    with chunk_index_lock:
+        entry = chunk_index_cache.get(document.id)
+        if entry and entry[0] == document.last_analyzed:
+            chunk_index_cache.move_to_end(document.id)
+            return entry[1]
+    
+    # Built outside the lock; only cache misses load the (deferred) extracted text
+    index = DocumentChunkIndex(document.extracted_text)
+    with chunk_index_lock:
+        chunk_index_cache[document.id] = (document.last_analyzed, index)
+        chunk_index_cache.move_to_end(document.id)
+        while len(chunk_index_cache) > app.config['RETRIEVAL_CACHE_DOCUMENTS']:
+            chunk_index_cache.popitem(last=False)
+    return index
+
+
+def retrieve_document_context(document, query=None, char_budget=4000, top_k=None):
+    """
+    Return the chunks of a document most relevant to `query`, in reading order, within char_budget.
+    Without a query (or when nothing matches) chunks are sampled evenly across the whole document.
+    """
+    top_k = top_k or app.config['RETRIEVAL_TOP_K']
+    index = get_chunk_index(document)
+    if not index.chunks:
+        return ''
+    
+    ranked = index.search(query) if query else []
+    if not ranked:
+        ranked = index.spread(max(top_k, char_budget // RETRIEVAL_CHUNK_CHARS))
+        top_k = len(ranked)
+    
+    picked = []
+    used = 0
+    for i in ranked:
+        size = len(index.chunks[i][1])
+        if used + size > char_budget:
+            continue
+        picked.append(i)
+        used += size
+        if len(picked) >= top_k:
+            break
+    if not picked:
+        # Budget smaller than a chunk: trim the best one
+        return index.chunks[ranked[0]][1][:char_budget]
+    
+    return '\n[...]\n'.join(index.chunks[i][1] for i in sorted(picked))
+
+
+# ============================================================================
+# Full-Text Search Index (SQLite FTS5 / PostgreSQL tsvector)
+# ============================================================================
+
+# The index is written from the ORM flush, so every insert, edit and analysis keeps it current.
+# Values are indexed as plain text (compressed columns are decompressed first).
+SEARCH_INDEX_COLUMNS = ('original_filename', 'subject', 'tags', 'ai_tags', 'key_terms', 'summary', 'extracted_text')
+SEARCH_INDEX_DDL = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS document_fts USING fts5("
+        "filename, subject, tags, summary, body, tokenize='porter unicode61 remove_diacritics 2')",
+    ],
+    'postgresql': [
+        "ALTER TABLE document ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        "CREATE INDEX IF NOT EXISTS ix_document_search_vector ON document USING GIN (search_vector)",
+    ],
+}
+# Vocabulary of indexed words for typo tolerance, created alongside the index but allowed to fail on its
+# own (pg_trgm needs CREATE EXTENSION rights): a trigram side table on SQLite, a pg_trgm GIN index on Postgres
+SEARCH_FUZZY_DDL = {
+    'sqlite': [
+        "CREATE TABLE IF NOT EXISTS search_term ("
+        "id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE, trigram_count INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS search_trigram ("
+        "trigram TEXT NOT NULL, term_id INTEGER NOT NULL, PRIMARY KEY (trigram, term_id)) WITHOUT ROWID",
+    ],
+    'postgresql': [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE TABLE IF NOT EXISTS search_term (term TEXT PRIMARY KEY)",
+        "CREATE INDEX IF NOT EXISTS ix_search_term_trgm ON search_term USING GIN (term gin_trgm_ops)",
+    ],
+}
+SEARCH_TERM_RE = re.compile(r'\w+')
+SEARCH_VOCABULARY_RE = re.compile(r'\b[^\W\d_]{3,32}\b')  # Words worth correcting to: letters only
+search_index_state = {}  # Database URL -> whether the index exists there
+
+
+def search_index_available(connection):
+    """True if the full-text index exists in this database (checked once per database)."""
+    key = str(connection.engine.url)
+    if key not in search_index_state:
+        dialect = connection.dialect.name
+        if dialect == 'sqlite':
+            sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document_fts'"
+        elif dialect == 'postgresql':
+            sql = "SELECT 1 FROM information_schema.columns WHERE table_name = 'document' AND column_name = 'search_vector'"
+        else:
+            sql = None
+        search_index_state[key] = bool(sql and connection.execute(db.text(sql)).first())
+    return search_index_state[key]
+
+
+def create_search_index(connection):
+    """Create the index structures for this database; False if the backend can't (e.g. SQLite without FTS5)."""
+    statements = SEARCH_INDEX_DDL.get(connection.dialect.name)
+    try:
+        for statement in statements or ():
+            connection.execute(db.text(statement))
+    except Exception as e:
+        print(f"Full-text index unavailable, search falls back to LIKE: {e}")
+        statements = None
+    search_index_state[str(connection.engine.url)] = bool(statements)
+    if statements:
+        create_fuzzy_index(connection)
+    return bool(statements)
+
+
+def create_fuzzy_index(connection):
+    """Create the vocabulary / trigram tables; False (exact search only) if the backend can't."""
+    key = (str(connection.engine.url), 'search_term')
+    try:
+        # Savepoint, so a missing pg_trgm doesn't abort the transaction that created the full-text index
+        with connection.begin_nested():
+            for statement in SEARCH_FUZZY_DDL.get(connection.dialect.name, ()):
+                connection.execute(db.text(statement))
+    except Exception as e:
+        print(f"Trigram index unavailable, search stays exact-only: {e}")
+        known_tables[key] = False
+        return False
+    known_tables[key] = connection.dialect.name in SEARCH_FUZZY_DDL
+    return known_tables[key]
+
+
+@event.listens_for(Document.__table__, 'after_create')
+def _create_search_index_with_table(target, connection, **kw):
+    create_search_index(connection)
+
+
+@event.listens_for(Document.__table__, 'before_drop')
+def _drop_search_index_with_table(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for table in ('document_fts', 'search_term', 'search_trigram'):
+            connection.execute(db.text(f"DROP TABLE IF EXISTS {table}"))
+    search_index_state.pop(str(connection.engine.url), None)
+    known_tables.pop((str(connection.engine.url), 'search_term'), None)
+
+
+def search_index_fields(connection, document, fetch_unloaded=True):
+    """Plain-text values of the indexed columns; deferred ones that aren't loaded are read through `connection`."""
+    state = db.inspect(document)
+    unloaded = [name for name in SEARCH_INDEX_COLUMNS if name in state.unloaded]
+    values = {name: getattr(document, name) for name in SEARCH_INDEX_COLUMNS if name not in unloaded}
+    if unloaded and fetch_unloaded:
+        table = Document.__table__
+        row = connection.execute(db.select(*[table.c[name] for name in unloaded]).where(table.c.id == document.id)).one()
+        values.update(zip(unloaded, row))
+    return {name: values.get(name) or '' for name in SEARCH_INDEX_COLUMNS}
+
+
+def write_search_index(connection, document_id, fields):
+    """Replace one document's entry in the full-text index."""
+    params = {
+        'id': document_id,
+        'filename': fields['original_filename'],
+        'subject': fields['subject'],
+        'tags': ' '.join(filter(None, (fields['tags'], fields['ai_tags'], fields['key_terms']))),
+        'summary': fields['summary'],
+        'body': fields['extracted_text'][:app.config['SEARCH_INDEX_BODY_CHARS']],
+    }
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text(
+            "UPDATE document SET search_vector = "
+            "setweight(to_tsvector('english', :filename), 'A') || "
+            "setweight(to_tsvector('english', :subject || ' ' || :tags), 'B') || "
+            "setweight(to_tsvector('english', :summary), 'C') || "
+            "setweight(to_tsvector('english', :body), 'D') "
+            "WHERE id = :id"
+        ), params)
+    else:
+        connection.execute(db.text("DELETE FROM document_fts WHERE rowid = :id"), params)
+        connection.execute(db.text(
+            "INSERT INTO document_fts (rowid, filename, subject, tags, summary, body) "
+            "VALUES (:id, :filename, :subject, :tags, :summary, :body)"
+        ), params)
+    if fuzzy_index_available(connection):
+        add_search_terms(connection, ' '.join(params[name] for name in ('filename', 'subject', 'tags', 'summary', 'body')))
+
+
+@event.listens_for(Document, 'after_insert')
+def _index_new_document(mapper, connection, target):
+    if search_index_available(connection):
+        write_search_index(connection, target.id, search_index_fields(connection, target, fetch_unloaded=False))
+
+
+@event.listens_for(Document, 'after_update')
+def _reindex_document(mapper, connection, target):
+    state = db.inspect(target)
+    changed = any(state.attrs[name].history.has_changes() for name in SEARCH_INDEX_COLUMNS)
+    if changed and search_index_available(connection):
+        write_search_index(connection, target.id, search_index_fields(connection, target))
+
+
+@event.listens_for(Document, 'after_delete')
+def _unindex_document(mapper, connection, target):
+    # Postgres keeps the vector on the row itself
+    if connection.dialect.name == 'sqlite' and search_index_available(connection):
+        connection.execute(db.text("DELETE FROM document_fts WHERE rowid = :id"), {'id': target.id})
+
+
+# ============================================================================
+# Typo Tolerance (trigram vocabulary)
+# ============================================================================
+
+SEARCH_FUZZY_BATCH = 500  # Words per vocabulary lookup / insert
+
+
+def fuzzy_index_available(connection):
+    return database_has_table(connection, 'search_term')
+
+
+def word_trigrams(word):
+    """Trigrams of one word, padded the way pg_trgm pads them so both backends score alike."""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def vocabulary_words(text):
+    """Distinct words of `text` worth suggesting as corrections (letters only, no stop words)."""
+    return {word for word in SEARCH_VOCABULARY_RE.findall(text.lower()) if word not in KEYWORD_STOP_WORDS}
+
+
+def known_search_terms(connection, words):
+    """The subset of `words` already in the vocabulary."""
+    statement = db.text("SELECT term FROM search_term WHERE term IN :terms").bindparams(
+        db.bindparam('terms', expanding=True))
+    return set(connection.execute(statement, {'terms': list(words)}).scalars())
+
+
+def add_search_terms(connection, text):
+    """
+    Add the new words of `text` (and, on SQLite, their trigrams) to the vocabulary. It only
+    grows and is shared by all users: readable_corrections() drops words the searcher can't find.
+    """
+    words = sorted(vocabulary_words(text))
+    for start in range(0, len(words), SEARCH_FUZZY_BATCH):
+        chunk = words[start:start + SEARCH_FUZZY_BATCH]
+        known = known_search_terms(connection, chunk)
+        new_words = [word for word in chunk if word not in known]
+        if not new_words:
+            continue
+        if connection.dialect.name == 'postgresql':
+            connection.execute(db.text("INSERT INTO search_term (term) VALUES (:term) ON CONFLICT DO NOTHING"),
+                               [{'term': word} for word in new_words])
+            continue
+        grams = {word: word_trigrams(word) for word in new_words}
+        connection.execute(db.text("INSERT OR IGNORE INTO search_term (term, trigram_count) VALUES (:term, :count)"),
+                           [{'term': word, 'count': len(grams[word])} for word in new_words])
+        ids = connection.execute(
+            db.text("SELECT id, term FROM search_term WHERE term IN :terms").bindparams(
+                db.bindparam('terms', expanding=True)),
+            {'terms': new_words}
+        ).all()
+        connection.execute(db.text("INSERT OR IGNORE INTO search_trigram (trigram, term_id) VALUES (:trigram, :id)"),
+                           [{'trigram': gram, 'id': term_id} for term_id, term in ids for gram in grams[term]])
+
+
+def similar_terms(connection, word, threshold, limit):
+    """Up to `limit` vocabulary words at least `threshold` similar to `word`, most similar first."""
+    if connection.dialect.name == 'postgresql':
+        # % is answered from the GIN index using the session threshold; similarity() then orders the few hits
+        connection.execute(db.text("SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+                           {'threshold': str(threshold)})
+        return list(connection.execute(db.text(
+            "SELECT term FROM search_term WHERE term % :word "
+            "ORDER BY similarity(term, :word) DESC, term LIMIT :limit"
+        ), {'word': word, 'limit': limit}).scalars())
+    
+    grams = word_trigrams(word)
+    # similarity = shared / (|A| + |B| - shared) can only reach the threshold if |B| lies within
+    # [t|A|, |A|/t] and at least t|A| trigrams are shared, which bounds the candidate set
+    rows = connection.execute(db.text(
+        "SELECT t.term, t.trigram_count, COUNT(*) AS shared FROM search_trigram g "
+        "JOIN search_term t ON t.id = g.term_id "
+        "WHERE g.trigram IN :grams AND t.trigram_count BETWEEN :shortest AND :longest "
+        "GROUP BY t.id HAVING COUNT(*) >= :min_shared"
+    ).bindparams(db.bindparam('grams', expanding=True)), {
+        'grams': sorted(grams),
+        'shortest': math.ceil(threshold * len(grams)),
+        'longest': math.floor(len(grams) / threshold),
+        'min_shared': math.ceil(threshold * len(grams)),
+    }).all()
+    scored = [(shared / (len(grams) + count - shared), term) for term, count, shared in rows]
+    scored = [(score, term) for score, term in scored if score >= threshold]
+    return [term for score, term in sorted(scored, key=lambda item: (-item[0], item[1]))[:limit]]
+
+
+def similar_search_terms(query):
+    """
+    {query word: [similar indexed words]} for the query words that aren't in the vocabulary
+    (likely typos), to be searched as alternatives. Words under 4 letters are left alone:
+    too few trigrams to tell a typo from a different word.
+    """
+    connection = db.session.connection()
+    if not search_index_available(connection) or not fuzzy_index_available(connection):
+        return {}
+    words = [word for word in dict.fromkeys(SEARCH_TERM_RE.findall(query.lower())[:16])
+             if len(word) >= 4 and SEARCH_VOCABULARY_RE.fullmatch(word)]
+    if not words:
+        return {}
+    known = known_search_terms(connection, words)
+    threshold = min(max(app.config['SEARCH_FUZZY_THRESHOLD'], 0.05), 1.0)
+    alternatives = {}
+    for word in words:
+        if word not in known:
+            similar = similar_terms(connection, word, threshold, app.config['SEARCH_FUZZY_EXPANSIONS'])
+            if similar:
+                alternatives[word] = similar
+    return alternatives
+
+
+# ============================================================================
+# Search Engine (ranking, snippets, pagination)
+# ============================================================================
+
+# BM25 weight of each index column: a hit in the filename counts most, then tags, then summary, then body
+SEARCH_FIELD_WEIGHTS = {'filename': 10.0, 'subject': 5.0, 'tags': 5.0, 'summary': 2.5, 'body': 1.0}
+SEARCH_SNIPPET_TOKENS = 24
+# Private-use characters mark hits in raw snippets, so the text can be escaped before <mark> goes in
+SEARCH_HIT_OPEN, SEARCH_HIT_CLOSE = '\ue000', '\ue001'
+
+
+def search_match_query(query, alternatives=None):
+    """
+    User input as an index query: every word must match, the last one as a prefix (search as you type).
+    alternatives maps a word to similar indexed words that may match in its place (typo tolerance).
+    """
+    terms = SEARCH_TERM_RE.findall(query.lower())[:16]
+    if not terms:
+        return None
+    alternatives = alternatives or {}
+    postgres = db.engine.dialect.name == 'postgresql'
+    groups = []
+    for i, term in enumerate(terms):
+        last = i == len(terms) - 1
+        if postgres:
+            options = [term + (':*' if last else '')] + alternatives.get(term, [])
+            groups.append(options[0] if len(options) == 1 else '(' + ' | '.join(options) + ')')
+        else:
+            options = [f'"{term}"' + ('*' if last else '')] + [f'"{alt}"' for alt in alternatives.get(term, [])]
+            groups.append(options[0] if len(options) == 1 else '(' + ' OR '.join(options) + ')')
+    return (' & ' if postgres else ' AND ').join(groups)  # FTS5 only allows the implicit AND between phrases
+
+
+def search_rank_sql():
+    """SELECT of (id, rank) for documents matching :match, lower rank = more relevant, with field weights applied."""
+    w = SEARCH_FIELD_WEIGHTS
+    if db.engine.dialect.name == 'postgresql':
+        # ts_rank_cd takes {D, C, B, A} weights in [0, 1]; write_search_index puts filename in A ... body in D
+        top = max(w.values())
+        weights = ', '.join(f"{w[field] / top:.3f}" for field in ('body', 'summary', 'tags', 'filename'))
+        return (f"SELECT id, -ts_rank_cd('{{{weights}}}', search_vector, to_tsquery('english', :match)) AS rank "
+                "FROM document WHERE search_vector @@ to_tsquery('english', :match)")
+    weights = ', '.join(str(w[field]) for field in ('filename', 'subject', 'tags', 'summary', 'body'))
+    return (f"SELECT rowid AS id, bm25(document_fts, {weights}) AS rank "
+            "FROM document_fts WHERE document_fts MATCH :match")
+
+
+def document_search_query(query, user_id, alternatives=None, filters=None):
+    """
+    Query for the documents user_id can read (owned, or shared directly or through a collection)
+    matching `query`, most relevant first, using the full-text index (LIKE scan ordered by date
+    when the index hasn't been created). See search_match_query for alternatives and
+    filter_documents for the facet filters.
+    """
+    connection = db.session.connection()
+    if document_access_available(connection):
+        q = Document.query.filter(Document.id.in_(accessible_document_ids(user_id)))
+    else:
+        q = Document.query.filter(Document.user_id == user_id)
+    q = filter_documents(q, filters)
+    match = search_match_query(query, alternatives)
+    
+    if not search_index_available(connection):
+        pattern = f"%{query}%"
+        return q.filter(db.or_(*[column.ilike(pattern) for column in (
+            Document.extracted_text, Document.summary, Document.original_filename,
+            Document.subject, Document.tags, Document.ai_tags
+        )])).order_by(Document.upload_date.desc())
+    
+    if match is None:
+        return q.filter(db.false())
+    matches = db.text(search_rank_sql()).bindparams(match=match)\
+        .columns(id=db.Integer, rank=db.Float).subquery('matches')
+    return q.join(matches, matches.c.id == Document.id).order_by(matches.c.rank, Document.upload_date.desc())
+
+
+def render_search_snippet(raw):
+    """Escape a raw snippet and turn its hit markers into <mark> tags."""
+    html = str(escape(raw)).replace(SEARCH_HIT_OPEN, '<mark>').replace(SEARCH_HIT_CLOSE, '</mark>')
+    return Markup(html)
+
+
+def highlight_summary(query, summary, width=200, alternatives=None):
+    """Snippet cut from the summary around the first query term, for databases without FTS5 snippets."""
+    terms = SEARCH_TERM_RE.findall(query.lower())[:16]
+    terms += [alt for term in terms for alt in (alternatives or {}).get(term, [])]
+    if not summary or not terms:
+        return None
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(term) for term in terms) + r')\w*', re.IGNORECASE)
+    hit = pattern.search(summary)
+    start = max(0, hit.start() - width // 3) if hit else 0
+    window = summary[start:start + width]
+    raw = pattern.sub(lambda m: SEARCH_HIT_OPEN + m.group(0) + SEARCH_HIT_CLOSE, window)
+    return render_search_snippet(('…' if start else '') + raw + ('…' if start + width < len(summary) else ''))
+
+
+def index_snippets_available(connection):
+    """True when snippets can come from the index itself (SQLite FTS5); otherwise they are cut from the summary."""
+    return connection.dialect.name == 'sqlite' and search_index_available(connection)
+
+
+def search_snippets(query, documents, alternatives=None):
+    """
+    Highlighted snippet per document id for one page of results. On SQLite they come from FTS5's
+    snippet(), which locates hits from the positions stored in the index, so document text is
+    never re-read or re-scanned; other databases highlight the (already loaded) summary.
+    """
+    match = search_match_query(query, alternatives)
+    if not documents or match is None:
+        return {}
+    
+    connection = db.session.connection()
+    if not index_snippets_available(connection):
+        snippets = {doc.id: highlight_summary(query, doc.summary, alternatives=alternatives) for doc in documents}
+        return {doc_id: snippet for doc_id, snippet in snippets.items() if snippet}
+    
+    rows = connection.execute(
+        db.text(
+            "SELECT rowid AS id, snippet(document_fts, -1, :open, :close, '…', :tokens) AS snippet "
+            "FROM document_fts WHERE document_fts MATCH :match AND rowid IN :ids"
+        ).bindparams(db.bindparam('ids', expanding=True)),
+        {'open': SEARCH_HIT_OPEN, 'close': SEARCH_HIT_CLOSE, 'tokens': SEARCH_SNIPPET_TOKENS,
+         'match': match, 'ids': [doc.id for doc in documents]}
+    )
+    return {row.id: render_search_snippet(row.snippet) for row in rows if row.snippet}
+
+
+def search_documents_fulltext(query, user_id, limit=None, with_summary=False):
+    """Search documents through the full-text index, most relevant first.
+
+    The deferred text columns are never fetched; pass with_summary=True when
+    the caller renders the summary.
+    """
+    if limit is None:
+        limit = app.config['SEARCH_RESULTS_LIMIT']
+    
+    q = document_search_query(query, user_id)
+    if with_summary:
+        q = q.options(db.undefer(Document.summary))
+    return q.limit(limit).all()
+
+
+# ============================================================================
+# Recommendations (persisted TF-IDF model)
+# ============================================================================
+
+RECOMMENDATION_MIN_SIMILARITY = 0.1
+
+
+def recommendation_model_available(connection):
+    return database_has_table(connection, RecommendationModel.__tablename__)
+
+
+class TfidfWeights:
+    """A fitted vocabulary and IDF: transforms text exactly like the TfidfVectorizer they came from, without refitting."""
+    
+    def __init__(self, vocabulary, idf):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.counter = CountVectorizer(vocabulary={term: i for i, term in enumerate(vocabulary)}, stop_words='english')
+    
+    @classmethod
+    def fit(cls, texts):
+        """(TfidfWeights, document matrix) for texts."""
+        vectorizer = TfidfVectorizer(max_features=app.config['RECOMMENDATIONS_MAX_FEATURES'], stop_words='english')
+        matrix = vectorizer.fit_transform(texts).astype(np.float32)
+        weights = cls(vectorizer.get_feature_names_out().tolist(), vectorizer.idf_.astype(np.float32))
+        return weights, matrix
+    
+    @classmethod
+    def from_model(cls, model):
+        return cls(json.loads(model.vocabulary), np.frombuffer(model.idf, dtype=np.float32))
+    
+    def transform(self, texts):
+        counts = self.counter.transform(texts).astype(np.float32)
+        return normalize(sparse.csr_matrix(counts.multiply(self.idf)))
+
+
+def encode_sparse_row(matrix, row):
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    return matrix.indices[start:end].astype('<i4').tobytes() + matrix.data[start:end].astype('<f4').tobytes()
+
+
+def decode_sparse_rows(values, n_features):
+    """CSR matrix from rows written by encode_sparse_row."""
+    sizes = [len(value) // 8 for value in values]
+    indptr = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    indices = [np.frombuffer(value, dtype='<i4', count=n) for value, n in zip(values, sizes)]
+    data = [np.frombuffer(value, dtype='<f4', count=n, offset=4 * n) for value, n in zip(values, sizes)]
+    return sparse.csr_matrix((np.concatenate(data or [np.zeros(0, np.float32)]),
+                              np.concatenate(indices or [np.zeros(0, np.int32)]), indptr),
+                             shape=(len(values), n_features))
+
+
+def recommendation_texts(user_id, exclude_version=None):
+    """(id, extracted_text) of the user's analyzed documents, optionally only those without a vector of a version."""
+    statement = db.select(Document.id, Document.extracted_text)\
+        .where(Document.user_id == user_id, Document.last_analyzed.isnot(None),
+               Document.extracted_text.isnot(None))
+    if exclude_version is not None:
+        statement = statement.where(Document.id.not_in(db.select(RecommendationVector.document_id).where(
+            RecommendationVector.user_id == user_id, RecommendationVector.version == exclude_version)))
+    return db.session.execute(statement.order_by(Document.id)).all()
+
+
+def store_recommendation_vectors(user_id, version, ids, matrix):
+    vectors = RecommendationVector.__table__
+    db.session.execute(vectors.delete().where(vectors.c.document_id.in_(ids)))
+    db.session.execute(vectors.insert(), [
+        {'document_id': doc_id, 'user_id': user_id, 'version': version, 'data': encode_sparse_row(matrix, row)}
+        for row, doc_id in enumerate(ids)
+    ])
+
+
+def fit_recommendation_model(user_id, model=None):
+    """Fit on all of the user's analyzed documents and store the model and every vector: O(library), run on drift only."""
+    rows = recommendation_texts(user_id)
+    weights, matrix = TfidfWeights.fit([text for _, text in rows])
+    if model is None:
+        model = RecommendationModel(user_id=user_id, version=0)
+        db.session.add(model)
+    model.version += 1
+    model.vocabulary = json.dumps(weights.vocabulary)
+    model.idf = weights.idf.tobytes()
+    model.fitted_documents = len(rows)
+    model.changed_documents = 0
+    model.fitted_at = datetime.utcnow()
+    vectors = RecommendationVector.__table__
+    db.session.execute(vectors.delete().where(vectors.c.user_id == user_id))
+    store_recommendation_vectors(user_id, model.version, [doc_id for doc_id, _ in rows], matrix)
+    db.session.commit()
+    return model
+
+
+def update_recommendation_model(user_id, model):
+    """
+    Refit the user's model, or store vectors for their documents that lack one, and return it.
+    The model row is locked first (PostgreSQL), so concurrent requests for one user take turns
+    and the later one finds the earlier one's work done.
+    """
+    if model is not None:
+        model = db.session.get(RecommendationModel, user_id, with_for_update=True, populate_existing=True)
+    pending = recommendation_texts(user_id, exclude_version=model.version) if model is not None else None
+    if model is None or recommendation_model_stale(model, len(pending)):
+        model = fit_recommendation_model(user_id, model)
+    elif pending:
+        ids = [doc_id for doc_id, _ in pending]
+        store_recommendation_vectors(user_id, model.version, ids,
+                                     TfidfWeights.from_model(model).transform([text for _, text in pending]))
+        model.changed_documents += len(ids)
+        db.session.commit()
+    return model
+
+
+def recommendation_model_stale(model, pending):
+    """True if the model should be refitted rather than used for `pending` more documents."""
+    drift = model.changed_documents + pending > app.config['RECOMMENDATIONS_REFIT_DRIFT'] * max(model.fitted_documents, 1)
+    age = datetime.utcnow() - model.fitted_at > timedelta(days=app.config['RECOMMENDATIONS_REFIT_DAYS'])
+    return drift or age
+
+
+# user_id -> (model version, search_generation, sorted document ids, CSR matrix), least recently used first
+recommendation_cache = OrderedDict()
+recommendation_cache_lock = threading.Lock()
+
+
+def get_recommendation_matrix(user_id):
+    """
+    (sorted document ids, L2-normalized TF-IDF matrix) of the user's analyzed documents.
+    Served from memory until the user's documents change (search_generation); then documents
+    without a current vector are transformed with the stored model and saved, or the model is
+    refitted if too many have changed since the fit.
+    """
+    if not recommendation_model_available(db.session.connection()):
+        rows = recommendation_texts(user_id)  # Tables not migrated yet: fit in memory, as before
+        return np.array([doc_id for doc_id, _ in rows], dtype=np.int64), TfidfWeights.fit([text for _, text in rows])[1]
+    
+    user = db.session.get(User, user_id)
+    generation = user.search_generation if user else 0
+    model = db.session.get(RecommendationModel, user_id)
+    with recommendation_cache_lock:
+        entry = recommendation_cache.get(user_id)
+        if model is not None and entry and entry[:2] == (model.version, generation):
+            recommendation_cache.move_to_end(user_id)
+            return entry[2], entry[3]
+    
+    try:
+        model = update_recommendation_model(user_id, model)
+    except IntegrityError:
+        # Another worker stored this user's first model (or the same vectors) at the same moment: build on it
+        db.session.rollback()
+        model = update_recommendation_model(user_id, db.session.get(RecommendationModel, user_id))
+    
+    # Vectors of deleted or no longer analyzed documents are left out by the join
+    rows = db.session.execute(
+        db.select(RecommendationVector.document_id, RecommendationVector.data)
+        .join(Document, Document.id == RecommendationVector.document_id)
+        .where(RecommendationVector.user_id == user_id, RecommendationVector.version == model.version,
+               Document.user_id == user_id, Document.last_analyzed.isnot(None))
+        .order_by(RecommendationVector.document_id)
+    ).all()
+    ids = np.array([doc_id for doc_id, _ in rows], dtype=np.int64)
+    matrix = decode_sparse_rows([data for _, data in rows], len(json.loads(model.vocabulary)))
+    with recommendation_cache_lock:
+        recommendation_cache[user_id] = (model.version, generation, ids, matrix)
+        recommendation_cache.move_to_end(user_id)
+        while len(recommendation_cache) > app.config['RECOMMENDATIONS_CACHE_USERS']:
+            recommendation_cache.popitem(last=False)
+    return ids, matrix
+
+
+@event.listens_for(SessionBase, 'before_flush')
+def _drop_stale_recommendation_vectors(session, flush_context, instances):
+    """Re-analyzed, re-owned or deleted documents lose their vector; the next request transforms them again."""
+    stale = [obj.id for obj in session.deleted if isinstance(obj, Document)]
+    stale += [obj.id for obj in session.dirty if isinstance(obj, Document) and any(
+        db.inspect(obj).attrs[name].history.has_changes() for name in ('extracted_text', 'user_id')
+    )]
+    if not stale:
+        return
+    connection = session.connection()
+    if recommendation_model_available(connection):
+        vectors = RecommendationVector.__table__
+        connection.execute(vectors.delete().where(vectors.c.document_id.in_(stale)))
+
+
+def get_document_recommendations(document_id, count=None):
+    """Get recommended documents based on content similarity (TF-IDF cosine, from the owner's stored vectors)."""
+    if count is None:
+        count = app.config['RECOMMENDATIONS_COUNT']
+    
+    document = db.session.get(Document, document_id)
+    if not document:
+        return []
+    
+    try:
+        ids, matrix = get_recommendation_matrix(document.user_id)
+        position = np.searchsorted(ids, document_id)
+        if position >= len(ids) or ids[position] != document_id:
+            return []  # Not analyzed
+        
+        # Cosine similarity: the rows are already unit length
+        similarities = (matrix @ matrix[position].T).toarray().ravel()
+        similarities[position] = -1
+        top = [i for i in np.argsort(-similarities, kind='stable')[:count]
+               if similarities[i] > RECOMMENDATION_MIN_SIMILARITY]
+        
+        # Only the recommended documents are loaded (summary is returned to the client)
+        found = {doc.id: doc for doc in Document.query.options(db.undefer(Document.summary))
+                 .filter(Document.id.in_(ids[top].tolist()))}
+        return [found[doc_id] for doc_id in ids[top].tolist() if doc_id in found]
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error getting recommendations: {e}")
+        return []
+
+
+# ============================================================================
+# Search Result Cache
+# ============================================================================
+
+# Document columns that can change which documents match a query or their order
+SEARCH_RESULT_COLUMNS = SEARCH_INDEX_COLUMNS + ('user_id', 'upload_date')
+# (user_id, normalized query) -> SearchCacheEntry, least recently used first
+search_result_cache = OrderedDict()
+search_result_cache_lock = threading.Lock()
+
+
+class SearchCacheEntry:
+    """
+    Ranked ids of one search (up to SEARCH_CACHE_MAX_IDS), its total and the typo corrections it used.
+    facets is filled in by search_facets the first time a page shows them.
+    """
+    __slots__ = ('generation', 'expires', 'ids', 'total', 'corrections', 'facets')
+    
+    def __init__(self, generation, ids, total, corrections):
+        self.generation = generation
+        self.expires = time.monotonic() + app.config['SEARCH_CACHE_TTL_SECONDS']
+        self.ids = ids
+        self.total = total
+        self.corrections = corrections
+        self.facets = None
+    
+    def covers(self, page, per_page):
+        """True if the page can be sliced from the cached ids."""
+        return page * per_page <= len(self.ids) or len(self.ids) == self.total
+
+
+class SearchPagination(Pagination):
+    """A page sliced from a cached list of ranked ids; only that page's documents are loaded."""
+    
+    def _query_items(self):
+        ids = self._query_args['ids'][self._query_offset:self._query_offset + self.per_page]
+        if not ids:
+            return []
+        found = {doc.id: doc for doc in self._query_args['query'].filter(Document.id.in_(ids))}
+        return [found[doc_id] for doc_id in ids if doc_id in found]
+    
+    def _query_count(self):
+        return self._query_args['total']
+
+
+def readable_corrections(alternatives, user_id, filters=None):
+    """
+    The similar words of `alternatives` that match a document user_id can read. The vocabulary is
+    shared by every user, so a word found only in someone else's private documents is never shown.
+    """
+    kept = {}
+    for word, similar in alternatives.items():
+        similar = [term for term in similar if document_search_query(term, user_id, filters=filters)
+                   .with_entities(Document.id).order_by(None).limit(1).first()]
+        if similar:
+            kept[word] = similar
+    return kept
+
+
+def rank_search_results(query, user_id, filters=None, mode=None):
+    """
+    Run a search for ids only: (ranked ids up to SEARCH_CACHE_MAX_IDS, total, typo corrections).
+    mode='semantic' ranks by vector similarity instead (keyword ranking if no model has been fitted).
+    """
+    limit = max(app.config['SEARCH_CACHE_MAX_IDS'], 1)
+    if mode == 'semantic':
+        ids = semantic_search_ids(query, user_id, filters, limit)
+        if ids is not None:
+            return ids, len(ids), {}
+    
+    def ranked(alternatives=None):
+        q = document_search_query(query, user_id, alternatives, filters).with_entities(Document.id)
+        ids = [row.id for row in q.limit(limit + 1)]
+        total = len(ids) if len(ids) <= limit else q.order_by(None).count()
+        return ids[:limit], total
+    
+    ids, total = ranked()
+    alternatives = {}
+    if total < app.config['SEARCH_FUZZY_MIN_RESULTS']:
+        alternatives = readable_corrections(similar_search_terms(query), user_id, filters)
+        if alternatives:
+            ids, total = ranked(alternatives)
+    return ids, total, alternatives
+
+
+def cached_search_results(query, user_id, filters=None, mode=None):
+    """SearchCacheEntry for the query, from the cache when it is fresh for the user's current generation."""
+    user = db.session.get(User, user_id)  # Normally current_user, already in the session
+    generation = user.search_generation if user else 0
+    key = (user_id, ' '.join(query.lower().split()), tuple(sorted((filters or {}).items())), mode)
+    now = time.monotonic()
+    with search_result_cache_lock:
+        entry = search_result_cache.get(key)
+        if entry and entry.generation == generation and entry.expires > now:
+            search_result_cache.move_to_end(key)
+            return entry
+    
+    entry = SearchCacheEntry(generation, *rank_search_results(query, user_id, filters, mode))
+    if app.config['SEARCH_CACHE_MAX_ENTRIES'] > 0:
+        with search_result_cache_lock:
+            search_result_cache[key] = entry
+            search_result_cache.move_to_end(key)
+            while len(search_result_cache) > app.config['SEARCH_CACHE_MAX_ENTRIES']:
+                search_result_cache.popitem(last=False)
+    return entry
+
+
+def search_readers(connection, document_ids):
+    """Ids of the users who can read any of the given documents, from the access index."""
+    if not document_ids or not document_access_available(connection):
+        return set()
+    return set(connection.execute(
+        db.select(DocumentAccess.user_id).where(DocumentAccess.document_id.in_(document_ids))
+    ).scalars())
+
+
+@event.listens_for(SessionBase, 'before_flush')
+def _bump_search_generations(session, flush_context, instances):
+    """Invalidate the cached searches of every user whose readable documents this flush changes."""
+    users = set()
+    documents = set()
+    for obj in session.new:
+        if isinstance(obj, Document):
+            users.add(obj.user_id)
+        elif isinstance(obj, SharePermission):
+            users.add(obj.shared_with_id)
+    for obj in session.dirty:
+        state = db.inspect(obj)
+        if isinstance(obj, Document):
+            if any(state.attrs[name].history.has_changes() for name in SEARCH_RESULT_COLUMNS):
+                documents.add(obj.id)
+                users.update(state.attrs.user_id.history.sum())
+        elif isinstance(obj, SharePermission) and any(
+            state.attrs[name].history.has_changes() for name in ('shared_with_id', 'document_id', 'collection_id')
+        ):
+            users.update(state.attrs.shared_with_id.history.sum())
+    for obj in session.deleted:
+        if isinstance(obj, Document):
+            documents.add(obj.id)
+            users.add(obj.user_id)
+        elif isinstance(obj, SharePermission):
+            users.add(obj.shared_with_id)
+    
+    collections = {collection.id for collection, document, added in session.info.get('collection_membership', [])}
+    collections.discard(None)
+    if not (users or documents or collections):
+        return
+    connection = session.connection()
+    if collections:
+        users.update(connection.execute(
+            db.select(SharePermission.shared_with_id).where(SharePermission.collection_id.in_(collections))
+        ).scalars())
+    users.update(search_readers(connection, documents))
+    users.discard(None)
+    if users:
+        user_table = User.__table__
+        connection.execute(user_table.update().where(user_table.c.id.in_(users))
+                           .values(search_generation=user_table.c.search_generation + 1))
+
+
+def search_documents_page(query, user_id, page=1, per_page=10, with_summary=False, filters=None, mode=None):
+    """
+    One page of ranked results for `query` (narrowed by facet `filters`, ranked by meaning if
+    mode='semantic') plus the snippets for just that page.
+    Returns (pagination, {document id: snippet Markup}, {misspelled word: [words also searched]}).
+    Pages are sliced from the cached ranked ids (see cached_search_results). Typo tolerance only
+    kicks in when exact matching finds fewer than SEARCH_FUZZY_MIN_RESULTS.
+    The summary column stays deferred unless with_summary is set or the snippets have to be cut from it.
+    """
+    results = cached_search_results(query, user_id, filters, mode)
+    page = max(page, 1)
+    
+    # Batch-load tags for the whole page instead of one query per card
+    options = [db.selectinload(Document.tag_objects)]
+    if with_summary or not index_snippets_available(db.session.connection()):
+        options.append(db.undefer(Document.summary))
+    if results.covers(page, per_page):
+        pagination = SearchPagination(page=page, per_page=per_page, error_out=False, ids=results.ids,
+                                      total=results.total, query=Document.query.options(*options))
+    else:
+        q = document_search_query(query, user_id, results.corrections, filters).options(*options)
+        pagination = q.paginate(page=page, per_page=per_page, error_out=False)
+    return pagination, search_snippets(query, pagination.items, results.corrections), results.corrections
+
+
+# ============================================================================
+# Search Facets
+# ============================================================================
+
+SEARCH_FACETS = ('year', 'subject', 'mimetype', 'tag')
+
+
+def search_filters(args):
+    """Facet filters picked in the UI (?year=&subject=&mimetype=&tag=<slug>), empty ones dropped."""
+    filters = {}
+    year = args.get('year', type=int)
+    if year is not None:
+        filters['year'] = year
+    for name in ('subject', 'mimetype', 'tag'):
+        value = (args.get(name) or '').strip()
+        if value:
+            filters[name] = value
+    return filters
+
+
+def filter_documents(q, filters):
+    """Narrow a Document query by facet filters: exact matches on indexed columns, never LIKE."""
+    if not filters:
+        return q
+    if 'year' in filters:
+        q = q.filter(Document.year == filters['year'])
+    if 'subject' in filters:
+        q = q.filter(Document.subject == filters['subject'])
+    if 'mimetype' in filters:
+        q = q.filter(Document.mimetype == filters['mimetype'])
+    if 'tag' in filters:
+        tagged = db.select(document_tags.c.document_id).join(Tag, Tag.id == document_tags.c.tag_id)\
+            .where(Tag.slug == filters['tag'])
+        q = q.filter(Document.id.in_(tagged))
+    return q
+
+
+def document_facets(document_ids):
+    """
+    Document counts by year, subject, mimetype and tag for the documents a query of Document.id
+    selects, in one grouped query: each document contributes one row for its year, subject and
+    mimetype and one row per tag, so a single GROUP BY counts every facet at once.
+    Returns {facet: [{'value', 'label', 'count'}, ...]}, years in order, the rest most common first.
+    """
+    matched = db.select(document_ids.order_by(None).cte('matched').c.id)
+    document = Document.__table__
+    rows = db.union_all(
+        db.select(document.c.year, document.c.subject, document.c.mimetype, db.null().label('tag_id'))
+        .where(document.c.id.in_(matched)),
+        db.select(db.null(), db.null(), db.null(), document_tags.c.tag_id)
+        .where(document_tags.c.document_id.in_(matched))
+    ).subquery('facet_rows')
+    grouped = db.select(rows.c.year, rows.c.subject, rows.c.mimetype, rows.c.tag_id, db.func.count().label('n'))\
+        .group_by(rows.c.year, rows.c.subject, rows.c.mimetype, rows.c.tag_id).subquery('facet_counts')
+    statement = db.select(grouped.c.year, grouped.c.subject, grouped.c.mimetype, Tag.slug, Tag.name, grouped.c.n)\
+        .outerjoin(Tag, Tag.id == grouped.c.tag_id)
+    
+    counts = {name: Counter() for name in SEARCH_FACETS}
+    labels = {name: {} for name in SEARCH_FACETS}
+    for year, subject, mimetype, tag_slug, tag_name, n in db.session.execute(statement):
+        if year is not None:
+            counts['year'][year] += n
+            counts['subject'][subject] += n
+            counts['mimetype'][mimetype or ''] += n
+        elif tag_slug is not None:
+            counts['tag'][tag_slug] += n
+            labels['tag'][tag_slug] = tag_name
+    
+    facets = {}
+    for name in SEARCH_FACETS:
+        values = counts[name].items()
+        order = (lambda item: item[0]) if name == 'year' else (lambda item: (-item[1], str(item[0])))
+        facets[name] = [{'value': value, 'label': labels[name].get(value, value), 'count': n}
+                        for value, n in sorted(values, key=order) if value != '']
+    return facets
+
+
+def search_facets(query, user_id, filters=None, mode=None):
+    """Facet counts over every result of a search (not just one page), cached with its ranked ids."""
+    results = cached_search_results(query, user_id, filters, mode)
+    if results.facets is None:
+        if mode == 'semantic' and len(results.ids) == results.total:
+            q = Document.query.filter(Document.id.in_(results.ids)).with_entities(Document.id)
+        else:
+            q = document_search_query(query, user_id, results.corrections, filters).with_entities(Document.id)
+        results.facets = document_facets(q)
+    return results.facets
+
+
+# ============================================================================
+# Semantic Search (local vectors)
+# ============================================================================
+
+SEMANTIC_MODEL_ID_BYTES = 8  # Stored vectors start with the id of the model that produced them
+
+
+def semantic_vectorizer():
+    """Stateless term hashing: no vocabulary to store, any text maps into the same feature space."""
+    return HashingVectorizer(n_features=app.config['SEMANTIC_HASH_FEATURES'], alternate_sign=False,
+                             stop_words='english', norm=None, dtype=np.float32)
+
+
+def semantic_text(fields):
+    """Text a document is embedded from: the same fields (and body length) as the full-text index."""
+    body = fields['extracted_text'][:app.config['SEARCH_INDEX_BODY_CHARS']]
+    return ' '.join(filter(None, (fields['original_filename'], fields['subject'], fields['tags'],
+                                  fields['ai_tags'], fields['key_terms'], fields['summary'], body)))
+
+
+class SemanticModel:
+    """
+    Hashed TF-IDF projected onto the top singular vectors of the library (latent semantic analysis):
+    text -> unit-length float32 vector, so documents about the same topic score high even without
+    shared words. Stored vectors carry the model id; ones from another model are ignored.
+    """
+    
+    def __init__(self, idf, components, model_id):
+        self.idf = idf  # (features,) float32
+        self.components = components  # (dimensions, features) float32
+        self.model_id = model_id
+        self.vectorizer = semantic_vectorizer()
+    
+    @property
+    def dimensions(self):
+        return self.components.shape[0]
+    
+    @classmethod
+    def fit(cls, texts, dimensions=None):
+        """Fit IDF weights and the SVD projection on a sample of document texts."""
+        counts = semantic_vectorizer().transform(texts)
+        tfidf = TfidfTransformer(sublinear_tf=True).fit(counts)
+        weighted = tfidf.transform(counts)
+        dimensions = min(dimensions or app.config['SEMANTIC_DIMENSIONS'], weighted.shape[0] - 1)
+        if dimensions < 1:
+            raise ValueError('Need at least two documents with text to fit a semantic model')
+        svd = TruncatedSVD(n_components=dimensions, random_state=0).fit(weighted)
+        idf = tfidf.idf_.astype(np.float32)
+        components = svd.components_.astype(np.float32)
+        model_id = hashlib.sha1(idf.tobytes() + components.tobytes()).digest()[:SEMANTIC_MODEL_ID_BYTES]
+        return cls(idf, components, model_id)
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['idf'], data['components'], data['model_id'].tobytes())
+    
+    def save(self, path):
+        """Write atomically, so workers never load a half-written model."""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(f, idf=self.idf, components=self.components, model_id=np.frombuffer(self.model_id, np.uint8))
+        os.replace(temp_path, path)
+    
+    def embed(self, texts):
+        """(len(texts), dimensions) float32 matrix of unit-length vectors (zero for texts with no known terms)."""
+        counts = self.vectorizer.transform(texts)
+        counts.data = np.log1p(counts.data)  # Sublinear tf, as fitted
+        vectors = np.asarray(counts.multiply(self.idf).tocsr() @ self.components.T, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+    
+    def encode(self, vector):
+        """Column value: model id followed by the raw little-endian float32 values."""
+        return self.model_id + vector.astype('<f4').tobytes()
+    
+    def accepts(self, value):
+        """True if a stored value was produced by this model."""
+        return (isinstance(value, bytes) and value[:SEMANTIC_MODEL_ID_BYTES] == self.model_id
+                and len(value) == SEMANTIC_MODEL_ID_BYTES + 4 * self.dimensions)
+
+
+semantic_model_state = {'key': None, 'model': None, 'fitting': False}
+semantic_model_lock = threading.Lock()
+semantic_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def get_semantic_model():
+    """The fitted model at SEMANTIC_MODEL_PATH (reloaded when the file is replaced), or None."""
+    path = app.config['SEMANTIC_MODEL_PATH']
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with semantic_model_lock:
+        if semantic_model_state['key'] != key:
+            try:
+                semantic_model_state['model'] = SemanticModel.load(path)
+            except Exception as e:
+                print(f"Semantic model could not be loaded: {e}")
+                semantic_model_state['model'] = None
+            semantic_model_state['key'] = key
+        return semantic_model_state['model']
+
+
+def fit_semantic_model(sample=5000, batch_size=200, progress=None):
+    """
+    Fit a model on a random sample of documents with text, write it to SEMANTIC_MODEL_PATH and
+    embed every document with it. Returns (model, documents fitted on, vectors stored);
+    progress(last document id, vectors stored) is called after each batch.
+    """
+    with_text = Document.extracted_text.isnot(None)
+    training = Document.query.options(db.undefer_group('content')).filter(with_text)\
+        .order_by(db.func.random()).limit(sample).all()
+    if len(training) < 2:
+        raise ValueError('Need at least two documents with text to fit the semantic model')
+    connection = db.session.connection()
+    model = SemanticModel.fit([semantic_text(search_index_fields(connection, doc)) for doc in training])
+    model.save(app.config['SEMANTIC_MODEL_PATH'])
+    db.session.expunge_all()
+    
+    last_id = 0
+    embedded = 0
+    while True:
+        batch = Document.query.options(db.undefer_group('content')).filter(Document.id > last_id)\
+            .order_by(Document.id).limit(batch_size).all()
+        if not batch:
+            break
+        connection = db.session.connection()
+        texts = [semantic_text(search_index_fields(connection, doc)) for doc in batch]
+        for doc, vector in zip(batch, model.embed(texts)):
+            doc.content_vector = model.encode(vector) if vector.any() else None
+            embedded += bool(vector.any())
+        # New vectors without a text change: drop the owners' and readers' cached semantic searches and indexes
+        users = {doc.user_id for doc in batch} | search_readers(connection, [doc.id for doc in batch])
+        users.discard(None)
+        db.session.execute(db.update(User).where(User.id.in_(users))
+                           .values(search_generation=User.search_generation + 1))
+        db.session.commit()
+        last_id = batch[-1].id
+        db.session.expunge_all()
+        if progress:
+            progress(last_id, embedded)
+    return model, len(training), embedded
+
+
+def _fit_first_semantic_model():
+    """Background entry point for schedule_semantic_model_fit(); one process fits, guarded by a lock file."""
+    lock_path = f"{app.config['SEMANTIC_MODEL_PATH']}.lock"
+    try:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if time.time() - os.path.getmtime(lock_path) < 3600:
+                return  # Another process is already fitting
+            os.remove(lock_path)  # Left behind by a crashed fit
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.close(fd)
+        try:
+            with app.app_context():
+                if get_semantic_model() is None and \
+                        Document.query.filter(Document.extracted_text.isnot(None)).limit(2).count() == 2:
+                    fit_semantic_model()
+        finally:
+            os.remove(lock_path)
+    except Exception as e:
+        print(f"Semantic model fit error: {e}")
+    finally:
+        with app.app_context():
+            db.session.remove()
+        semantic_model_state['fitting'] = False
+
+
+def schedule_semantic_model_fit():
+    """After an analysis: fit the first semantic model in the background if there is none yet."""
+    if not app.config['SEMANTIC_AUTO_FIT'] or semantic_model_state['fitting'] or get_semantic_model() is not None:
+        return
+    semantic_model_state['fitting'] = True
+    semantic_executor.submit(_fit_first_semantic_model)
+
+
+@event.listens_for(SessionBase, 'before_flush')
+def _embed_documents(session, flush_context, instances):
+    """Keep content_vector in step with the indexed text, like the full-text index."""
+    changed = [obj for obj in session.new if isinstance(obj, Document)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Document) and any(
+        db.inspect(obj).attrs[name].history.has_changes() for name in SEARCH_INDEX_COLUMNS
+    )]
+    if not changed:
+        return
+    model = get_semantic_model()
+    if model is None:
+        return
+    connection = session.connection()
+    texts = [semantic_text(search_index_fields(connection, doc, fetch_unloaded=doc.id is not None)) for doc in changed]
+    for doc, vector in zip(changed, model.embed(texts)):
+        doc.content_vector = model.encode(vector) if vector.any() else None
+
+
+class SemanticIndex:
+    """
+    One user's document vectors as a float32 matrix, scored with a single matrix-vector product.
+    Past SEMANTIC_ANN_MIN_DOCUMENTS an inverted-file index (k-means clusters) limits each query
+    to the documents of the SEMANTIC_ANN_PROBES clusters closest to it. k-means runs in the
+    background (cluster_semantic_index); until it has, queries scan the whole matrix, and an index
+    rebuilt after an edit files its vectors under the previous centroids.
+    """
+    
+    def __init__(self, ids, matrix, centroids=None, fitted_documents=0):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.matrix = matrix
+        self.clusters = None  # (centroids, row order, cluster bounds), replaced as a whole
+        self.fitted_documents = 0  # Library size the centroids were fitted on
+        if centroids is not None and self.clustered_size():
+            self.use_centroids(centroids, fitted_documents)
+    
+    def clustered_size(self):
+        return len(self.ids) >= max(app.config['SEMANTIC_ANN_MIN_DOCUMENTS'], 2)
+    
+    def use_centroids(self, centroids, fitted_documents, labels=None):
+        """Group the rows by cluster; without labels each vector goes to its nearest centroid."""
+        if labels is None:
+            # Nearest by Euclidean distance, as k-means assigns: argmax of x.c - |c|^2 / 2, in chunks
+            offsets = 0.5 * (centroids ** 2).sum(axis=1)
+            labels = np.concatenate([np.argmax(self.matrix[start:start + 8192] @ centroids.T - offsets, axis=1)
+                                     for start in range(0, len(self.ids), 8192)] or [np.empty(0, np.int64)])
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(len(centroids) + 1))
+        self.fitted_documents = fitted_documents
+        self.clusters = (centroids, order, bounds)
+    
+    def needs_clustering(self):
+        """True if the library is large enough for clusters and has none, or has drifted from their fit."""
+        if not self.clustered_size():
+            return False
+        drift = abs(len(self.ids) - self.fitted_documents)
+        return self.clusters is None or drift > app.config['SEMANTIC_ANN_REFIT_DRIFT'] * self.fitted_documents
+    
+    def search(self, vector, limit, min_score):
+        """[(document id, cosine similarity)] best first, at most `limit`, all at least min_score."""
+        clusters = self.clusters
+        if clusters is None:
+            rows = None
+            scores = self.matrix @ vector
+        else:
+            centroids, order, bounds = clusters
+            probes = min(app.config['SEMANTIC_ANN_PROBES'], len(centroids))
+            nearest = np.argpartition(-(centroids @ vector), probes - 1)[:probes]
+            rows = np.concatenate([order[bounds[c]:bounds[c + 1]] for c in nearest])
+            scores = self.matrix[rows] @ vector
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        top = top[scores[top] >= min_score]
+        positions = top if rows is None else rows[top]
+        return list(zip(self.ids[positions].tolist(), scores[top].tolist()))
+
+
+# user_id -> (search_generation, model id, SemanticIndex), least recently used first
+semantic_index_cache = OrderedDict()
+semantic_index_lock = threading.Lock()
+semantic_clustering = set()  # (user_id, model id) with a k-means fit queued or running
+
+
+def load_semantic_index(user_id, model, previous=None):
+    """Vectors of every document user_id can read that were embedded by `model`, under `previous`'s centroids."""
+    connection = db.session.connection()
+    if document_access_available(connection):
+        readable = Document.id.in_(accessible_document_ids(user_id))
+    else:
+        readable = Document.user_id == user_id
+    rows = db.session.execute(
+        db.select(Document.id, Document.content_vector).where(readable, Document.content_vector.isnot(None))
+    ).all()
+    rows = [(doc_id, value) for doc_id, value in rows if model.accepts(value)]
+    offset = SEMANTIC_MODEL_ID_BYTES
+    matrix = np.frombuffer(b''.join(value[offset:] for _, value in rows), dtype='<f4')\
+        .reshape(len(rows), model.dimensions).astype(np.float32)
+    clusters = previous.clusters if previous is not None else None
+    if clusters is None:
+        return SemanticIndex([doc_id for doc_id, _ in rows], matrix)
+    return SemanticIndex([doc_id for doc_id, _ in rows], matrix, clusters[0], previous.fitted_documents)
+
+
+def cluster_semantic_index(user_id, model_id, index):
+    """Background job: fit k-means on an index's vectors and hand the centroids to the user's cached index."""
+    try:
+        kmeans = MiniBatchKMeans(n_clusters=int(math.sqrt(len(index.ids))), random_state=0, n_init=3)
+        labels = kmeans.fit_predict(index.matrix)
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        index.use_centroids(centroids, len(index.ids), labels)
+        with semantic_index_lock:
+            entry = semantic_index_cache.get(user_id)
+            current = entry[2] if entry and entry[1] == model_id else None
+        # Rebuilt after an edit while k-means ran: switch it to the new centroids too
+        if current is not None and current is not index and current.clustered_size():
+            current.use_centroids(centroids, len(index.ids))
+    except Exception as e:
+        print(f"Semantic index clustering error: {e}")
+    finally:
+        with semantic_index_lock:
+            semantic_clustering.discard((user_id, model_id))
+
+
+def get_semantic_index(user_id, model):
+    """
+    The user's cached SemanticIndex, reloaded when their documents (search_generation) or the model
+    change. Queries never wait for k-means: it is queued on semantic_executor when needed.
+    """
+    user = db.session.get(User, user_id)
+    key = (user.search_generation if user else 0, model.model_id)
+    with semantic_index_lock:
+        entry = semantic_index_cache.get(user_id)
+        if entry and entry[:2] == key:
+            semantic_index_cache.move_to_end(user_id)
+            return entry[2]
+    
+    previous = entry[2] if entry and entry[1] == model.model_id else None
+    index = load_semantic_index(user_id, model, previous)
+    with semantic_index_lock:
+        semantic_index_cache[user_id] = key + (index,)
+        semantic_index_cache.move_to_end(user_id)
+        while len(semantic_index_cache) > app.config['SEMANTIC_CACHE_USERS']:
+            semantic_index_cache.popitem(last=False)
+        cluster = index.needs_clustering() and (user_id, model.model_id) not in semantic_clustering
+        if cluster:
+            semantic_clustering.add((user_id, model.model_id))
+    if cluster:
+        semantic_executor.submit(cluster_semantic_index, user_id, model.model_id, index)
+    return index
+
+
+def semantic_search_ids(query, user_id, filters=None, limit=None):
+    """Ids of the documents closest in meaning to `query`, best first, or None without a fitted model."""
+    model = get_semantic_model()
+    if model is None:
+        return None
+    limit = limit or app.config['SEARCH_CACHE_MAX_IDS']
+    vector = model.embed([query])[0]
+    if not vector.any():
+        return []
+    # Filtered searches over-fetch, then keep the hits that pass the facet filters
+    hits = get_semantic_index(user_id, model).search(vector, limit * (4 if filters else 1),
+                                                     app.config['SEMANTIC_MIN_SCORE'])
+    ids = [doc_id for doc_id, _ in hits]
+    if filters and ids:
+        q = filter_documents(Document.query.filter(Document.id.in_(ids)), filters).with_entities(Document.id)
+        kept = {row.id for row in q}
+        ids = [doc_id for doc_id in ids if doc_id in kept]
+    return ids[:limit]
+
+
+# ============================================================================
+# Typeahead Suggestions (in-memory inverted index)
+# ============================================================================
+
+# Every worker maps the same snapshot file read-only, so its arrays live once in the page cache
+# (also across fork). Documents changed since the snapshot was written are read from the
+# search_change log and kept in a small per-worker overlay until the next snapshot.
+SUGGEST_TERM_RE = re.compile(r'[^\W_]+')
+SUGGEST_MAX_TERM_CHARS = 32
+# (column, bit stored with each posting, score of a hit in that field)
+SUGGEST_FIELDS = (('original_filename', 1, 8), ('tags', 2, 4), ('subject', 4, 2), ('summary', 8, 1))
+SUGGEST_FIELD_SCORES = np.array(
+    [sum(score for _, bit, score in SUGGEST_FIELDS if mask & bit) for mask in range(16)], dtype=np.float64
+)
+SUGGEST_LOGGED_ATTRIBUTES = ('user_id', 'original_filename', 'subject', 'tags', 'ai_tags', 'key_terms', 'summary',
+                             'tag_objects')
+SUGGEST_FILE_MAGIC = b'SUGGEST1'
+SUGGEST_HEADER = struct.Struct('<8sQIII4x')  # magic, last change id, documents, terms, postings
+suggest_state = {'index': None, 'checked_at': 0.0, 'rebuilding': False}
+suggest_lock = threading.Lock()
+suggest_executor = ThreadPoolExecutor(max_workers=1)
+search_change_state = {}  # Database URL -> whether the search_change table exists there
+
+
+def suggest_terms(fields):
+    """{term: field bits} for one document's filename, tags, subject and summary."""
+    terms = {}
+    for name, bit, _ in SUGGEST_FIELDS:
+        for term in SUGGEST_TERM_RE.findall((fields.get(name) or '').lower()):
+            if 1 < len(term) <= SUGGEST_MAX_TERM_CHARS and term not in KEYWORD_STOP_WORDS:
+                terms[term] = terms.get(term, 0) | bit
+    return terms
+
+
+def load_suggest_documents(condition, limit=None):
+    """[(id, user_id, filename, {term: bits})] for the documents matching `condition`, in id order."""
+    rows = db.session.execute(
+        db.select(Document.id, Document.user_id, Document.original_filename, Document.subject,
+                  Document.tags, Document.ai_tags, Document.key_terms, Document.summary)
+        .where(condition).order_by(Document.id).limit(limit)
+    ).all()
+    tag_names = {}
+    if rows:
+        for document_id, name in db.session.execute(
+            db.select(document_tags.c.document_id, Tag.name).join(Tag, Tag.id == document_tags.c.tag_id)
+            .where(document_tags.c.document_id.in_([row.id for row in rows]))
+        ):
+            tag_names.setdefault(document_id, []).append(name)
+    
+    documents = []
+    for row in rows:
+        fields = {
+            'original_filename': os.path.splitext(row.original_filename)[0],
+            'tags': ' '.join(filter(None, [row.tags, row.ai_tags, row.key_terms] + tag_names.get(row.id, []))),
+            'subject': row.subject,
+            'summary': row.summary,
+        }
+        documents.append((row.id, row.user_id, row.original_filename, suggest_terms(fields)))
+    return documents
+
+
+def _aligned(data):
+    """Pad a section to 8 bytes so the next array starts aligned."""
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _offsets(lengths):
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))).astype('<u4')
+
+
+def build_suggest_snapshot(path, batch_size=2000):
+    """
+    Write a snapshot of every document's terms to `path` (atomically, so readers never see a partial
+    file) and drop the change-log rows it covers. Returns the number of documents written.
+    """
+    # Read the log position first: changes made while documents are read are applied again later
+    last_change_id = db.session.query(db.func.max(SearchChange.id)).scalar() or 0
+    # Rows inside the commit window stay: a transaction holding a lower id may not be visible yet
+    prune_before = datetime.utcnow() - timedelta(seconds=app.config['SUGGEST_CHANGE_WINDOW_SECONDS'])
+    # Flat uint32 buffers rather than a Python object per posting
+    doc_ids, doc_users, titles = array('I'), array('I'), []
+    term_ids = {}
+    posting_terms, posting_docs, posting_bits = array('I'), array('I'), bytearray()
+    last_id = 0
+    while True:
+        batch = load_suggest_documents(Document.id > last_id, limit=batch_size)
+        if not batch:
+            break
+        for document_id, user_id, title, terms in batch:
+            position = len(doc_ids)
+            doc_ids.append(document_id)
+            doc_users.append(user_id)
+            titles.append(title.encode('utf-8'))
+            for term, bits in terms.items():
+                posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+                posting_docs.append(position)
+                posting_bits.append(bits)
+        last_id = batch[-1][0]
+    
+    # Terms sorted (UTF-8 byte order = code point order) with their postings stored contiguously,
+    # so all terms sharing a prefix are one slice of the posting arrays
+    vocabulary = sorted(term_ids)
+    rank = np.empty(len(vocabulary), dtype=np.int64)
+    rank[[term_ids[term] for term in vocabulary]] = np.arange(len(vocabulary))
+    term_ranks = rank[np.frombuffer(posting_terms, dtype=np.uint32)] if posting_docs else np.empty(0, np.int64)
+    docs = np.frombuffer(posting_docs, dtype=np.uint32)
+    order = np.lexsort((docs, term_ranks))
+    encoded_terms = [term.encode('utf-8') for term in vocabulary]
+    
+    sections = [
+        SUGGEST_HEADER.pack(SUGGEST_FILE_MAGIC, last_change_id, len(doc_ids), len(vocabulary), len(docs)),
+        _aligned(np.frombuffer(doc_ids, dtype=np.uint32).astype('<u4').tobytes()),
+        _aligned(np.frombuffer(doc_users, dtype=np.uint32).astype('<u4').tobytes()),
+        _aligned(_offsets([len(t) for t in titles]).tobytes()),
+        _aligned(b''.join(titles)),
+        _aligned(_offsets([len(t) for t in encoded_terms]).tobytes()),
+        _aligned(b''.join(encoded_terms)),
+        _aligned(_offsets(np.bincount(term_ranks, minlength=len(vocabulary))).tobytes()),
+        _aligned(docs[order].astype('<u4').tobytes()),
+        _aligned(np.frombuffer(bytes(posting_bits), dtype=np.uint8)[order].tobytes()),
+    ]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        for section in sections:
+            f.write(section)
+    os.replace(temp_path, path)
+    
+    db.session.execute(db.delete(SearchChange).where(SearchChange.id <= last_change_id,
+                                                     SearchChange.created_at < prune_before))
+    db.session.commit()
+    return len(doc_ids)
+
+
+class _SnapshotTerms:
+    """Sorted terms of a snapshot as a sequence of bytes, for bisect."""
+    
+    def __init__(self, buffer, start, offsets):
+        self.buffer = buffer
+        self.start = start
+        self.offsets = offsets
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i):
+        return self.buffer[self.start + self.offsets[i]:self.start + self.offsets[i + 1]]
+
+
+class SuggestSnapshot:
+    """Read-only view of a snapshot file; the arrays are numpy views over one shared mmap."""
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        magic, self.last_change_id, n_docs, n_terms, n_postings = SUGGEST_HEADER.unpack_from(self.buffer, 0)
+        if magic != SUGGEST_FILE_MAGIC:
+            raise ValueError(f"{path} is not a suggestion index")
+        self.offset = SUGGEST_HEADER.size
+        
+        self.doc_ids = self._array('<u4', n_docs)
+        self.doc_users = self._array('<u4', n_docs)
+        self.title_offsets = self._array('<u4', n_docs + 1)
+        self.titles_start = self._skip(int(self.title_offsets[-1]))
+        term_offsets = self._array('<u4', n_terms + 1).tolist()
+        self.terms = _SnapshotTerms(self.buffer, self._skip(term_offsets[-1]), term_offsets)
+        self.posting_offsets = self._array('<u4', n_terms + 1).tolist()
+        self.posting_docs = self._array('<u4', n_postings)
+        self.posting_bits = self._array('u1', n_postings)
+    
+    def _array(self, dtype, count):
+        values = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.offset)
+        self._skip(values.nbytes)
+        return values
+    
+    def _skip(self, size):
+        """Step over a section of `size` bytes (plus padding); returns where it starts."""
+        start = self.offset
+        self.offset += size + (-size % 8)
+        return start
+    
+    def position(self, document_id):
+        """Index of a document in the snapshot, or None."""
+        i = int(np.searchsorted(self.doc_ids, document_id))
+        return i if i < len(self.doc_ids) and self.doc_ids[i] == document_id else None
+    
+    def title(self, i):
+        start = self.titles_start
+        return self.buffer[start + int(self.title_offsets[i]):start + int(self.title_offsets[i + 1])].decode('utf-8')
+    
+    def prefix_postings(self, prefix):
+        """(document positions, field bits) of every term starting with `prefix`."""
+        key = prefix.encode('utf-8')
+        lo = bisect.bisect_left(self.terms, key)
+        hi = bisect.bisect_left(self.terms, key + b'\xff', lo)  # 0xff never occurs in UTF-8
+        start, end = self.posting_offsets[lo], self.posting_offsets[hi]
+        return self.posting_docs[start:end], self.posting_bits[start:end]
+
+
+class SuggestIndex:
+    """A worker's typeahead index: the shared snapshot plus documents changed since it was written."""
+    
+    def __init__(self, path, snapshot):
+        self.path = path
+        self.snapshot = snapshot
+        self.last_change_id = snapshot.last_change_id
+        self.applied_changes = {}  # change id -> created_at, for ids inside the re-read window
+        self.superseded = np.zeros(len(snapshot.doc_ids), dtype=bool)  # Snapshot entries that are out of date
+        # Overlay of changed documents, inverted per user: term -> {document_id: bits}, plus the sorted terms
+        self.changed = {}  # document_id -> (user_id, title, terms)
+        self.changed_postings = {}
+        self.changed_terms = {}
+    
+    def apply(self, document_id, entry):
+        """Replace a document's entry; entry is (user_id, title, terms), or None once it is deleted."""
+        position = self.snapshot.position(document_id)
+        if position is not None:
+            self.superseded[position] = True
+        
+        old = self.changed.pop(document_id, None)
+        if old is not None:
+            postings, terms = self.changed_postings[old[0]], self.changed_terms[old[0]]
+            for term in old[2]:
+                del postings[term][document_id]
+                if not postings[term]:
+                    del postings[term]
+                    del terms[bisect.bisect_left(terms, term)]
+        if entry is not None:
+            user_id = entry[0]
+            self.changed[document_id] = entry
+            postings = self.changed_postings.setdefault(user_id, {})
+            terms = self.changed_terms.setdefault(user_id, [])
+            for term, bits in entry[2].items():
+                if term not in postings:
+                    postings[term] = {}
+                    bisect.insort(terms, term)
+                postings[term][document_id] = bits
+    
+    def pending(self):
+        return len(self.changed) + int(self.superseded.sum())
+    
+    def _changed_matches(self, user_id, words):
+        """{document_id: score} of changed documents matching every word as a prefix."""
+        postings, terms = self.changed_postings.get(user_id), self.changed_terms.get(user_id)
+        if not terms:
+            return {}
+        scores = None
+        for word in words:
+            word_scores = {}
+            lo = bisect.bisect_left(terms, word)
+            hi = bisect.bisect_left(terms, word + '\U0010ffff', lo)
+            for term in terms[lo:hi]:
+                for document_id, bits in postings[term].items():
+                    word_scores[document_id] = word_scores.get(document_id, 0.0) + SUGGEST_FIELD_SCORES[bits]
+            if scores is not None:
+                word_scores = {d: s + scores[d] for d, s in word_scores.items() if d in scores}
+            scores = word_scores
+            if not scores:
+                break
+        return scores
+    
+    def suggest(self, user_id, query, limit):
+        """Up to `limit` (score, document id, title) of user_id's documents matching every word as a prefix."""
+        words = SUGGEST_TERM_RE.findall(query.lower())[:8]
+        # Finished stop words ("notes on ...") aren't indexed; the word being typed always counts
+        words = [w for w in words[:-1] if w not in KEYWORD_STOP_WORDS] + words[-1:]
+        if not words:
+            return []
+        
+        snapshot = self.snapshot
+        n_docs = len(snapshot.doc_ids)
+        scores = np.zeros(n_docs)
+        matched = snapshot.doc_users == user_id
+        matched &= ~self.superseded
+        for word in words:
+            if not matched.any():
+                break
+            docs, bits = snapshot.prefix_postings(word)
+            word_scores = np.bincount(docs, weights=SUGGEST_FIELD_SCORES[bits], minlength=n_docs)
+            matched &= word_scores > 0
+            scores += word_scores
+        
+        results = []
+        candidates = np.flatnonzero(matched)
+        if len(candidates) > limit:
+            # Best score first, newest document first among equal scores
+            candidates = candidates[np.argpartition(-(scores[candidates] * (n_docs + 1) + candidates), limit)[:limit]]
+        for i in candidates:
+            results.append((float(scores[i]), int(snapshot.doc_ids[i]), snapshot.title(i)))
+        for document_id, score in self._changed_matches(user_id, words).items():
+            results.append((float(score), document_id, self.changed[document_id][1]))
+        
+        results.sort(key=lambda result: (-result[0], -result[1]))
+        return results[:limit]
+
+
+def search_change_log_available(connection):
+    """True if the search_change table exists (checked once per database; old databases need the migration)."""
+    key = str(connection.engine.url)
+    if key not in search_change_state:
+        search_change_state[key] = db.inspect(connection).has_table(SearchChange.__tablename__)
+    return search_change_state[key]
+
+
+def log_search_change(connection, document_id):
+    if search_change_log_available(connection):
+        connection.execute(SearchChange.__table__.insert().values(document_id=document_id, created_at=datetime.utcnow()))
+
+
+@event.listens_for(Document, 'after_insert')
+def _log_new_document(mapper, connection, target):
+    log_search_change(connection, target.id)
+
+
+@event.listens_for(Document, 'after_update')
+def _log_changed_document(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in SUGGEST_LOGGED_ATTRIBUTES):
+        log_search_change(connection, target.id)
+
+
+@event.listens_for(Document, 'after_delete')
+def _log_deleted_document(mapper, connection, target):
+    log_search_change(connection, target.id)
+
+
+def apply_search_changes(index, batch_size=500):
+    """
+    Bring a worker's index up to date with the change log. Ids are allocated when a change is
+    logged but only become visible when its transaction commits, so a lower id can show up after
+    a higher one: the last SUGGEST_CHANGE_WINDOW_SECONDS of the log are re-read as well, and
+    every id in it that this index hasn't applied yet is picked up.
+    """
+    window_start = datetime.utcnow() - timedelta(seconds=app.config['SUGGEST_CHANGE_WINDOW_SECONDS'])
+    index.applied_changes = {i: at for i, at in index.applied_changes.items() if at >= window_start}
+    rows = db.session.execute(
+        db.select(SearchChange.id, SearchChange.document_id, SearchChange.created_at)
+        .where(db.or_(SearchChange.id > index.last_change_id, SearchChange.created_at >= window_start))
+        .order_by(SearchChange.id)
+    ).all()
+    rows = [row for row in rows if row.id not in index.applied_changes]
+    if not rows:
+        return
+    document_ids = list(dict.fromkeys(row.document_id for row in rows))
+    for first in range(0, len(document_ids), batch_size):
+        batch = document_ids[first:first + batch_size]
+        current = {doc[0]: doc[1:] for doc in load_suggest_documents(Document.id.in_(batch))}
+        for document_id in batch:
+            index.apply(document_id, current.get(document_id))
+    for row in rows:
+        index.applied_changes[row.id] = row.created_at or datetime.utcnow()
+    index.last_change_id = max(index.last_change_id, rows[-1].id)
+
+
+def _rebuild_suggest_snapshot(path):
+    """Background compaction: one process writes a new snapshot, every worker picks it up on its next refresh."""
+    lock_path = f"{path}.lock"
+    try:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if time.time() - os.path.getmtime(lock_path) < 600:
+                return  # Another process is already rebuilding
+            os.remove(lock_path)  # Left behind by a crashed rebuild
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.close(fd)
+        try:
+            with app.app_context():
+                build_suggest_snapshot(path)
+        finally:
+            os.remove(lock_path)
+    except Exception as e:
+        print(f"Suggestion index rebuild error: {e}")
+    finally:
+        suggest_state['rebuilding'] = False
+
+
+def schedule_suggest_snapshot(path):
+    """Write a new snapshot in the background (call with suggest_lock held); at most one queued per worker."""
+    if not suggest_state['rebuilding']:
+        suggest_state['rebuilding'] = True
+        suggest_executor.submit(_rebuild_suggest_snapshot, path)
+
+
+def get_suggest_index():
+    """
+    This worker's index, at most SUGGEST_REFRESH_SECONDS behind the database. None while there is no
+    readable snapshot yet: the first one is written in the background and callers fall back to the
+    full-text index meanwhile.
+    """
+    path = app.config['SUGGEST_INDEX_PATH']
+    index = suggest_state['index']
+    now = time.monotonic()
+    if index is not None and index.path == path and now - suggest_state['checked_at'] < app.config['SUGGEST_REFRESH_SECONDS']:
+        return index
+    
+    with suggest_lock:
+        index = suggest_state['index']
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            schedule_suggest_snapshot(path)
+            return None
+        file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        # A new snapshot (first use, or written by any worker's compaction) replaces the overlay
+        if index is None or index.path != path or index.snapshot.file_id != file_id:
+            try:
+                snapshot = SuggestSnapshot(path)
+            except (ValueError, struct.error) as e:
+                print(f"Suggestion index unreadable, rebuilding: {e}")
+                schedule_suggest_snapshot(path)
+                return None
+            index = SuggestIndex(path, snapshot)
+            suggest_state['index'] = index
+        apply_search_changes(index)
+        suggest_state['checked_at'] = now
         
-        return recommendations
-    except Exception as e:
-        print(f"Error getting recommendations: {e}")
-        return []
+        if index.pending() > app.config['SUGGEST_COMPACT_AFTER']:
+            schedule_suggest_snapshot(path)
+        return index
+
+
+def suggest_from_search_index(user_id, query, limit):
+    """(score, document id, title) typeahead matches from the full-text index, for a worker without a snapshot."""
+    rows = document_search_query(query, user_id).filter(Document.user_id == user_id)\
+        .with_entities(Document.id, Document.original_filename).limit(limit).all()
+    return [(0.0, row.id, row.original_filename) for row in rows]
+
+
+def suggest_documents(user_id, query, limit=None):
+    """Typeahead matches for `query` among user_id's documents: [{'id', 'original_filename'}], best first."""
+    limit = limit or app.config['SUGGEST_RESULTS_LIMIT']
+    index = get_suggest_index()
+    if index is not None:
+        matches = index.suggest(user_id, query, limit)
+    else:
+        matches = suggest_from_search_index(user_id, query, limit)
+    return [{'id': document_id, 'original_filename': title} for _, document_id, title in matches]
 
 
 @app.route('/')
 @login_required
 def index():
-    years = [r[0] for r in db.session.query(Document.year).filter_by(user_id=current_user.id).distinct().order_by(Document.year).all()]
-    years = sorted([y for y in years if y is not None])
-    
-    # Get total document count for current user
-    total_docs = Document.query.filter_by(user_id=current_user.id).count()
+    # Years and the document total come from one grouped count
+    year_counts = {facet['value']: facet['count'] for facet in document_facets(
+        Document.query.filter_by(user_id=current_user.id).with_entities(Document.id)
+    )['year']}
+    years = list(year_counts)
+    total_docs = sum(year_counts.values())
     
-    return render_template('index.html', years=years, human_year_label=human_year_label, total_docs=total_docs)
+    return render_template('index.html', years=years, year_counts=year_counts, human_year_label=human_year_label,
+                           total_docs=total_docs)
 
 
 @app.route('/upload', methods=['GET', 'POST'])
@@ -1291,6 +5101,9 @@ def upload():
             # Get file size
             file_size = os.path.getsize(save_path)
             
+            # Plain-text content goes into the search index now; the file may move to cloud storage below
+            text_content = plain_text_content(save_path, file.mimetype, orig)
+            
             # Generate thumbnail for images and PDFs
             thumbnail = generate_thumbnail(save_path, file.mimetype)
             
@@ -1350,6 +5163,7 @@ def upload():
                 size=file_size,
                 thumbnail_filename=thumbnail,
                 storage_type=storage_type,
+                extracted_text=text_content,
                 user_id=current_user.id
             )
             # Set tags using the new tag system
@@ -1419,6 +5233,9 @@ def upload_multiple():
             # Get file size
             file_size = os.path.getsize(save_path)
             
+            # Plain-text content goes into the search index now; the file may move to cloud storage below
+            text_content = plain_text_content(save_path, file.mimetype, orig)
+            
             # Generate thumbnail for images and PDFs
             thumbnail = generate_thumbnail(save_path, file.mimetype)
             
@@ -1473,6 +5290,7 @@ def upload_multiple():
                 size=file_size,
                 thumbnail_filename=thumbnail,
                 storage_type=storage_type,
+                extracted_text=text_content,
                 user_id=current_user.id
             )
             doc.set_tags_from_string(tags)
@@ -1546,6 +5364,7 @@ def create_note():
             subject=subject,
             mimetype='text/plain',
             size=os.path.getsize(save_path),
+            extracted_text=content.strip(),  # Indexed for search as it is written
             user_id=current_user.id
         )
         # Set tags using the new tag system
@@ -1562,14 +5381,15 @@ def create_note():
 @app.route('/year/<int:year>')
 @login_required
 def year_view(year: int):
-    subject = request.args.get('subject', type=str)
     tags = request.args.get('tags', type=str)
     page = request.args.get('page', 1, type=int)
     per_page = 10
+    filters = search_filters(request.args)
+    filters.pop('year', None)
 
-    q = Document.query.filter_by(year=year, user_id=current_user.id)
-    if subject:
-        q = q.filter(Document.subject.ilike(f'%{subject}%'))
+    year_documents = Document.query.filter_by(year=year, user_id=current_user.id)
+    # Subject / tag / type picked from the facet lists are indexed equality filters
+    q = filter_documents(year_documents, filters).options(db.selectinload(Document.tag_objects))
     if tags:
         # simple tags search: every provided tag must appear in stored tags string
         for t in [t.strip() for t in tags.split(',') if t.strip()]:
@@ -1580,15 +5400,16 @@ def year_view(year: int):
     )
     documents = pagination.items
     
-    # collect distinct subjects for a quick filter UI
-    subjects = [r[0] for r in db.session.query(Document.subject).filter_by(year=year, user_id=current_user.id).distinct().order_by(Document.subject).all()]
+    # Subject and tag counts for the filter UI, over the whole year
+    facets = document_facets(year_documents.with_entities(Document.id))
     
     return render_template(
         'year.html', 
         year=year, 
         documents=documents, 
         pagination=pagination,
-        subjects=subjects, 
+        facets=facets,
+        filters=filters,
         human_year_label=human_year_label,
         get_subject_color_class=get_subject_color_class
     )
@@ -1600,44 +5421,17 @@ def search():
     query = request.args.get('q', '').strip()
     page = request.args.get('page', 1, type=int)
     per_page = 10
+    filters = search_filters(request.args)
+    mode = 'semantic' if request.args.get('mode') == 'semantic' and get_semantic_model() is not None else None
     
     if not query:
         flash('Please enter a search term', 'warning')
         return redirect(url_for('index'))
     
-    # Search across multiple fields
-    search_term = f'%{query}%'
-    q = Document.query.filter_by(user_id=current_user.id).filter(
-        db.or_(
-            Document.original_filename.ilike(search_term),
-            Document.subject.ilike(search_term),
-            Document.tags.ilike(search_term)
-        )
-    )
-    
-    # For text files, also search content
-    text_docs = Document.query.filter_by(user_id=current_user.id, mimetype='text/plain').all()
-    matching_text_doc_ids = []
-    
-    for doc in text_docs:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], doc.stored_filename)
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-                if query.lower() in content.lower():
-                    matching_text_doc_ids.append(doc.id)
-        except Exception:
-            pass
-    
-    # Combine results
-    if matching_text_doc_ids:
-        q = q.union(
-            Document.query.filter(Document.id.in_(matching_text_doc_ids))
-        )
-    
-    pagination = q.order_by(Document.upload_date.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
+    # BM25-ranked over filename, subject, tags, summary and text (note content is indexed on write),
+    # or ranked by vector similarity in semantic mode
+    pagination, snippets, corrections = search_documents_page(query, current_user.id, page=page, per_page=per_page,
+                                                              filters=filters, mode=mode)
     documents = pagination.items
     
     return render_template(
@@ -1645,6 +5439,12 @@ def search():
         query=query,
         documents=documents,
         pagination=pagination,
+        snippets=snippets,
+        corrections=corrections,
+        facets=search_facets(query, current_user.id, filters, mode),
+        filters=filters,
+        mode=mode,
+        semantic_available=mode is not None or get_semantic_model() is not None,
         human_year_label=human_year_label,
         get_subject_color_class=get_subject_color_class
     )
@@ -1675,7 +5475,7 @@ def tag_view(slug):
     per_page = 10
     
     # Get documents with this tag that belong to current user
-    q = Document.query.join(document_tags).join(Tag).filter(
+    q = Document.query.options(db.selectinload(Document.tag_objects)).join(document_tags).join(Tag).filter(
         Tag.slug == slug,
         Document.user_id == current_user.id
     )
@@ -1698,7 +5498,12 @@ def tag_view(slug):
 @app.route('/download/<int:doc_id>')
 @login_required
 def download(doc_id: int):
-    doc = Document.query.filter_by(id=doc_id, user_id=current_user.id).first_or_404()
+    doc = Document.query.get_or_404(doc_id)
+    
+    # Owner, or shared directly or through a collection
+    if not can_access_document(current_user, doc):
+        flash('You do not have access to this document', 'danger')
+        return redirect(url_for('index'))
     
     # Track download
     doc.download_count = (doc.download_count or 0) + 1
@@ -1732,7 +5537,12 @@ def download(doc_id: int):
 @app.route('/preview/<int:doc_id>')
 @login_required
 def preview(doc_id: int):
-    doc = Document.query.filter_by(id=doc_id, user_id=current_user.id).first_or_404()
+    doc = Document.query.get_or_404(doc_id)
+    
+    # Owner, or shared directly or through a collection
+    if not can_access_document(current_user, doc):
+        flash('You do not have access to this document', 'danger')
+        return redirect(url_for('index'))
     
     # Track view
     doc.view_count = (doc.view_count or 0) + 1
@@ -1886,6 +5696,8 @@ def delete_document(doc_id: int):
                 print(f"Error deleting thumbnail: {e}")
     
     # Delete from database
+    if doc.last_analyzed is not None:
+        update_keyword_stats(doc.user_id, doc.extracted_text, -1)
     db.session.delete(doc)
     db.session.commit()
     
@@ -2051,14 +5863,19 @@ def revoke_share(share_id):
 def shared_with_me():
     """View all documents and collections shared with current user."""
     # Get shared documents
-    doc_shares = SharePermission.query.filter_by(
+    doc_shares = SharePermission.query.options(
+        db.selectinload(SharePermission.document).selectinload(Document.tag_objects),
+        db.selectinload(SharePermission.document).selectinload(Document.owner)
+    ).filter_by(
         shared_with_id=current_user.id
     ).filter(SharePermission.document_id.isnot(None)).all()
     
     shared_docs = [share.document for share in doc_shares if share.document]
     
     # Get shared collections
-    collection_shares = SharePermission.query.filter_by(
+    collection_shares = SharePermission.query.options(
+        db.selectinload(SharePermission.collection)
+    ).filter_by(
         shared_with_id=current_user.id
     ).filter(SharePermission.collection_id.isnot(None)).all()
     
@@ -2128,7 +5945,7 @@ def create_collection():
 def view_collection(collection_id):
     """View documents in a specific collection."""
     collection = Collection.query.filter_by(id=collection_id, user_id=current_user.id).first_or_404()
-    documents = collection.documents.all()
+    documents = collection.documents.options(db.selectinload(Document.tag_objects)).all()
     
     return render_template('collection_view.html', collection=collection, documents=documents)
 
@@ -2397,7 +6214,10 @@ def group_view(group_id):
     # For now, show documents shared by group members
     member_ids = [member.id for member in group.members]
     
-    shared_docs = db.session.query(Document).join(
+    shared_docs = db.session.query(Document).options(
+        db.selectinload(Document.tag_objects),
+        db.selectinload(Document.owner)
+    ).join(
         SharePermission,
         Document.id == SharePermission.document_id
     ).filter(
@@ -2520,31 +6340,210 @@ def analyze_document_route(doc_id):
     """Trigger AI analysis for a document."""
     document = Document.query.filter_by(id=doc_id, user_id=current_user.id).first_or_404()
     
-    if not gemini_model and not openai_client:
+    if not ai_available():
         return jsonify({'success': False, 'error': 'AI features not configured'}), 400
     
-    # Run analysis in the request (in production, use background task)
-    success = analyze_document(doc_id)
+    # ?force=1 re-runs the LLM calls instead of serving cached responses
+    force = request.args.get('force', '').lower() in ('1', 'true', 'yes')
     
-    if success:
-        # Log analysis activity
-        log_activity('analysis', document_id=doc_id)
-        
+    # Queue the analysis on the background executor; progress is polled or streamed
+    job = AnalysisJob(id=uuid4().hex, user_id=current_user.id, document_id=document.id)
+    db.session.add(job)
+    db.session.commit()
+    analysis_executor.submit(run_analysis_job, job.id, not force)
+    
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('analysis_job_status', job_id=job.id),
+        'events_url': url_for('analysis_job_events', job_id=job.id)
+    }), 202
+
+
+@app.route('/api/analysis-jobs/<job_id>')
+@login_required
+def analysis_job_status(job_id):
+    """Current state of a background analysis job."""
+    job = AnalysisJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    if fail_stale_analysis_job(job):
+        db.session.refresh(job)
+    return jsonify({'success': True, 'job': analysis_job_payload(job)})
+
+
+@app.route('/api/analysis-jobs/<job_id>/events')
+@login_required
+def analysis_job_events(job_id):
+    """
+    Server-Sent Events stream of a job's progress (extracting, page N of M, summarizing, tagging, done).
+    503 when this worker has no free stream slot; the client then polls analysis_job_status.
+    """
+    job = AnalysisJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    job_id = job.id
+    if not acquire_stream_slot():
+        return jsonify({'success': False, 'error': 'Too many open streams; poll the status URL'}), 503
+    
+    def events():
+        last_seq = None
+        last_sent = time.monotonic()
+        deadline = last_sent + app.config['ANALYSIS_EVENT_TIMEOUT_SECONDS']
+        while time.monotonic() < deadline:
+            db.session.expire_all()
+            current = db.session.get(AnalysisJob, job_id)
+            if current is None:  # Deleted with its document
+                yield sse_event('failed', {'job_id': job_id, 'status': 'failed', 'error': 'Document was deleted'})
+                return
+            if fail_stale_analysis_job(current):
+                continue
+            if current.seq != last_seq:
+                last_seq = current.seq
+                last_sent = time.monotonic()
+                event = 'failed' if current.status == 'failed' else current.stage
+                yield sse_event(event, analysis_job_payload(current), event_id=current.seq)
+                if current.status in ('done', 'failed'):
+                    return
+            elif time.monotonic() - last_sent > 15:
+                # Comment line keeps proxies from closing an idle stream
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(app.config['ANALYSIS_EVENT_POLL_SECONDS'])
+    
+    return event_stream_response(events())
+
+
+@app.route('/api/ai/bulk-analyze', methods=['POST'])
+@login_required
+def bulk_analyze_start():
+    """
+    Start a background bulk analysis of the current user's unanalyzed documents (admins: all users).
+    Runs in a thread of this web worker with inline text extraction, so it is limited to
+    BULK_ANALYSIS_WEB_MAX_DOCUMENTS documents; larger libraries are analyzed with bulk_analyze.py.
+    """
+    if not ai_available():
+        return jsonify({'success': False, 'error': 'AI features not configured'}), 400
+    
+    data = request.get_json(silent=True) or {}
+    user_id = current_user.id
+    if data.get('all_users'):
+        if not is_admin_user(current_user):
+            return jsonify({'success': False, 'error': 'Admin access required'}), 403
+        user_id = None
+    
+    fail_stale_analysis_runs(user_id)
+    if AnalysisRun.query.filter_by(user_id=user_id, status='running').first():
+        return jsonify({'success': False, 'error': 'A bulk analysis is already running'}), 409
+    
+    # Resume the most recent interrupted run, otherwise start a new one
+    run = AnalysisRun.query.filter(
+        AnalysisRun.user_id == user_id,
+        AnalysisRun.status.in_(['pending', 'failed'])
+    ).order_by(AnalysisRun.id.desc()).first()
+    
+    pending = pending_analysis_query(user_id)
+    if run:
+        pending = pending.filter(Document.id > run.last_document_id)
+    pending = pending.count()
+    if pending > app.config['BULK_ANALYSIS_WEB_MAX_DOCUMENTS']:
+        command = 'python bulk_analyze.py' + (f' --user-id {user_id}' if user_id is not None else '')
+        if run:
+            command += f' --resume {run.id}'
         return jsonify({
-            'success': True,
-            'summary': document.summary,
-            'ai_tags': document.ai_tags,
-            'extracted_text_length': len(document.extracted_text) if document.extracted_text else 0
-        })
-    else:
-        return jsonify({'success': False, 'error': 'Analysis failed'}), 500
+            'success': False,
+            'error': f"{pending} documents are too many to analyze from the web app; run `{command}` on the server",
+            'pending': pending
+        }), 400
+    
+    if not run:
+        run = AnalysisRun(user_id=user_id)
+        db.session.add(run)
+        db.session.commit()
+    
+    run_id = run.id
+    use_cache = not data.get('force')
+    
+    def worker():
+        with app.app_context():
+            try:
+                run_bulk_analysis(run_id, extract_workers=0, use_cache=use_cache)
+            except Exception as e:
+                print(f"Bulk analysis run {run_id} failed: {e}")
+    
+    threading.Thread(target=worker, daemon=True).start()
+    return jsonify({
+        'success': True,
+        'run_id': run_id,
+        'status_url': url_for('bulk_analyze_status', run_id=run_id)
+    }), 202
+
+
+@app.route('/api/ai/bulk-analyze/<int:run_id>')
+@login_required
+def bulk_analyze_status(run_id):
+    """Progress and throughput of a bulk analysis run."""
+    run = AnalysisRun.query.get_or_404(run_id)
+    if run.user_id != current_user.id and not is_admin_user(current_user):
+        return jsonify({'success': False, 'error': 'Run not found'}), 404
+    return jsonify({'success': True, 'run': run.to_dict()})
+
+
+@app.route('/api/ai/cache-stats')
+@login_required
+def ai_cache_stats():
+    """Admin only: hit/miss counters for the LLM response cache (this worker) and its current size."""
+    if not is_admin_user(current_user):
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+    lookups = llm_cache_stats['hits'] + llm_cache_stats['misses']
+    return jsonify({
+        'success': True,
+        'enabled': app.config['LLM_CACHE_ENABLED'],
+        'stats': dict(llm_cache_stats),
+        'hit_rate': round(llm_cache_stats['hits'] / lookups, 3) if lookups else None,
+        'entries': LLMCacheEntry.query.count(),
+        'max_entries': app.config['LLM_CACHE_MAX_ENTRIES'],
+        'ttl_hours': app.config['LLM_CACHE_TTL_HOURS']
+    })
+
+
+@app.route('/api/ai/providers')
+@login_required
+def ai_providers_status():
+    """Circuit breaker state per AI provider and call counters (timeouts, fallbacks, hedges)."""
+    return jsonify({
+        'success': True,
+        'provider': app.config['AI_PROVIDER'],
+        'providers': ai_provider_status(),
+        'stats': dict(ai_provider_stats),
+        'timeout_seconds': app.config['AI_TIMEOUT_SECONDS'],
+        'hedge_after_seconds': app.config['AI_HEDGE_AFTER_SECONDS']
+    })
+
+
+@app.route('/api/admin/ai-metrics')
+@login_required
+def admin_ai_metrics():
+    """Admin only: AI latency percentiles per route and provider, and daily per-user token totals."""
+    if not is_admin_user(current_user):
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+    hours = min(max(request.args.get('hours', 24, type=int), 1), 24 * app.config['AI_METRICS_RETENTION_DAYS'])
+    days = min(max(request.args.get('days', 7, type=int), 1), app.config['AI_METRICS_RETENTION_DAYS'])
+    
+    flush_ai_metrics()
+    since = datetime.utcnow() - timedelta(hours=hours)
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return jsonify({
+        'success': True,
+        'hours': hours,
+        'routes': ai_metrics_by(AICallMetric.route, since),
+        'providers': ai_metrics_by(AICallMetric.provider, since),
+        'daily_users': ai_daily_usage(today - timedelta(days=days - 1)),
+        'daily_token_quota': app.config['AI_DAILY_TOKEN_QUOTA'] or None
+    })
 
 
 @app.route('/document/<int:doc_id>/summary')
 @login_required
 def get_document_summary(doc_id):
     """Get or generate document summary."""
-    document = Document.query.filter_by(id=doc_id, user_id=current_user.id).first_or_404()
+    document = Document.query.options(db.undefer(Document.summary)).filter_by(id=doc_id, user_id=current_user.id).first_or_404()
     
     if document.summary:
         return jsonify({'success': True, 'summary': document.summary})
@@ -2568,11 +6567,12 @@ def get_smart_tags(doc_id):
     
     if document.ai_tags:
         tags = [tag.strip() for tag in document.ai_tags.split(',')]
-        return jsonify({'success': True, 'tags': tags})
+        key_terms = [term.strip() for term in document.key_terms.split(',')] if document.key_terms else []
+        return jsonify({'success': True, 'tags': tags, 'key_terms': key_terms})
     
     # Generate tags if not exists
     if document.extracted_text:
-        smart_tags = generate_smart_tags(document.extracted_text, document.subject)
+        smart_tags = generate_smart_tags(document.extracted_text, document.subject, user_id=document.user_id)
         if smart_tags:
             document.ai_tags = ', '.join(smart_tags)
             db.session.commit()
@@ -2585,7 +6585,7 @@ def get_smart_tags(doc_id):
 @login_required
 def get_extracted_text(doc_id):
     """Get extracted text from document."""
-    document = Document.query.filter_by(id=doc_id, user_id=current_user.id).first_or_404()
+    document = Document.query.options(db.undefer(Document.extracted_text)).filter_by(id=doc_id, user_id=current_user.id).first_or_404()
     
     if document.extracted_text:
         return jsonify({
@@ -2597,44 +6597,65 @@ def get_extracted_text(doc_id):
     return jsonify({'success': False, 'error': 'No extracted text available'}), 404
 
 
-@app.route('/search')
-@login_required
-def search_documents():
-    """Full-text search across documents."""
-    query = request.args.get('q', '').strip()
-    
-    if not query:
-        return render_template('search.html', query='', results=[])
-    
-    # Perform full-text search
-    results = search_documents_fulltext(query, current_user.id)
-    
-    return render_template('search.html', query=query, results=results)
-
-
 @app.route('/api/search')
 @login_required
 def api_search_documents():
-    """API endpoint for document search."""
+    """
+    API endpoint for document search (same ranking as the search page), paginated with ?page=&per_page=,
+    narrowed with ?year=&subject=&mimetype=&tag=. ?facets=1 adds the facet counts of all results.
+    ?mode=semantic ranks by meaning (local vectors) instead of keywords.
+    """
     query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), app.config['SEARCH_RESULTS_LIMIT'])
+    filters = search_filters(request.args)
+    mode = 'semantic' if request.args.get('mode') == 'semantic' and get_semantic_model() is not None else None
     
     if not query:
         return jsonify({'success': False, 'error': 'Query required'}), 400
     
-    results = search_documents_fulltext(query, current_user.id)
+    pagination, snippets, corrections = search_documents_page(query, current_user.id, page=page, per_page=per_page,
+                                                              with_summary=True, filters=filters, mode=mode)
     
     results_list = []
-    for doc in results:
+    for doc in pagination.items:
+        snippet = snippets.get(doc.id)
         results_list.append({
             'id': doc.id,
             'original_filename': doc.original_filename,
             'year': doc.year,
             'subject': doc.subject,
             'summary': doc.summary,
+            'snippet': str(snippet) if snippet else None,  # HTML-escaped, hits wrapped in <mark>
             'upload_date': doc.upload_date.strftime('%Y-%m-%d')
         })
     
-    return jsonify({'success': True, 'results': results_list, 'count': len(results_list)})
+    return jsonify({
+        'success': True,
+        'results': results_list,
+        'count': len(results_list),
+        'total': pagination.total,
+        'page': pagination.page,
+        'pages': pagination.pages,
+        'per_page': per_page,
+        'corrections': corrections,  # Misspelled word -> similar words that were searched as well
+        'filters': filters,
+        'mode': mode or 'keyword',
+        'facets': search_facets(query, current_user.id, filters, mode) if request.args.get('facets') else None
+    })
+
+
+@app.route('/api/search/suggest')
+@login_required
+def api_search_suggest():
+    """Search-as-you-type suggestions from the in-memory index (matches filename, tags, subject and summary)."""
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', app.config['SUGGEST_RESULTS_LIMIT'], type=int), 1), 20)
+    
+    if not query:
+        return jsonify({'success': True, 'suggestions': []})
+    
+    return jsonify({'success': True, 'suggestions': suggest_documents(current_user.id, query, limit)})
 
 
 @app.route('/document/<int:doc_id>/recommendations')
@@ -2665,11 +6686,14 @@ def ai_features_page():
     """AI features showcase page."""
     # Get some stats
     total_docs = Document.query.filter_by(user_id=current_user.id).count()
-    analyzed_docs = Document.query.filter_by(user_id=current_user.id).filter(Document.extracted_text.isnot(None)).count()
+    analyzed_docs = Document.query.filter_by(user_id=current_user.id).filter(Document.last_analyzed.isnot(None)).count()
     summarized_docs = Document.query.filter_by(user_id=current_user.id).filter(Document.summary.isnot(None)).count()
     
-    # Get the actual analyzed documents with summaries
-    analyzed_documents = Document.query.filter_by(user_id=current_user.id).filter(
+    # Get the actual analyzed documents with summaries (the cards show the summary and text length)
+    analyzed_documents = Document.query.options(
+        db.undefer(Document.summary),
+        db.undefer(Document.extracted_text)
+    ).filter_by(user_id=current_user.id).filter(
         Document.summary.isnot(None)
     ).order_by(Document.last_analyzed.desc()).limit(6).all()
     
@@ -2677,7 +6701,7 @@ def ai_features_page():
         'total_documents': total_docs,
         'analyzed_documents': analyzed_docs,
         'summarized_documents': summarized_docs,
-        'ai_enabled': gemini_model is not None or openai_client is not None,
+        'ai_enabled': ai_available(),
         'ocr_enabled': os.path.exists(app.config['TESSERACT_CMD'])
     }
     
@@ -2745,10 +6769,166 @@ def chat_session(session_id):
                          document=document)
 
 
+CHAT_SYSTEM_PROMPT = """You are an AI Study Assistant helping students understand their documents and study materials.
+You are helpful, friendly, and focused on education.
+Answer the student's questions based on the document context provided. If asked to generate quizzes, create multiple-choice questions. If asked for study plans, provide structured schedules."""
+
+# Stored messages are trimmed to this many characters when folded into the rolling summary
+CHAT_SUMMARY_MESSAGE_CHARS = 800
+
+chat_summary_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token for English text)."""
+    return len(text or '') // 4 + 1
+
+
+def truncate_to_tokens(text, max_tokens, keep='head'):
+    """Trim text to roughly max_tokens, keeping the start ('head') or the end ('tail')."""
+    max_chars = max(max_tokens, 0) * 4
+    if not text or len(text) <= max_chars:
+        return text or ''
+    return text[:max_chars] if keep == 'head' else text[-max_chars:]
+
+
+def recent_chat_messages(session_id, limit=None):
+    """Return the last `limit` messages of a session, oldest first (LIMIT in SQL, not Python)."""
+    limit = limit or app.config['CHAT_HISTORY_MESSAGES']
+    messages = ChatMessage.query.filter_by(session_id=session_id)\
+        .order_by(ChatMessage.id.desc()).limit(limit).all()
+    return messages[::-1]
+
+
+def prepare_chat_turn(session, user_message):
+    """
+    Assemble the Gemini chat history for the next turn within CHAT_PROMPT_TOKEN_BUDGET.
+    The prompt is: system instructions + document context + rolling summary, then the
+    most recent messages that still fit. Returns (history, estimated_prompt_tokens).
+    """
+    budget = app.config['CHAT_PROMPT_TOKEN_BUDGET'] - estimate_tokens(user_message)
+    
+    # Build context from document if available
+    context = ""
+    if session.document:
+        doc = session.document
+        context = f"""Document Context:
+Filename: {doc.original_filename}
+Subject: {doc.subject}
+Year: {doc.year}
+"""
+        # Read just the summary: touching doc.summary would load the whole deferred 'content' group
+        doc_summary = db.session.query(Document.summary).filter_by(id=doc.id).scalar()
+        if doc_summary:
+            context += f"Summary: {doc_summary}\n"
+        excerpt_tokens = min(app.config['CHAT_DOCUMENT_TOKENS'], budget // 3)
+        excerpt = retrieve_document_context(doc, user_message, char_budget=excerpt_tokens * 4)
+        if excerpt:
+            context += f"\nRelevant Document Excerpts:\n{excerpt}\n"
+    
+    preamble = CHAT_SYSTEM_PROMPT
+    if context:
+        preamble += f"\n\n{context}"
+    if session.history_summary:
+        summary = truncate_to_tokens(session.history_summary, app.config['CHAT_SUMMARY_MAX_TOKENS'], keep='tail')
+        preamble += f"\n\nSummary of the earlier conversation:\n{summary}"
+    used = estimate_tokens(preamble)
+    
+    # Fill the rest of the budget with the newest messages
+    window = []
+    for msg in reversed(recent_chat_messages(session.id)):
+        cost = estimate_tokens(msg.content)
+        if used + cost > budget:
+            break
+        window.insert(0, msg)
+        used += cost
+    # Gemini expects turns to alternate, starting after our model acknowledgement with a user turn
+    while window and window[0].role != 'user':
+        window.pop(0)
+    
+    # The system prompt goes first as a user/model exchange so it works with any chat backend
+    conversation_history = [
+        {'role': 'user', 'parts': [preamble]},
+        {'role': 'model', 'parts': ['Understood. I will use this context to help the student.']},
+    ]
+    for msg in window:
+        conversation_history.append({
+            'role': 'model' if msg.role == 'assistant' else msg.role,
+            'parts': [msg.content]
+        })
+    
+    return conversation_history, used + estimate_tokens(user_message)
+
+
+def summarize_chat_turns(previous_summary, messages):
+    """Fold messages into the running summary (AI provider when available, otherwise extractive)."""
+    max_tokens = app.config['CHAT_SUMMARY_MAX_TOKENS']
+    transcript = '\n'.join(
+        f"{'Student' if msg.role == 'user' else 'Assistant'}: {msg.content[:CHAT_SUMMARY_MESSAGE_CHARS]}"
+        for msg in messages
+    )
+    
+    if ai_available():
+        try:
+            prompt = f"""Update the running summary of a tutoring conversation with the new messages below.
+Keep the topics covered, questions asked, answers given and anything the student wants to remember.
+Write at most {max_tokens * 3 // 4} words.
+
+Current summary:
+{previous_summary or '(none)'}
+
+New messages:
+{transcript}
+
+Updated summary:"""
+            return truncate_to_tokens(ai_complete(prompt).strip(), max_tokens, keep='tail')
+        except Exception as e:
+            print(f"Chat summary error: {e}")
+    
+    # Fallback: keep the student's questions, dropping the oldest when over budget
+    questions = '\n'.join(f"- Student asked: {msg.content[:200]}" for msg in messages if msg.role == 'user')
+    combined = '\n'.join(part for part in (previous_summary, questions) if part)
+    return truncate_to_tokens(combined, max_tokens, keep='tail')
+
+
+def refresh_chat_summary(session_id):
+    """
+    Fold messages that have slid out of the history window into the session's rolling summary.
+    Incremental: only messages after summarized_until_id are summarized, so the cost per turn is constant.
+    """
+    with app.app_context():
+        try:
+            session = db.session.get(ChatSession, session_id)
+            if not session:
+                return
+            # Oldest message still inside the window; everything before it belongs in the summary
+            boundary_id = db.session.query(ChatMessage.id).filter_by(session_id=session_id)\
+                .order_by(ChatMessage.id.desc()).offset(app.config['CHAT_HISTORY_MESSAGES'] - 1).limit(1).scalar()
+            if boundary_id is None:
+                return
+            pending = ChatMessage.query.filter(
+                ChatMessage.session_id == session_id,
+                ChatMessage.id > (session.summarized_until_id or 0),
+                ChatMessage.id < boundary_id
+            ).order_by(ChatMessage.id).limit(app.config['CHAT_HISTORY_MESSAGES'] * 5).all()
+            if not pending:
+                return
+            
+            with ai_call_scope('chat_summary', session.user_id):
+                session.history_summary = summarize_chat_turns(session.history_summary, pending)
+            session.summarized_until_id = pending[-1].id
+            db.session.commit()
+        except Exception as e:
+            print(f"Chat summary refresh error: {e}")
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+
 @app.route('/chat/<int:session_id>/message', methods=['POST'])
 @login_required
 def chat_send_message(session_id):
-    """Send a message in a chat session and get AI response."""
+    """Send a message in a chat session and get AI response (JSON fallback for the streaming endpoint)."""
     session = ChatSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
     
     data = request.get_json()
@@ -2757,6 +6937,9 @@ def chat_send_message(session_id):
     if not user_message:
         return jsonify({'success': False, 'error': 'Message cannot be empty'}), 400
     
+    started = time.monotonic()
+    conversation_history, prompt_tokens = prepare_chat_turn(session, user_message)
+    
     # Save user message
     user_msg = ChatMessage(
         session_id=session.id,
@@ -2767,48 +6950,9 @@ def chat_send_message(session_id):
     
     # Generate AI response
     try:
-        # Build context from document if available
-        context = ""
-        if session.document:
-            doc = session.document
-            context = f"""Document Context:
-Filename: {doc.original_filename}
-Subject: {doc.subject}
-Year: {doc.year}
-"""
-            if doc.summary:
-                context += f"Summary: {doc.summary}\n"
-            if doc.extracted_text:
-                # Use first 3000 characters of extracted text
-                context += f"\nDocument Content (excerpt):\n{doc.extracted_text[:3000]}...\n"
-        
-        # Get conversation history
-        previous_messages = session.messages.order_by(ChatMessage.created_at).all()
-        conversation_history = []
-        for msg in previous_messages[-10:]:  # Last 10 messages for context
-            conversation_history.append({
-                'role': msg.role,
-                'parts': [msg.content]
-            })
-        
-        # Add current user message
-        conversation_history.append({
-            'role': 'user',
-            'parts': [user_message]
-        })
-        
-        # Call Gemini API
-        if gemini_model:
-            system_prompt = f"""You are an AI Study Assistant helping students understand their documents and study materials.
-You are helpful, friendly, and focused on education.
-
-{context}
-
-Answer the student's questions based on the document context provided. If asked to generate quizzes, create multiple-choice questions. If asked for study plans, provide structured schedules."""
-            
-            chat = gemini_model.start_chat(history=conversation_history[:-1])
-            response = chat.send_message(user_message)
-            ai_response = response.text
+        # Call the AI provider (Gemini, falling back to OpenAI)
+        if ai_available():
+            ai_response = call_ai('chat', conversation_history, user_message)
         else:
             ai_response = "AI is not configured. Please set up Gemini API key in .env file."
         
@@ -2825,8 +6969,14 @@ Answer the student's questions based on the document context provided. If asked
         
         db.session.commit()
         
-        # Log chat activity
-        log_activity('chat', document_id=session.document_id if session.document_id else None)
+        # Log chat activity (the whole response arrives at once, so first token == total time)
+        total_ms = round((time.monotonic() - started) * 1000)
+        log_activity('chat', document_id=session.document_id if session.document_id else None,
+                     meta_data=json.dumps({'streamed': False, 'ttft_ms': total_ms, 'total_ms': total_ms,
+                                           'prompt_tokens': prompt_tokens}))
+        
+        # Older turns are summarized in the background so the next prompt stays small
+        chat_summary_executor.submit(refresh_chat_summary, session.id)
         
         return jsonify({
             'success': True,
@@ -2842,11 +6992,95 @@ Answer the student's questions based on the document context provided. If asked
             }
         })
         
+    except AIProviderError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), e.status_code
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/chat/<int:session_id>/message/stream', methods=['POST'])
+@login_required
+def chat_stream_message(session_id):
+    """
+    Send a message and stream the AI response as Server-Sent Events.
+    Emits 'token' events as Gemini produces text, then 'done' (with message ids and
+    time to first token) once the assistant message is saved, or 'error'.
+    503 before anything is saved when this worker has no free stream slot; the client
+    then sends the message to the JSON endpoint instead.
+    """
+    session = ChatSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+    
+    data = request.get_json(silent=True) or {}
+    user_message = data.get('message', '').strip()
+    
+    if not user_message:
+        return jsonify({'success': False, 'error': 'Message cannot be empty'}), 400
+    
+    if not ai_available():
+        return jsonify({'success': False, 'error': 'AI not configured'}), 400
+    
+    if not acquire_stream_slot():
+        return jsonify({'success': False, 'error': 'Too many open streams; use the JSON endpoint'}), 503
+    
+    try:
+        started = time.monotonic()
+        conversation_history, prompt_tokens = prepare_chat_turn(session, user_message)
+        
+        # Save user message before streaming so it survives a dropped connection
+        user_msg = ChatMessage(session_id=session.id, role='user', content=user_message)
+        db.session.add(user_msg)
+        db.session.commit()
+    except Exception:
+        stream_slots.release()
+        raise
+    user_msg_id = user_msg.id
+    user_id = current_user.id
+    document_id = session.document_id
+    
+    def events():
+        parts = []
+        ttft_ms = None
+        try:
+            # The deadline (and provider fallback) covers the wait for the first token
+            with ai_call_scope('chat_stream_message', user_id):
+                first, rest = call_ai('stream_chat', conversation_history, user_message)
+            ttft_ms = round((time.monotonic() - started) * 1000)
+            for text in itertools.chain([first], rest):
+                if not text:
+                    continue
+                parts.append(text)
+                yield sse_event('token', {'text': text})
+        except Exception as e:
+            yield sse_event('error', {'error': str(e)})
+            return
+        
+        ai_msg = ChatMessage(session_id=session_id, role='assistant', content=''.join(parts))
+        db.session.add(ai_msg)
+        ChatSession.query.filter_by(id=session_id).update({'updated_at': datetime.utcnow()})
+        db.session.commit()
+        
+        total_ms = round((time.monotonic() - started) * 1000)
+        log_activity('chat', document_id=document_id, user_id=user_id,
+                     meta_data=json.dumps({'streamed': True, 'ttft_ms': ttft_ms, 'total_ms': total_ms,
+                                           'prompt_tokens': prompt_tokens}))
+        chat_summary_executor.submit(refresh_chat_summary, session_id)
+        
+        yield sse_event('done', {
+            'user_message_id': user_msg_id,
+            'ai_message': {
+                'id': ai_msg.id,
+                'content': ai_msg.content,
+                'created_at': ai_msg.created_at.isoformat()
+            },
+            'ttft_ms': ttft_ms,
+            'total_ms': total_ms
+        })
+    
+    return event_stream_response(events())
+
+
 @app.route('/chat/<int:session_id>/delete', methods=['POST'])
 @login_required
 def chat_delete(session_id):
@@ -2861,11 +7095,17 @@ def chat_delete(session_id):
 @app.route('/chat/quiz/generate', methods=['POST'])
 @login_required
 def generate_quiz():
-    """Generate quiz questions from a document using AI."""
-    data = request.get_json()
+    """Serve quiz questions from the document's quiz bank, generating with AI only when needed."""
+    data = request.get_json(silent=True) or {}
     document_id = data.get('document_id')
-    num_questions = data.get('num_questions', 5)
+    try:
+        num_questions = int(data.get('num_questions', 5))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'num_questions must be a number'}), 400
+    if not 1 <= num_questions <= QUIZ_MAX_QUESTIONS:
+        return jsonify({'success': False, 'error': f'num_questions must be between 1 and {QUIZ_MAX_QUESTIONS}'}), 400
     difficulty = data.get('difficulty', 'medium')  # easy, medium, hard
+    topic = data.get('topic', '').strip()  # Optional: focus questions on part of the document
     
     if not document_id:
         return jsonify({'success': False, 'error': 'Document ID required'}), 400
@@ -2874,66 +7114,46 @@ def generate_quiz():
     if not document:
         return jsonify({'success': False, 'error': 'Document not found'}), 404
     
-    if not document.extracted_text:
-        return jsonify({'success': False, 'error': 'Document has no extracted text. Please analyze it first.'}), 400
+    if difficulty not in QUIZ_DIFFICULTIES:
+        return jsonify({'success': False, 'error': 'Invalid difficulty'}), 400
+    
+    if not ai_available():
+        return jsonify({'success': False, 'error': 'AI not configured'}), 500
     
     try:
-        if gemini_model:
-            prompt = f"""Based on the following document content, generate {num_questions} multiple-choice questions at {difficulty} difficulty level.
-
-Document: {document.original_filename}
-Subject: {document.subject}
-
-Content:
-{document.extracted_text[:4000]}
-
-Generate questions in this exact JSON format:
-{{
-  "questions": [
-    {{
-      "question": "Question text here?",
-      "options": ["Option A", "Option B", "Option C", "Option D"],
-      "correct_answer": 0,
-      "explanation": "Why this answer is correct"
-    }}
-  ]
-}}
-
-Make the questions educational and test real understanding, not just memorization."""
-            
-            response = gemini_model.generate_content(prompt)
-            quiz_text = response.text
-            
-            # Try to extract JSON from response
-            import json
-            import re
-            
-            # Find JSON in response
-            json_match = re.search(r'\{[\s\S]*\}', quiz_text)
-            if json_match:
-                quiz_data = json.loads(json_match.group())
-            else:
-                # If no JSON found, return raw text
-                return jsonify({
-                    'success': True,
-                    'raw_response': quiz_text
-                })
-            
-            # Log quiz activity
-            log_activity('quiz', document_id=document_id)
-            
+        if topic:
+            # Topic quizzes are one-off: generated for the request, not banked
+            questions, raw = generate_quiz_questions(document, num_questions, difficulty, topic)
+            source = 'generated'
+        else:
+            questions, source, raw = serve_quiz(document, num_questions, difficulty)
+        
+        if questions is None:
+            # If no JSON found, return raw text
             return jsonify({
                 'success': True,
-                'quiz': quiz_data,
-                'document': {
-                    'id': document.id,
-                    'filename': document.original_filename
-                }
+                'raw_response': raw
             })
-        else:
-            return jsonify({'success': False, 'error': 'AI not configured'}), 500
-            
+        
+        # Log quiz activity
+        log_activity('quiz', document_id=document_id, meta_data=json.dumps({'source': source}))
+        
+        return jsonify({
+            'success': True,
+            'quiz': {'questions': questions},
+            'source': source,
+            'document': {
+                'id': document.id,
+                'filename': document.original_filename
+            }
+        })
+    
+    except AIProviderError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status_code
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
+        db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
@@ -2946,13 +7166,13 @@ def generate_study_plan():
     duration_days = data.get('duration_days', 7)
     hours_per_day = data.get('hours_per_day', 2)
     
-    # Get user's documents
-    documents = Document.query.filter_by(user_id=current_user.id).order_by(Document.upload_date.desc()).limit(20).all()
+    # Get user's documents (summaries go into the prompt)
+    documents = Document.query.options(db.undefer(Document.summary)).filter_by(user_id=current_user.id).order_by(Document.upload_date.desc()).limit(20).all()
     
     if not documents:
         return jsonify({'success': False, 'error': 'No documents found. Upload some study materials first.'}), 400
     
-    if not gemini_model:
+    if not ai_available():
         return jsonify({'success': False, 'error': 'AI not configured'}), 500
     
     try:
@@ -2996,8 +7216,7 @@ Generate a structured study plan in JSON format:
 
 Make it realistic, achievable, and motivating!"""
         
-        response = gemini_model.generate_content(prompt)
-        plan_text = response.text
+        plan_text = ai_complete(prompt)
         
         # Try to extract JSON
         import json
@@ -3016,6 +7235,8 @@ Make it realistic, achievable, and motivating!"""
             'success': True,
             'plan': plan_data
         })
+    except AIProviderError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status_code
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -3134,7 +7355,7 @@ def analytics_documents_usage():
         
         docs_data = [{
             'id': doc.id,
-            'filename': doc.filename,
+            'filename': doc.original_filename,
             'views': doc.view_count,
             'downloads': doc.download_count,
             'subject': doc.subject or 'Uncategorized'
@@ -3207,7 +7428,9 @@ def analytics_ai_usage():
         
         return jsonify({
             'success': True,
-            'data': ai_data
+            'data': ai_data,
+            'tokens_today': ai_tokens_today(current_user.id),
+            'daily_token_quota': app.config['AI_DAILY_TOKEN_QUOTA'] or None
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -3274,12 +7497,14 @@ def analytics_activity_timeline():
 
 
 # Helper function to log activity
-def log_activity(activity_type, document_id=None, meta_data=None):
-    """Helper function to log user activity."""
+def log_activity(activity_type, document_id=None, meta_data=None, user_id=None):
+    """Helper function to log user activity (pass user_id when logging from a streamed response)."""
     try:
-        if current_user.is_authenticated:
+        if user_id is None and current_user.is_authenticated:
+            user_id = current_user.id
+        if user_id is not None:
             activity = ActivityLog(
-                user_id=current_user.id,
+                user_id=user_id,
                 activity_type=activity_type,
                 document_id=document_id,
                 meta_data=meta_data
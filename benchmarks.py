@@ -0,0 +1,830 @@
+"""
+Micro-benchmarks for the database and AI helpers in app.py.
+Each benchmark runs against a throwaway SQLite database filled with synthetic documents.
+
+Usage:
+    python benchmarks.py deferred-columns [--docs 200]
+    python benchmarks.py compressed-text [--docs 200]
+    python benchmarks.py retrieval [--pages 500]
+    python benchmarks.py structured-analysis [--docs 20] [--stub-latency-ms 100]
+    python benchmarks.py keyword-tags [--docs 200]
+    python benchmarks.py fulltext-search [--docs 10000]
+    python benchmarks.py fuzzy-search [--docs 100000]
+    python benchmarks.py facets [--docs 100000]
+    python benchmarks.py search-cache [--docs 100000]
+    python benchmarks.py semantic-search [--docs 100000]
+    python benchmarks.py recommendations [--docs 1000]
+    python benchmarks.py suggest [--docs 100000]
+    python benchmarks.py shared-search [--docs 50000] [--shares 5000]
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+# Point the app at a temporary database before it is imported
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_path
+os.environ['SUGGEST_INDEX_PATH'] = _db_path + '.suggest'
+os.environ['SEMANTIC_MODEL_PATH'] = _db_path + '.semantic.npz'
+
+from sqlalchemy import inspect
+
+import app as app_module
+from app import app, db, Document, User, DocumentChunkIndex, chunk_index_cache, retrieve_document_context, estimate_tokens
+
+WORDS = (
+    'energy entropy enthalpy equilibrium reaction kinetics catalyst molecule '
+    'vector matrix integral derivative theorem proof lemma function limit '
+    'cell protein enzyme membrane genome mutation species evolution '
+    'algorithm recursion complexity graph tree queue stack compiler'
+).split()
+
+
+def fake_text(n_words, rng):
+    """Return n_words of pseudo-academic filler text."""
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def prose_corpus(n_docs, doc_chars=100_000, seed=42):
+    """Build realistic English documents by stitching together the repo's markdown guides."""
+    rng = random.Random(seed)
+    sources = []
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.md'))):
+        with open(path, encoding='utf-8', errors='ignore') as f:
+            sources.append(f.read())
+    docs = []
+    for _ in range(n_docs):
+        parts = []
+        length = 0
+        while length < doc_chars:
+            part = rng.choice(sources)
+            parts.append(part)
+            length += len(part)
+        docs.append(''.join(parts)[:doc_chars])
+    return docs
+
+
+def zipf_vocabulary():
+    """Words of the repo's markdown guides, most frequent first (a realistic long-tail vocabulary)."""
+    counts = Counter()
+    for path in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.md')):
+        with open(path, encoding='utf-8', errors='ignore') as f:
+            counts.update(w for w in re.findall(r'[a-z]{3,}', f.read().lower()))
+    return [word for word, _ in counts.most_common()]
+
+
+def seed_documents(n_docs, text_words=15000, seed=42):
+    """Create a user with n_docs analyzed documents and return the user id."""
+    rng = random.Random(seed)
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    db.session.add(user)
+    db.session.commit()
+    for i in range(n_docs):
+        db.session.add(Document(
+            user_id=user.id,
+            original_filename=f'chapter_{i}.pdf',
+            stored_filename=f'bench_{i}.pdf',
+            year=1 + i % 4,
+            subject=rng.choice(['Physics', 'Chemistry', 'Mathematics', 'Biology']),
+            tags='bench',
+            mimetype='application/pdf',
+            size=1024 * (i + 1),
+            extracted_text=fake_text(text_words, rng),
+            summary=fake_text(80, rng),
+            content_vector=bytes(8 + 4 * 128),  # Model id + 128 float32 values
+        ))
+    db.session.commit()
+    return user.id
+
+
+def loaded_bytes(documents):
+    """Sum the size of every column value the ORM actually loaded."""
+    total = 0
+    for doc in documents:
+        for value in inspect(doc).dict.values():
+            if isinstance(value, str):
+                total += len(value.encode('utf-8'))
+            elif isinstance(value, (int, float)):
+                total += 8
+    return total
+
+
+def bench_deferred_columns(args):
+    """Bytes fetched and time per year-view page, with and without deferral."""
+    user_id = seed_documents(args.docs)
+    per_page = 10
+
+    def page_query(eager_content):
+        q = Document.query.filter_by(year=1, user_id=user_id)
+        if eager_content:
+            # Behaviour before the heavy columns were deferred
+            q = q.options(db.undefer_group('content'))
+        return q.order_by(Document.upload_date.desc()).limit(per_page)
+
+    for label, eager in (('before (all columns)', True), ('after (deferred)', False)):
+        timings = []
+        size = 0
+        for _ in range(args.repeat):
+            db.session.expunge_all()
+            start = time.perf_counter()
+            docs = page_query(eager).all()
+            timings.append(time.perf_counter() - start)
+            size = loaded_bytes(docs)
+        timings.sort()
+        print(f"{label:24s} {size / 1024:10.1f} KiB/page   median {timings[len(timings) // 2] * 1000:7.2f} ms")
+
+
+def bench_compressed_text(args):
+    """Database size and read/write latency for plain vs. compressed extracted_text."""
+    texts = prose_corpus(args.docs)
+    raw_size = sum(len(t.encode('utf-8')) for t in texts)
+    print(f"corpus: {len(texts)} documents, {raw_size / 1024 / 1024:.1f} MiB of text")
+
+    for label, compress in (('plain', False), ('compressed', True)):
+        app.config['COMPRESS_TEXT_COLUMNS'] = compress
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+        db.session.add(user)
+        db.session.commit()
+
+        start = time.perf_counter()
+        for i, text in enumerate(texts):
+            db.session.add(Document(
+                user_id=user.id, original_filename=f'book_{i}.pdf', stored_filename=f'bench_{i}.pdf',
+                year=1, subject='Physics', mimetype='application/pdf', extracted_text=text,
+            ))
+        db.session.commit()
+        write_ms = (time.perf_counter() - start) * 1000
+
+        db.session.execute(db.text('VACUUM'))
+        file_size = os.path.getsize(_db_path)
+
+        timings = []
+        for _ in range(args.repeat):
+            db.session.expunge_all()
+            start = time.perf_counter()
+            docs = Document.query.options(db.undefer(Document.extracted_text)).limit(10).all()
+            sum(len(d.extracted_text) for d in docs)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{label:11s} db file {file_size / 1024 / 1024:7.2f} MiB   "
+              f"insert all {write_ms:8.1f} ms   read 10 docs median {timings[len(timings) // 2] * 1000:6.2f} ms")
+
+
+def bench_retrieval(args):
+    """Chunk index build time (once per document) and per-question retrieval latency for a long book."""
+    text = prose_corpus(1, doc_chars=args.pages * 3000)[0]
+    rng = random.Random(7)
+    words = [w for w in text.split() if w.isalpha() and len(w) > 4]
+    questions = [' '.join(rng.sample(words, 6)) + '?' for _ in range(args.repeat)]
+    book = SimpleNamespace(id=1, last_analyzed=None, extracted_text=text)
+    
+    start = time.perf_counter()
+    index = DocumentChunkIndex(text)
+    build_ms = (time.perf_counter() - start) * 1000
+    print(f"book: {args.pages} pages, {len(text) / 1024 / 1024:.1f} MiB, {len(index.chunks)} chunks, "
+          f"{len(index.vocabulary)} terms; index build {build_ms:.0f} ms")
+    
+    chunk_index_cache.clear()
+    retrieve_document_context(book, questions[0], char_budget=3200)  # warm the cache
+    timings = []
+    for question in questions:
+        start = time.perf_counter()
+        retrieve_document_context(book, question, char_budget=3200)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"retrieve top chunks per question: median {timings[len(timings) // 2] * 1000:.2f} ms, "
+          f"max {timings[-1] * 1000:.2f} ms")
+
+
+class CountingStubModel:
+    """Deterministic stand-in for the Gemini model: fixed round-trip latency, token accounting."""
+    
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+    
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        if generation_config and generation_config.get('response_mime_type') == 'application/json':
+            text = json.dumps({
+                'summary': 'A concise overview of the document. ' * 8,
+                'tags': ['storage', 'search', 'analysis', 'documents', 'ai'],
+                'key_terms': ['full-text search', 'smart tags', 'OCR'],
+            })
+        elif prompt.startswith('Summarize'):
+            text = 'A concise overview of the document. ' * 8
+        else:
+            text = 'storage, search, analysis, documents, ai'
+        self.calls += 1
+        self.tokens_in += estimate_tokens(prompt)
+        self.tokens_out += estimate_tokens(text)
+        time.sleep(self.latency)
+        return SimpleNamespace(text=text)
+
+
+def bench_structured_analysis(args):
+    """Calls, tokens and latency per document: separate summary + tags calls vs. one structured call."""
+    texts = prose_corpus(args.docs, doc_chars=20000)
+    app_module.llm_rate_limiter = app_module.TokenBucket(60000)
+    app.config['AI_SUMMARY_HIERARCHICAL'] = False  # compare single-input prompts only
+    print(f"corpus: {len(texts)} documents; stub provider round trip {args.stub_latency_ms} ms")
+    
+    for label, structured in (('two calls', False), ('structured', True)):
+        app.config['AI_STRUCTURED_ANALYSIS'] = structured
+        stub = CountingStubModel(args.stub_latency_ms)
+        app_module.gemini_model = stub
+        timings = []
+        for text in texts:
+            start = time.perf_counter()
+            app_module.generate_analysis(text, 'Computer Science', use_cache=False)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{label:11s} {stub.calls / len(texts):4.1f} calls/doc   "
+              f"{stub.tokens_in / len(texts):7.0f} tokens in/doc   {stub.tokens_out / len(texts):5.0f} tokens out/doc   "
+              f"median {timings[len(timings) // 2] * 1000:6.1f} ms/doc")
+
+
+def nltk_keyword_tags(text, count=5, tokenize=None):
+    """The previous local tagger: NLTK word_tokenize over the whole text, then raw frequency."""
+    from nltk.tokenize import word_tokenize
+    words = (tokenize or word_tokenize)(text.lower())
+    words = [w for w in words if w.isalnum() and w not in app_module.stop_words and len(w) > 3]
+    return [word for word, _ in Counter(words).most_common(count)]
+
+
+def bench_keyword_tags(args):
+    """Local smart-tag latency per document: NLTK tokenize + frequency vs. regex candidates + library IDF."""
+    texts = prose_corpus(args.docs, doc_chars=50_000)
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    db.session.add(user)
+    db.session.commit()
+    
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        app_module.update_keyword_stats(user.id, text, 1)
+        db.session.add(Document(user_id=user.id, original_filename=f'doc_{i}.pdf', stored_filename=f'bench_{i}.pdf', year=1,
+                                subject='Physics', mimetype='application/pdf', last_analyzed=app_module.datetime.utcnow()))
+    db.session.commit()
+    print(f"library: {len(texts)} documents of 50k chars; IDF statistics built in "
+          f"{(time.perf_counter() - start) * 1000 / len(texts):.2f} ms/doc")
+    
+    try:
+        nltk_keyword_tags('warm up.')
+        old_path = ('nltk + freq', nltk_keyword_tags)
+    except LookupError:
+        # word_tokenize = punkt sentence split + Treebank tokenizer; time the Treebank half as a lower bound
+        from nltk.tokenize import NLTKWordTokenizer
+        print("nltk punkt data is not installed (the old path silently returned no tags); "
+              "timing its Treebank tokenizer alone")
+        old_path = ('nltk + freq', lambda text: nltk_keyword_tags(text, tokenize=NLTKWordTokenizer().tokenize))
+    
+    paths = [old_path, ('regex + idf', lambda text: app_module.keyword_tags(text, count=5, user_id=user.id))]
+    for label, tagger in paths:
+        timings = []
+        for text in texts[:args.repeat]:
+            start = time.perf_counter()
+            tags = tagger(text)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{label:12s} median {timings[len(timings) // 2] * 1000:7.2f} ms/doc   e.g. {tags}")
+
+
+def bench_fulltext_search(args):
+    """Search latency over a large library: LIKE scan vs. the full-text index (FTS5 / tsvector)."""
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    
+    start = time.perf_counter()
+    for first in range(0, args.docs, 1000):
+        for i in range(first, min(first + 1000, args.docs)):
+            words = rng.choices(vocabulary, weights, k=300)
+            db.session.add(Document(
+                user_id=user_id, original_filename=f'{words[0]}_{i}.pdf', stored_filename=f'bench_{i}.pdf',
+                year=1 + i % 4, subject=rng.choice(['Physics', 'Chemistry', 'Mathematics', 'Biology']),
+                mimetype='application/pdf', summary=' '.join(words[:40]), extracted_text=' '.join(words),
+            ))
+        db.session.commit()
+        db.session.expunge_all()
+    print(f"library: {args.docs} documents of 300 words; insert + index {(time.perf_counter() - start) * 1000 / args.docs:.2f} ms/doc")
+    
+    # Rare, mid-frequency and common words, a two-word query and a typeahead prefix
+    queries = [vocabulary[2000], vocabulary[300], vocabulary[20], f"{vocabulary[150]} {vocabulary[400]}", vocabulary[500][:4]]
+    index_key = str(db.engine.url)
+    for label, use_index in (('LIKE scan', False), ('full-text index', True)):
+        app_module.search_index_state[index_key] = use_index
+        for query in queries:
+            timings = []
+            for _ in range(args.repeat if use_index else max(3, args.repeat // 5)):
+                db.session.expunge_all()
+                start = time.perf_counter()
+                results = app_module.search_documents_fulltext(query, user_id)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{label:16s} {query!r:28s} {len(results):3d} results   median {timings[len(timings) // 2] * 1000:8.2f} ms")
+
+
+def bench_facets(args):
+    """Facet counts for a search: one GROUP BY query per facet vs. document_facets' single grouped query."""
+    from app import Tag, document_tags
+    app.config['SEARCH_CACHE_MAX_ENTRIES'] = 0  # Time the counting itself, not the result cache
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    tags = [Tag(name=word, slug=word) for word in vocabulary[:50]]
+    db.session.add_all([user] + tags)
+    db.session.commit()
+    user_id, tag_ids = user.id, [tag.id for tag in tags]
+    subjects = ['Physics', 'Chemistry', 'Mathematics', 'Biology', 'History', 'Economics']
+    mimetypes = ['application/pdf', 'image/png', 'text/plain']
+    for first in range(0, args.docs, 1000):
+        batch = []
+        for i in range(first, min(first + 1000, args.docs)):
+            words = rng.choices(vocabulary, weights, k=100)
+            batch.append(Document(
+                user_id=user_id, original_filename=f'{words[0]}_{i}.pdf', stored_filename=f'bench_{i}.pdf',
+                year=1 + i % 4, subject=rng.choice(subjects), mimetype=rng.choice(mimetypes),
+                extracted_text=' '.join(words),
+            ))
+        db.session.add_all(batch)
+        db.session.commit()
+        db.session.execute(document_tags.insert(), [{'document_id': doc.id, 'tag_id': tag_id} for doc in batch
+                                                    for tag_id in rng.sample(tag_ids, 3)])
+        db.session.commit()
+        db.session.expunge_all()
+    print(f"library: {args.docs} documents, 3 tags each")
+    
+    def per_facet(query):
+        ids = app_module.document_search_query(query, user_id).with_entities(Document.id).order_by(None).subquery()
+        counts = {}
+        for name, column in (('year', Document.year), ('subject', Document.subject), ('mimetype', Document.mimetype)):
+            counts[name] = db.session.query(column, db.func.count()).filter(Document.id.in_(db.select(ids.c.id)))\
+                .group_by(column).all()
+        counts['tag'] = db.session.query(Tag.slug, db.func.count()).join(document_tags)\
+            .filter(document_tags.c.document_id.in_(db.select(ids.c.id))).group_by(Tag.slug).all()
+        return counts
+    
+    def single_pass(query):
+        return app_module.document_facets(app_module.document_search_query(query, user_id).with_entities(Document.id))
+    
+    for label, count_facets in (('query per facet', per_facet), ('one grouped query', single_pass)):
+        for query in (vocabulary[2000], vocabulary[300], vocabulary[20]):
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                count_facets(query)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{label:18s} {query!r:18s} median {timings[len(timings) // 2] * 1000:7.2f} ms")
+
+
+def bench_fuzzy_search(args):
+    """Search latency with typo tolerance: exact queries vs. misspelled ones that fall back to trigram matches."""
+    app.config['SEARCH_CACHE_MAX_ENTRIES'] = 0  # Time the search itself, not the result cache
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    
+    start = time.perf_counter()
+    for first in range(0, args.docs, 1000):
+        for i in range(first, min(first + 1000, args.docs)):
+            words = rng.choices(vocabulary, weights, k=300)
+            db.session.add(Document(
+                user_id=user_id, original_filename=f'{words[0]}_{i}.pdf', stored_filename=f'bench_{i}.pdf',
+                year=1 + i % 4, subject='Physics', mimetype='application/pdf',
+                summary=' '.join(words[:40]), extracted_text=' '.join(words),
+            ))
+        db.session.commit()
+        db.session.expunge_all()
+    terms = db.session.execute(db.text("SELECT COUNT(*) FROM search_term")).scalar()
+    print(f"library: {args.docs} documents, {terms} vocabulary words; "
+          f"insert + index {(time.perf_counter() - start) * 1000 / args.docs:.2f} ms/doc")
+    
+    def typo(word):
+        """Swap two letters in the middle, the most common kind of typo."""
+        i = len(word) // 2
+        return word[:i - 1] + word[i] + word[i - 1] + word[i + 1:]
+    
+    common = next(w for w in vocabulary[50:] if len(w) >= 7)
+    rare = next(w for w in vocabulary[1500:] if len(w) >= 7)
+    queries = [('exact, many hits', common), ('exact, few hits', rare),
+               ('typo, common word', typo(common)), ('typo, rare word', typo(rare)),
+               ('no match', 'qzxvbnmk')]
+    for label, query in queries:
+        timings = []
+        for _ in range(args.repeat):
+            db.session.expunge_all()
+            start = time.perf_counter()
+            pagination, _, corrections = app_module.search_documents_page(query, user_id)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{label:18s} {query!r:18s} {pagination.total:6d} results {str(corrections)[:40]:42s} "
+              f"median {timings[len(timings) // 2] * 1000:7.2f} ms")
+
+
+def bench_search_cache(args):
+    """Paging through results and polling page 1: re-running the ranked search vs. slicing cached ids."""
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    for first in range(0, args.docs, 1000):
+        for i in range(first, min(first + 1000, args.docs)):
+            words = rng.choices(vocabulary, weights, k=300)
+            db.session.add(Document(
+                user_id=user_id, original_filename=f'{words[0]}_{i}.pdf', stored_filename=f'bench_{i}.pdf',
+                year=1, subject='Physics', mimetype='application/pdf',
+                summary=' '.join(words[:40]), extracted_text=' '.join(words),
+            ))
+        db.session.commit()
+        db.session.expunge_all()
+    print(f"library: {args.docs} documents of 300 words")
+    
+    queries = [vocabulary[2000], vocabulary[300], vocabulary[20]]
+    entries = app.config['SEARCH_CACHE_MAX_ENTRIES']
+    for label, max_entries in (('no cache', 0), ('result cache', entries)):
+        app.config['SEARCH_CACHE_MAX_ENTRIES'] = max_entries
+        app_module.search_result_cache.clear()
+        for query in queries:
+            timings = []
+            for _ in range(args.repeat):
+                for page in (1, 2, 3, 4, 5, 1):  # Page through, then back to the first page (polling)
+                    db.session.expunge_all()
+                    start = time.perf_counter()
+                    pagination = app_module.search_documents_page(query, user_id, page=page)[0]
+                    timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{label:13s} {query!r:18s} {pagination.total:6d} results   "
+                  f"median {timings[len(timings) // 2] * 1000:7.2f} ms   p99 {timings[int(len(timings) * 0.99)] * 1000:7.2f} ms")
+    
+    # What invalidation costs: one generation bump per write
+    start = time.perf_counter()
+    for i in range(100):
+        db.session.add(Document(user_id=user_id, original_filename=f'new_{i}.pdf', stored_filename=f'new_{i}.pdf',
+                                year=1, subject='Physics'))
+        db.session.commit()
+    print(f"insert + index + generation bump: {(time.perf_counter() - start) * 10:.2f} ms/doc")
+
+
+def bench_semantic_search(args):
+    """Semantic search: embedding cost, vector size vs. JSON, and query latency of the exact scan vs. the IVF index."""
+    from app import SemanticModel, semantic_index_cache
+    app.config['SEARCH_CACHE_MAX_ENTRIES'] = 0  # Time the ranking itself, not the result cache
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    # Topical documents: each draws most words from one of 40 topic vocabularies
+    topics = [rng.sample(vocabulary[100:3000], 60) for _ in range(40)]
+    texts = [' '.join(rng.choices(topics[i % 40], k=200) + rng.choices(vocabulary, weights, k=100))
+             for i in range(args.docs)]
+    
+    start = time.perf_counter()
+    model = SemanticModel.fit(rng.sample(texts, min(len(texts), 5000)))
+    model.save(app.config['SEMANTIC_MODEL_PATH'])
+    print(f"fit {model.dimensions}-dimension model on {min(len(texts), 5000)} documents: "
+          f"{time.perf_counter() - start:.2f} s")
+    
+    start = time.perf_counter()
+    for first in range(0, args.docs, 1000):
+        for i in range(first, min(first + 1000, args.docs)):
+            db.session.add(Document(user_id=user_id, original_filename=f'doc_{i}.txt', stored_filename=f'bench_{i}.txt',
+                                    year=1, subject='General', extracted_text=texts[i]))
+        db.session.commit()
+        db.session.expunge_all()
+    print(f"library: {args.docs} documents; insert + index + embed {(time.perf_counter() - start) * 1000 / args.docs:.2f} ms/doc")
+    vector = db.session.execute(db.select(Document.content_vector).limit(1)).scalar()
+    as_json = json.dumps([round(float(x), 6) for x in app_module.np.frombuffer(vector[8:], dtype='<f4')])
+    print(f"stored vector: {len(vector)} bytes (JSON would be {len(as_json)} bytes)")
+    
+    queries = [' '.join(rng.sample(topics[t], 3)) for t in range(5)]
+    for label, ann_min in (('exact scan', args.docs + 1), ('IVF index', 2)):
+        app.config['SEMANTIC_ANN_MIN_DOCUMENTS'] = ann_min
+        semantic_index_cache.clear()
+        start = time.perf_counter()
+        app_module.semantic_search_ids(queries[0], user_id)
+        print(f"{label}: first query (load matrix) {(time.perf_counter() - start) * 1000:.0f} ms")
+        if ann_min == 2:
+            app_module.semantic_executor.submit(lambda: None).result()  # Wait for the background k-means fit
+            print(f"{label}: load matrix + background cluster {(time.perf_counter() - start) * 1000:.0f} ms")
+        timings = []
+        overlap = []
+        for _ in range(args.repeat):
+            for query in queries:
+                start = time.perf_counter()
+                ids = app_module.semantic_search_ids(query, user_id, limit=10)
+                timings.append(time.perf_counter() - start)
+                overlap.append(ids)
+        timings.sort()
+        print(f"{label:11s} median {timings[len(timings) // 2] * 1000:7.2f} ms   p99 {timings[int(len(timings) * 0.99)] * 1000:7.2f} ms")
+        if ann_min == 2:
+            doc = Document.query.filter_by(user_id=user_id).first()
+            doc.extracted_text += ' revised'  # Re-embedded, bumps the generation
+            db.session.commit()
+            start = time.perf_counter()
+            app_module.semantic_search_ids(queries[0], user_id)
+            print(f"{label}: first query after an edit (reuses the centroids) "
+                  f"{(time.perf_counter() - start) * 1000:.0f} ms")
+            app.config['SEMANTIC_ANN_MIN_DOCUMENTS'] = args.docs + 1
+            semantic_index_cache.clear()
+            exact = [app_module.semantic_search_ids(query, user_id, limit=10) for query in queries]
+            recall = sum(len(set(a) & set(b)) for a, b in zip(overlap, exact)) / max(sum(len(b) for b in exact), 1)
+            print(f"IVF recall@10 vs. exact scan: {recall:.2f}")
+
+
+def bench_recommendations(args):
+    """Recommendations: refitting TF-IDF on every request vs. the stored per-user model and vectors."""
+    from app import TfidfWeights, get_document_recommendations, recommendation_cache
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    user = User(email='bench@example.com', name='Bench', google_id='bench-google-id')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    topics = [rng.sample(vocabulary[100:3000], 60) for _ in range(40)]
+    for first in range(0, args.docs, 1000):
+        for i in range(first, min(first + 1000, args.docs)):
+            words = rng.choices(topics[i % 40], k=1000) + rng.choices(vocabulary, weights, k=2000)
+            db.session.add(Document(user_id=user_id, original_filename=f'doc_{i}.txt', stored_filename=f'bench_{i}.txt',
+                                    year=1, subject='General', extracted_text=' '.join(words)))
+        db.session.commit()
+        db.session.expunge_all()
+    doc_ids = db.session.execute(db.select(Document.id).order_by(Document.id)).scalars().all()
+    print(f"library: {args.docs} documents of 3000 words")
+    
+    def refit_per_request(document_id, count=5):
+        # The previous implementation: load every analyzed document and fit a new vectorizer
+        docs = Document.query.filter(Document.user_id == user_id, Document.extracted_text.isnot(None)).all()
+        matrix = TfidfWeights.fit([doc.extracted_text for doc in docs])[1]
+        position = next(i for i, doc in enumerate(docs) if doc.id == document_id)
+        similarities = app_module.cosine_similarity(matrix[position:position + 1], matrix)[0]
+        similarities[position] = -1
+        return [docs[i] for i in similarities.argsort()[-count:][::-1] if similarities[i] > 0.1]
+    
+    def timed(label, function, repeat):
+        timings = []
+        for n in range(repeat):
+            db.session.expunge_all()
+            start = time.perf_counter()
+            function(doc_ids[n % len(doc_ids)])
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{label:32s} median {timings[len(timings) // 2] * 1000:8.2f} ms   max {timings[-1] * 1000:8.2f} ms")
+    
+    timed('refit per request (before)', refit_per_request, min(args.repeat, 5))
+    timed('first request: fit + store', get_document_recommendations, 1)
+    timed('stored model, in memory', get_document_recommendations, args.repeat)
+    
+    def cold(document_id):
+        recommendation_cache.clear()
+        get_document_recommendations(document_id)
+    timed('stored model, from database', cold, args.repeat)
+    
+    expected = [doc.id for doc in refit_per_request(doc_ids[0])]
+    print(f"same recommendations as a refit: {[doc.id for doc in get_document_recommendations(doc_ids[0])] == expected}")
+    
+    added = iter(range(args.repeat))
+    
+    def add_document(document_id):
+        n = next(added)
+        db.session.add(Document(user_id=user_id, original_filename=f'new_{n}.txt', stored_filename=f'new_{n}.txt', year=1,
+                                subject='General', extracted_text=' '.join(rng.choices(topics[0], k=1000))))
+        db.session.commit()
+        get_document_recommendations(document_id)
+    timed('after a new document (transform)', add_document, args.repeat)
+    
+    app.config['RECOMMENDATIONS_REFIT_DRIFT'] = 0  # What crossing the drift threshold costs, once
+    recommendation_cache.clear()
+    timed('drift threshold crossed: refit', get_document_recommendations, 1)
+
+
+def bench_suggest(args):
+    """Typeahead latency: FTS5 prefix query vs. the mmap'd in-memory index (with a change-log overlay)."""
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    users = [User(email=f'bench{n}@example.com', name='Bench', google_id=f'bench-google-id-{n}') for n in range(2)]
+    db.session.add_all(users)
+    db.session.commit()
+    user_id = users[0].id
+    
+    # Rows are inserted directly (and indexed for FTS below): the ORM would log every insert as a change
+    table = Document.__table__
+    for first in range(0, args.docs, 5000):
+        rows = []
+        for i in range(first, min(first + 5000, args.docs)):
+            words = rng.choices(vocabulary, weights, k=40)
+            rows.append(dict(
+                user_id=users[i % 10 == 0].id, original_filename=f'{words[0]}_{words[1]}_{i}.pdf',
+                stored_filename=f'bench_{i}.pdf', year=1 + i % 4,
+                subject=rng.choice(['Physics', 'Chemistry', 'Mathematics', 'Biology']),
+                tags=', '.join(words[2:5]), summary=' '.join(words[5:]), upload_date=app_module.datetime.utcnow(),
+            ))
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+    db.session.execute(db.text(
+        "INSERT INTO document_fts (rowid, filename, subject, tags, summary, body) "
+        "SELECT id, original_filename, subject, tags, summary, '' FROM document"
+    ))
+    db.session.commit()
+    
+    start = time.perf_counter()
+    app_module.build_suggest_snapshot(app.config['SUGGEST_INDEX_PATH'])
+    size = os.path.getsize(app.config['SUGGEST_INDEX_PATH'])
+    print(f"snapshot: {args.docs} documents, {size / 1024 / 1024:.1f} MiB, built in {time.perf_counter() - start:.1f} s")
+    
+    # Documents edited after the snapshot are served from the overlay
+    for doc in Document.query.filter_by(user_id=user_id).limit(min(500, args.docs // 10)).all():
+        doc.subject = rng.choice(vocabulary[:200])
+    db.session.commit()
+    
+    # Keystroke-by-keystroke prefixes of common, mid-frequency and rare words, and a two-word query
+    typed = [vocabulary[5], vocabulary[150], vocabulary[2000], f"{vocabulary[40]} {vocabulary[90]}"]
+    queries = [word[:n] for word in typed for n in range(2, len(word) + 1)]
+    
+    def measure(label, fn):
+        timings = []
+        for _ in range(args.repeat):
+            for query in queries:
+                start = time.perf_counter()
+                fn(query)
+                timings.append(time.perf_counter() - start)
+        timings.sort()
+        p50, p99 = timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+        print(f"{label:24s} {len(timings):5d} keystrokes   p50 {p50 * 1000:7.2f} ms   p99 {p99 * 1000:7.2f} ms")
+    
+    measure('FTS5 prefix query', lambda q: app_module.search_documents_fulltext(q, user_id, limit=8))
+    app_module.get_suggest_index()
+    app.config['SUGGEST_REFRESH_SECONDS'] = 3600  # Steady state: the change-log poll runs once a second
+    measure('suggest index', lambda q: app_module.suggest_documents(user_id, q, 8))
+    app.config['SUGGEST_REFRESH_SECONDS'] = 0
+    measure('suggest + log poll', lambda q: app_module.suggest_documents(user_id, q, 8))
+    os.remove(app.config['SUGGEST_INDEX_PATH'])
+
+
+def bench_shared_search(args):
+    """Search for a user with thousands of shares: OR over share subqueries vs. the document_access index."""
+    from app import Collection, SharePermission, document_collections, rebuild_document_access
+    app.config['SEARCH_CACHE_MAX_ENTRIES'] = 0  # Time the search itself, not the result cache
+    rng = random.Random(42)
+    vocabulary = zipf_vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    owners = [User(email=f'owner{n}@example.com', name='Owner', google_id=f'owner-{n}') for n in range(50)]
+    reader = User(email='reader@example.com', name='Reader', google_id='reader')
+    db.session.add_all(owners + [reader])
+    db.session.commit()
+    reader_id = reader.id
+    owner_ids = [owner.id for owner in owners]
+    
+    # Rows are inserted directly and the indexes rebuilt once, as the migrations do
+    table = Document.__table__
+    for first in range(0, args.docs, 5000):
+        db.session.execute(table.insert(), [dict(
+            user_id=(reader if i % 50 == 0 else owners[i % 50]).id, original_filename=f'notes_{i}.pdf',
+            stored_filename=f'bench_{i}.pdf', year=1, subject='Physics', upload_date=app_module.datetime.utcnow(),
+            summary=' '.join(rng.choices(vocabulary, weights, k=60)),
+        ) for i in range(first, min(first + 5000, args.docs))])
+    db.session.commit()
+    doc_ids = [row[0] for row in db.session.execute(db.select(Document.id).where(Document.user_id != reader_id))]
+    rng.shuffle(doc_ids)
+    
+    direct, members = doc_ids[:args.shares], doc_ids[args.shares:args.shares * 2]
+    collections = [Collection(name=f'c{n}', user_id=owners[n].id) for n in range(20)]
+    db.session.add_all(collections)
+    db.session.commit()
+    db.session.execute(document_collections.insert(), [
+        {'document_id': doc_id, 'collection_id': collections[n % 20].id} for n, doc_id in enumerate(members)
+    ])
+    db.session.execute(SharePermission.__table__.insert(), [
+        {'shared_by_id': owners[0].id, 'shared_with_id': reader_id, 'document_id': doc_id, 'permission': 'viewer'}
+        for doc_id in direct
+    ])
+    db.session.execute(SharePermission.__table__.insert(), [
+        {'shared_by_id': c.user_id, 'shared_with_id': reader_id, 'collection_id': c.id, 'permission': 'viewer'}
+        for c in collections
+    ])
+    db.session.execute(db.text(
+        "INSERT INTO document_fts (rowid, filename, subject, tags, summary, body) "
+        "SELECT id, original_filename, subject, '', summary, '' FROM document"
+    ))
+    db.session.commit()
+    start = time.perf_counter()
+    with db.engine.begin() as connection:
+        rebuild_document_access(connection)
+    accessible = db.session.query(app_module.DocumentAccess).filter_by(user_id=reader_id).count()
+    print(f"library: {args.docs} documents; reader owns {args.docs // 50}, has {args.shares} direct shares and "
+          f"20 shared collections ({accessible} readable); index rebuilt in {time.perf_counter() - start:.2f} s")
+    
+    shared = db.select(SharePermission.document_id).where(SharePermission.shared_with_id == reader_id)
+    via_collection = db.select(document_collections.c.document_id).join(
+        SharePermission, SharePermission.collection_id == document_collections.c.collection_id
+    ).where(SharePermission.shared_with_id == reader_id)
+    naive_filter = db.or_(Document.user_id == reader_id, Document.id.in_(shared), Document.id.in_(via_collection))
+    
+    def naive_search(query):
+        matches = db.text(app_module.search_rank_sql()).bindparams(match=app_module.search_match_query(query))\
+            .columns(id=db.Integer, rank=db.Float).subquery('matches')
+        return Document.query.filter(naive_filter).join(matches, matches.c.id == Document.id)\
+            .order_by(matches.c.rank).paginate(page=1, per_page=10, error_out=False)
+    
+    def indexed_search(query):
+        return app_module.search_documents_page(query, reader_id)[0]
+    
+    queries = [vocabulary[2000], vocabulary[300], vocabulary[20], f"{vocabulary[150]} {vocabulary[400]}"]
+    for label, search in (('OR over shares', naive_search), ('access index', indexed_search)):
+        for query in queries:
+            timings = []
+            for _ in range(args.repeat):
+                db.session.expunge_all()
+                start = time.perf_counter()
+                page = search(query)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{label:16s} {query!r:28s} {page.total:5d} results   median {timings[len(timings) // 2] * 1000:8.2f} ms")
+    
+    # Maintenance cost: sharing / revoking a 1,000-document collection and a single document
+    big = Collection(name='big', user_id=owner_ids[1])
+    db.session.add(big)
+    db.session.commit()
+    db.session.execute(document_collections.insert(), [{'document_id': d, 'collection_id': big.id} for d in doc_ids[-1000:]])
+    db.session.commit()
+    for label, kwargs in (('share 1 document', {'document_id': doc_ids[-2000]}), ('share 1,000-doc collection', {'collection_id': big.id})):
+        start = time.perf_counter()
+        share = SharePermission(shared_by_id=owner_ids[1], shared_with_id=reader_id, **kwargs)
+        db.session.add(share)
+        db.session.commit()
+        granted = time.perf_counter() - start
+        start = time.perf_counter()
+        db.session.delete(share)
+        db.session.commit()
+        print(f"{label:28s} grant {granted * 1000:7.2f} ms   revoke {(time.perf_counter() - start) * 1000:7.2f} ms")
+
+
+BENCHMARKS = {
+    'compressed-text': bench_compressed_text,
+    'deferred-columns': bench_deferred_columns,
+    'facets': bench_facets,
+    'fulltext-search': bench_fulltext_search,
+    'fuzzy-search': bench_fuzzy_search,
+    'keyword-tags': bench_keyword_tags,
+    'recommendations': bench_recommendations,
+    'retrieval': bench_retrieval,
+    'search-cache': bench_search_cache,
+    'semantic-search': bench_semantic_search,
+    'shared-search': bench_shared_search,
+    'structured-analysis': bench_structured_analysis,
+    'suggest': bench_suggest,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--docs', type=int, default=200, help='number of synthetic documents')
+    parser.add_argument('--stub-latency-ms', type=int, default=100, help='simulated LLM round trip')
+    parser.add_argument('--pages', type=int, default=500, help='book length for the retrieval benchmark')
+    parser.add_argument('--repeat', type=int, default=20, help='repetitions per measurement')
+    parser.add_argument('--shares', type=int, default=5000, help='direct shares for the shared-search benchmark')
+    args = parser.parse_args()
+
+    try:
+        with app.app_context():
+            db.create_all()
+            BENCHMARKS[args.benchmark](args)
+            db.session.remove()
+    finally:
+        os.close(_db_fd)
+        os.unlink(_db_path)
+        if os.path.exists(os.environ['SEMANTIC_MODEL_PATH']):
+            os.unlink(os.environ['SEMANTIC_MODEL_PATH'])
+
+
+if __name__ == '__main__':
+    main()
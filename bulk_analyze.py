@@ -0,0 +1,78 @@
+"""
+Bulk AI analysis of every document that has never been analyzed (last_analyzed IS NULL).
+Text extraction runs on a process pool; LLM calls share the app's token-bucket rate limiter
+(GEMINI_RPM, AI_MAX_CONCURRENT_CALLS) and back off exponentially on 429 responses.
+Progress is stored in the analysis_run table, so an interrupted run can be resumed.
+
+Usage:
+    python bulk_analyze.py [--user-id ID] [--workers N] [--llm-workers N] [--batch-size 20]
+                           [--limit N] [--resume RUN_ID] [--force]
+"""
+import argparse
+import sys
+
+from app import app, db, AnalysisRun, pending_analysis_query, run_bulk_analysis
+
+
+def print_progress(run):
+    rate = f"{run.docs_per_minute:.1f} docs/min" if run.docs_per_minute else "-"
+    print(f"  … {run.processed}/{run.total} processed "
+          f"({run.succeeded} ok, {run.failed} failed) at {rate}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze all unanalyzed documents.')
+    parser.add_argument('--user-id', type=int, default=None, help='only this user\'s documents')
+    parser.add_argument('--workers', type=int, default=None, help='text extraction processes (0 = inline)')
+    parser.add_argument('--llm-workers', type=int, default=None, help='concurrent LLM requests')
+    parser.add_argument('--batch-size', type=int, default=20, help='documents committed per batch')
+    parser.add_argument('--limit', type=int, default=None, help='stop after this many documents')
+    parser.add_argument('--resume', type=int, default=None, metavar='RUN_ID', help='continue an earlier run')
+    parser.add_argument('--force', action='store_true', help='bypass the LLM response cache')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Bulk Document Analysis")
+    print("=" * 60)
+
+    with app.app_context():
+        db.create_all()
+
+        if args.resume:
+            run = AnalysisRun.query.get(args.resume)
+            if not run:
+                print(f"✗ Analysis run {args.resume} not found")
+                sys.exit(1)
+            print(f"Resuming run {run.id} after document id {run.last_document_id}")
+        else:
+            run = AnalysisRun(user_id=args.user_id)
+            db.session.add(run)
+            db.session.commit()
+            pending = pending_analysis_query(args.user_id).count()
+            print(f"Started run {run.id}: {pending} documents pending")
+
+        try:
+            run = run_bulk_analysis(
+                run.id,
+                extract_workers=args.workers,
+                llm_workers=args.llm_workers,
+                batch_size=args.batch_size,
+                limit=args.limit,
+                use_cache=not args.force,
+                progress=print_progress,
+            )
+        except KeyboardInterrupt:
+            db.session.rollback()
+            interrupted = AnalysisRun.query.get(run.id)
+            interrupted.status = 'failed'
+            interrupted.error = 'interrupted'
+            db.session.commit()
+            print(f"\n⚠ Interrupted - resume with: python bulk_analyze.py --resume {run.id}")
+            sys.exit(130)
+
+        print(f"\n✅ Run {run.id} {run.status}: {run.succeeded} analyzed, {run.failed} failed, "
+              f"{run.docs_per_minute or 0:.1f} docs/minute")
+
+
+if __name__ == '__main__':
+    main()
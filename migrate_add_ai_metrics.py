@@ -0,0 +1,25 @@
+"""
+Migration script to add the ai_call_metric table (per-call AI latency / token metrics).
+Run this once to update your existing database.
+"""
+from app import app, db
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            print("Starting migration to add AI call metrics...")
+            
+            # Create all tables defined in models (existing tables are left untouched)
+            db.create_all()
+            
+            print("✓ Migration completed successfully!")
+            print("✓ Added tables:")
+            print("  - ai_call_metric (latency, tokens and outcome of every AI call)")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
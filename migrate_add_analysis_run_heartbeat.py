@@ -0,0 +1,35 @@
+"""
+Migration script to add the updated_at heartbeat column to the analysis_run table.
+Bulk analysis runs whose heartbeat is older than BULK_ANALYSIS_STALE_MINUTES are marked
+failed, so a run whose process crashed can be resumed instead of blocking new runs.
+Run this once to update your existing database.
+"""
+from app import app, db
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            inspector = db.inspect(db.engine)
+            if 'analysis_run' not in inspector.get_table_names():
+                db.create_all()
+                print("✓ Migration successful! analysis_run table created.")
+                return
+            
+            columns = [column['name'] for column in inspector.get_columns('analysis_run')]
+            if 'updated_at' not in columns:
+                print("Adding updated_at column to analysis_run table...")
+                with db.engine.begin() as conn:
+                    conn.execute(db.text('ALTER TABLE analysis_run ADD COLUMN updated_at TIMESTAMP'))
+                    # Existing 'running' rows get no heartbeat, so they count as stale right away
+                    conn.execute(db.text("UPDATE analysis_run SET updated_at = finished_at WHERE status != 'running'"))
+                print("✓ Migration successful! updated_at column added.")
+            else:
+                print("updated_at column already exists. No migration needed.")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
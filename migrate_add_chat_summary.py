@@ -0,0 +1,35 @@
+"""
+Migration script to add rolling-summary columns to ChatSession and an index on ChatMessage.session_id.
+Run this once to update your existing database.
+"""
+from app import app, db
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            print("Starting migration to add chat history summaries...")
+            
+            inspector = db.inspect(db.engine)
+            columns = [column['name'] for column in inspector.get_columns('chat_session')]
+            
+            with db.engine.begin() as conn:
+                if 'history_summary' not in columns:
+                    conn.execute(db.text("ALTER TABLE chat_session ADD COLUMN history_summary TEXT"))
+                    print("✓ Added chat_session.history_summary")
+                if 'summarized_until_id' not in columns:
+                    conn.execute(db.text("ALTER TABLE chat_session ADD COLUMN summarized_until_id INTEGER DEFAULT 0"))
+                    print("✓ Added chat_session.summarized_until_id")
+                conn.execute(db.text(
+                    "CREATE INDEX IF NOT EXISTS ix_chat_message_session_id ON chat_message (session_id)"
+                ))
+                print("✓ Indexed chat_message.session_id")
+            
+            print("✓ Migration completed successfully!")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
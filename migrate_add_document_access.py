@@ -0,0 +1,30 @@
+"""
+Migration script to add the document_access table (maintained index of the documents each user
+can read: owned, shared directly, or shared through a collection) and fill it from existing
+documents and shares. Safe to re-run: the index is rebuilt from scratch.
+"""
+from app import app, db, DocumentAccess, rebuild_document_access
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            print("Starting migration to add the document access index...")
+            
+            # Create all tables defined in models (existing tables are left untouched)
+            db.create_all()
+            
+            with db.engine.begin() as connection:
+                rebuild_document_access(connection)
+            count = DocumentAccess.query.count()
+            
+            print("✓ Migration completed successfully!")
+            print("✓ Added tables:")
+            print(f"  - document_access ({count} rows: owned and shared documents per user)")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
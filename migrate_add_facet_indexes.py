@@ -0,0 +1,28 @@
+"""
+Migration script to add the indexes behind facet counts and filters:
+document (user_id, year, subject), document (user_id, mimetype) and document_tags (tag_id).
+Run this once to update your existing database. Safe to re-run.
+"""
+from app import app, db, Document, document_tags
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            print("Starting migration to add facet indexes...")
+            
+            indexes = list(Document.__table__.indexes) + list(document_tags.indexes)
+            for index in indexes:
+                index.create(db.engine, checkfirst=True)
+            
+            print("✓ Migration completed successfully!")
+            print("✓ Added indexes:")
+            for index in indexes:
+                print(f"  - {index.name}")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,72 @@
+"""
+Migration script to add the typo-tolerance vocabulary (SQLite trigram side table, or a
+pg_trgm GIN index on PostgreSQL) and fill it with the words of existing documents.
+Requires the full-text index (migrate_add_fulltext_index.py). Safe to re-run: known words are skipped.
+
+Usage:
+    python migrate_add_fuzzy_search.py [--batch-size 500]
+"""
+import argparse
+import sys
+
+from app import (
+    app,
+    db,
+    Document,
+    SEARCH_INDEX_COLUMNS,
+    add_search_terms,
+    create_fuzzy_index,
+    search_index_available,
+    search_index_fields,
+)
+
+
+def migrate(batch_size=500):
+    with app.app_context():
+        try:
+            print("Starting migration to add typo-tolerant search...")
+            
+            with db.engine.begin() as connection:
+                if not search_index_available(connection):
+                    print("✗ The full-text index is missing; run migrate_add_fulltext_index.py first")
+                    sys.exit(1)
+                if not create_fuzzy_index(connection):
+                    print(f"✗ Could not create the trigram index on {connection.dialect.name}; search stays exact-only")
+                    sys.exit(1)
+            
+            last_id = 0
+            scanned = 0
+            while True:
+                batch = Document.query.options(db.undefer_group('content')).filter(Document.id > last_id)\
+                    .order_by(Document.id).limit(batch_size).all()
+                if not batch:
+                    break
+                connection = db.session.connection()
+                limit = app.config['SEARCH_INDEX_BODY_CHARS']  # Same text write_search_index indexes
+                for doc in batch:
+                    fields = search_index_fields(connection, doc)
+                    fields['extracted_text'] = fields['extracted_text'][:limit]
+                    add_search_terms(connection, ' '.join(fields[name] for name in SEARCH_INDEX_COLUMNS))
+                db.session.commit()
+                scanned += len(batch)
+                last_id = batch[-1].id
+                db.session.expunge_all()
+                print(f"  … scanned documents up to id {last_id} ({scanned} documents)")
+            
+            words = db.session.execute(db.text("SELECT COUNT(*) FROM search_term")).scalar()
+            print("✓ Migration completed successfully!")
+            print("✓ Added tables:")
+            print(f"  - search_term ({words} words from {scanned} documents)")
+            if db.engine.dialect.name == 'sqlite':
+                print("  - search_trigram (trigram → word lookup)")
+            
+        except SystemExit:
+            raise
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create and backfill the typo-tolerance vocabulary.')
+    parser.add_argument('--batch-size', type=int, default=500, help='documents per transaction')
+    migrate(parser.parse_args().batch_size)
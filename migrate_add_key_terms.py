@@ -0,0 +1,26 @@
+"""
+Migration script to add the key_terms column to the Document table.
+Run this once to update your existing database.
+"""
+from app import app, db
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            columns = [column['name'] for column in db.inspect(db.engine).get_columns('document')]
+            
+            if 'key_terms' not in columns:
+                print("Adding key_terms column to document table...")
+                with db.engine.begin() as conn:
+                    conn.execute(db.text("ALTER TABLE document ADD COLUMN key_terms VARCHAR(1024)"))
+                print("✓ Migration successful! key_terms column added.")
+            else:
+                print("key_terms column already exists. No migration needed.")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,53 @@
+"""
+Migration script to add the keyword_stat table (per-user keyword document frequencies)
+and fill it from documents that were analyzed before it existed.
+Safe to re-run: the statistics are rebuilt from scratch.
+
+Usage:
+    python migrate_add_keyword_stats.py [--batch-size 100]
+"""
+import argparse
+import sys
+
+from app import app, db, Document, KeywordStat, update_keyword_stats
+
+
+def migrate(batch_size=100):
+    with app.app_context():
+        try:
+            print("Starting migration to add keyword statistics...")
+            
+            # Create all tables defined in models (existing tables are left untouched)
+            db.create_all()
+            KeywordStat.query.delete()
+            db.session.commit()
+            
+            last_id = 0
+            counted = 0
+            while True:
+                batch = Document.query.options(db.undefer(Document.extracted_text)).filter(
+                    Document.id > last_id,
+                    Document.last_analyzed.isnot(None)
+                ).order_by(Document.id).limit(batch_size).all()
+                if not batch:
+                    break
+                for doc in batch:
+                    update_keyword_stats(doc.user_id, doc.extracted_text, 1)
+                db.session.commit()
+                counted += len(batch)
+                last_id = batch[-1].id
+                db.session.expunge_all()
+                print(f"  … counted documents up to id {last_id} ({counted} documents)")
+            
+            print("✓ Migration completed successfully!")
+            print("✓ Added tables:")
+            print(f"  - keyword_stat (keyword document frequencies, built from {counted} analyzed documents)")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add and backfill keyword statistics.')
+    parser.add_argument('--batch-size', type=int, default=100, help='documents per transaction')
+    migrate(parser.parse_args().batch_size)
@@ -0,0 +1,25 @@
+"""
+Migration script to add the llm_cache_entry table (persistent LLM response cache).
+Run this once to update your existing database.
+"""
+from app import app, db
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            print("Starting migration to add the LLM response cache...")
+            
+            # Create all tables defined in models (existing tables are left untouched)
+            db.create_all()
+            
+            print("✓ Migration completed successfully!")
+            print("✓ Added tables:")
+            print("  - llm_cache_entry (cached AI summaries and tags)")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,25 @@
+"""
+Migration script to add the quiz_set table (stored quiz banks).
+Run this once to update your existing database.
+"""
+from app import app, db
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            print("Starting migration to add quiz banks...")
+            
+            # Create all tables defined in models (existing tables are left untouched)
+            db.create_all()
+            
+            print("✓ Migration completed successfully!")
+            print("✓ Added tables:")
+            print("  - quiz_set (pre-generated quiz questions per document and difficulty)")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
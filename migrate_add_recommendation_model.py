@@ -0,0 +1,42 @@
+"""
+Migration script to add the recommendation_model and recommendation_vector tables,
+which store each user's fitted TF-IDF model and document vectors for recommendations.
+Fitting is optional: without --fit each user's model is fitted on their first request.
+Run this once to update your existing database.
+
+Usage:
+    python migrate_add_recommendation_model.py [--fit]
+"""
+import argparse
+import sys
+
+from app import app, db, Document, RecommendationModel, fit_recommendation_model
+
+
+def migrate(fit=False):
+    with app.app_context():
+        try:
+            print("Creating recommendation_model and recommendation_vector tables...")
+            db.create_all()  # Only creates missing tables
+            print("✓ Tables ready.")
+            
+            if fit:
+                user_ids = db.session.execute(
+                    db.select(Document.user_id).where(Document.extracted_text.isnot(None)).distinct()
+                ).scalars().all()
+                for user_id in user_ids:
+                    model = fit_recommendation_model(user_id, db.session.get(RecommendationModel, user_id))
+                    print(f"  … user {user_id}: fitted on {model.fitted_documents} documents")
+                    db.session.expunge_all()
+                print(f"✓ Fitted models for {len(user_ids)} users.")
+            
+            print("✓ Migration completed successfully!")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the stored TF-IDF model tables for recommendations.')
+    parser.add_argument('--fit', action='store_true', help="fit every user's model now instead of on first use")
+    migrate(parser.parse_args().fit)
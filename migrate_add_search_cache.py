@@ -0,0 +1,27 @@
+"""
+Migration script to add the search_generation column to the User table.
+The search result cache compares it with the generation its entries were built for.
+Run this once to update your existing database.
+"""
+from app import app, db
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            columns = [column['name'] for column in db.inspect(db.engine).get_columns('user')]
+            
+            if 'search_generation' not in columns:
+                print("Adding search_generation column to user table...")
+                with db.engine.begin() as conn:
+                    conn.execute(db.text('ALTER TABLE "user" ADD COLUMN search_generation INTEGER NOT NULL DEFAULT 0'))
+                print("✓ Migration successful! search_generation column added.")
+            else:
+                print("search_generation column already exists. No migration needed.")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,62 @@
+"""
+Migration script for semantic search: stores content_vector as raw float32 bytes
+(BYTEA on PostgreSQL; SQLite needs no schema change), fits the local model
+(hashing vectorizer + TruncatedSVD) on a sample of documents, writes it to
+SEMANTIC_MODEL_PATH and embeds every document. Later writes are embedded as they happen.
+Re-running refits the model and re-embeds all documents, e.g. once the library has grown.
+(With SEMANTIC_AUTO_FIT the app fits a first model by itself after the first analysis.)
+
+Usage:
+    python migrate_add_semantic_vectors.py [--sample 5000] [--batch-size 200]
+"""
+import argparse
+import sys
+
+from app import app, db, fit_semantic_model
+
+
+def convert_column():
+    """content_vector used to be (never written) JSON text; drop those values and switch the type."""
+    with db.engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(db.text(
+                "ALTER TABLE document ALTER COLUMN content_vector TYPE BYTEA USING NULL"
+            ))
+        else:
+            conn.execute(db.text(
+                "UPDATE document SET content_vector = NULL WHERE typeof(content_vector) != 'blob'"
+            ))
+
+
+def migrate(sample=5000, batch_size=200):
+    with app.app_context():
+        try:
+            print("Starting migration to add semantic search vectors...")
+            convert_column()
+            
+            def progress(last_id, embedded):
+                print(f"  … embedded documents up to id {last_id} ({embedded} vectors)")
+            
+            try:
+                model, fitted, embedded = fit_semantic_model(sample, batch_size, progress=progress)
+            except ValueError as e:
+                print(f"✗ {e}")
+                sys.exit(1)
+            print(f"✓ Fitted {model.dimensions}-dimension model on {fitted} documents")
+            
+            print("✓ Migration completed successfully!")
+            print(f"✓ Wrote model: {app.config['SEMANTIC_MODEL_PATH']}")
+            print(f"✓ Stored {embedded} document vectors ({4 * model.dimensions} bytes each)")
+            
+        except SystemExit:
+            raise
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the semantic search model and embed all documents.')
+    parser.add_argument('--sample', type=int, default=5000, help='documents the model is fitted on')
+    parser.add_argument('--batch-size', type=int, default=200, help='documents per transaction')
+    args = parser.parse_args()
+    migrate(args.sample, args.batch_size)
@@ -0,0 +1,31 @@
+"""
+Migration script to add the search_change table (change log for the typeahead index) and
+write the first suggestion snapshot to SUGGEST_INDEX_PATH.
+Run this once to update your existing database, then restart the app so every worker logs changes.
+Re-running it rewrites the snapshot, which is also how to compact it by hand.
+"""
+from app import app, db, build_suggest_snapshot
+import sys
+
+def migrate():
+    with app.app_context():
+        try:
+            print("Starting migration to add the typeahead suggestion index...")
+            
+            # Create all tables defined in models (existing tables are left untouched)
+            db.create_all()
+            
+            path = app.config['SUGGEST_INDEX_PATH']
+            count = build_suggest_snapshot(path)
+            
+            print("✓ Migration completed successfully!")
+            print("✓ Added tables:")
+            print("  - search_change (document changes applied by each worker's suggestion index)")
+            print(f"✓ Wrote suggestion snapshot: {path} ({count} documents)")
+            
+        except Exception as e:
+            print(f"✗ Migration failed: {e}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,87 @@
+"""
+Backfill script to compress existing extracted_text / summary values in place.
+Run this after setting COMPRESS_TEXT_COLUMNS=true so old rows match new writes.
+Rows are processed in id-ordered batches, so the script can be interrupted and re-run.
+
+Usage:
+    python migrate_compress_text.py [--batch-size 200] [--decompress]
+"""
+import argparse
+
+from app import (
+    app,
+    db,
+    COMPRESSED_TEXT_PREFIX,
+    compress_text,
+    decompress_text,
+)
+
+COLUMNS = ('extracted_text', 'summary')
+
+
+def convert_value(value, decompress):
+    """Return the new stored value, or None if the value should be left alone."""
+    if value is None:
+        return None
+    is_compressed = value.startswith(COMPRESSED_TEXT_PREFIX) and decompress_text(value) != value
+    if decompress:
+        return decompress_text(value) if is_compressed else None
+    if is_compressed or len(value) < app.config['COMPRESS_TEXT_MIN_LENGTH']:
+        return None
+    return compress_text(value)
+
+
+def backfill(batch_size=200, decompress=False):
+    """Compress (or decompress) stored text columns batch by batch."""
+    # Raw SQL on purpose: the CompressedText type would decompress on read
+    select_sql = db.text(
+        f"SELECT id, {', '.join(COLUMNS)} FROM document WHERE id > :last_id ORDER BY id LIMIT :limit"
+    )
+    last_id = 0
+    converted = 0
+    bytes_before = 0
+    bytes_after = 0
+
+    while True:
+        rows = db.session.execute(select_sql, {'last_id': last_id, 'limit': batch_size}).fetchall()
+        if not rows:
+            break
+
+        for row in rows:
+            for column in COLUMNS:
+                value = getattr(row, column)
+                new_value = convert_value(value, decompress)
+                if new_value is None:
+                    continue
+                db.session.execute(
+                    db.text(f"UPDATE document SET {column} = :value WHERE id = :id"),
+                    {'value': new_value, 'id': row.id}
+                )
+                converted += 1
+                bytes_before += len(value)
+                bytes_after += len(new_value)
+
+        db.session.commit()
+        last_id = rows[-1].id
+        print(f"  … processed documents up to id {last_id} ({converted} values converted)")
+
+    return converted, bytes_before, bytes_after
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compress stored document text in batches.')
+    parser.add_argument('--batch-size', type=int, default=200, help='documents per transaction')
+    parser.add_argument('--decompress', action='store_true', help='undo the compression (opt-out)')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Document Text Compression Backfill")
+    print("=" * 60)
+
+    if not args.decompress and not app.config['COMPRESS_TEXT_COLUMNS']:
+        print("⚠ COMPRESS_TEXT_COLUMNS is off: existing rows will be compressed, new writes will not.")
+
+    with app.app_context():
+        converted, before, after = backfill(args.batch_size, args.decompress)
+
+    print(f"\n✅ Converted {converted} values: {before / 1024:.1f} KiB → {after / 1024:.1f} KiB")
@@ -1,9 +1,17 @@
 import os
+import json
+import re
 import tempfile
+import time
 import pytest
 import shutil
-from app import app, db, Document
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
+from app import app, db, Document, User, recommendation_cache, search_result_cache, semantic_index_cache
 from io import BytesIO
+from types import SimpleNamespace
 
 
 @pytest.fixture
@@ -15,6 +23,12 @@ def client():
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
     app.config['TESTING'] = True
     app.config['UPLOAD_FOLDER'] = upload_dir
+    app.config['SUGGEST_INDEX_PATH'] = os.path.join(upload_dir, 'suggest_index.bin')
+    app.config['SEMANTIC_MODEL_PATH'] = os.path.join(upload_dir, 'semantic_model.npz')
+    app.config['SEMANTIC_AUTO_FIT'] = False  # Tests fit their own models
+    search_result_cache.clear()  # Ids and generations restart with every fresh database
+    semantic_index_cache.clear()
+    recommendation_cache.clear()
     
     with app.test_client() as client:
         with app.app_context():
@@ -29,6 +43,43 @@ def client():
     shutil.rmtree(upload_dir, ignore_errors=True)
 
 
+@pytest.fixture
+def auth_client(client):
+    """Test client logged in as a freshly created user."""
+    with app.app_context():
+        user = User(email='student@example.com', name='Student', google_id='test-google-id')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    return client
+
+
+@contextmanager
+def captured_queries():
+    """Collect the SQL statements executed inside the block."""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def selected_columns(statement):
+    """Return the column list of a SELECT statement (empty for other statements)."""
+    match = re.match(r'\s*SELECT\s+(.*?)\s+FROM\s', statement, re.S | re.I)
+    return match.group(1) if match else ''
+
+
 def test_index_empty(client):
     """Test index page with no documents."""
     rv = client.get('/')
@@ -246,3 +297,1398 @@ def test_preview_text_note(client):
     rv = client.get(f'/preview/{doc_id}')
     assert rv.status_code == 200
     assert b'This is a test note content' in rv.data
+
+
+def test_listing_routes_do_not_fetch_heavy_columns(auth_client):
+    """List pages must not SELECT extracted_text, summary or content_vector."""
+    auth_client.post('/upload', data={
+        'file': (BytesIO(b'heavy'), 'heavy.pdf'),
+        'year': '1',
+        'subject': 'Chemistry',
+        'tags': 'organic',
+    }, content_type='multipart/form-data')
+    doc = Document.query.first()
+    doc.extracted_text = 'x' * 50000
+    doc.summary = 'A long summary'
+    db.session.commit()
+    db.session.expire_all()
+    
+    for url in ['/year/1', '/tag/organic', '/search?q=heavy', '/api/documents',
+                '/shared-with-me', '/api/analytics/documents-usage']:
+        with captured_queries() as statements:
+            rv = auth_client.get(url)
+        assert rv.status_code == 200, url
+        for statement in statements:
+            columns = selected_columns(statement)
+            for heavy in ('extracted_text', 'summary', 'content_vector'):
+                assert heavy not in columns, f'{url} fetched {heavy}'
+
+
+def test_compressed_text_roundtrip_and_backfill(auth_client, monkeypatch):
+    """Long text is stored compressed when enabled and always read back transparently."""
+    from app import COMPRESSED_TEXT_PREFIX
+    from migrate_compress_text import backfill
+    
+    with app.app_context():
+        text = 'Thermodynamics chapter. ' * 200
+        raw_sql = db.text('SELECT extracted_text FROM document WHERE id = :id')
+        user = User.query.first()
+
+        plain = Document(user_id=user.id, original_filename='plain.pdf', stored_filename='plain.pdf',
+                         year=1, subject='Physics', extracted_text=text)
+        db.session.add(plain)
+        db.session.commit()
+        assert db.session.execute(raw_sql, {'id': plain.id}).scalar() == text
+
+        monkeypatch.setitem(app.config, 'COMPRESS_TEXT_COLUMNS', True)
+        packed = Document(user_id=user.id, original_filename='packed.pdf', stored_filename='packed.pdf',
+                          year=1, subject='Physics', extracted_text=text)
+        db.session.add(packed)
+        db.session.commit()
+        stored = db.session.execute(raw_sql, {'id': packed.id}).scalar()
+        assert stored.startswith(COMPRESSED_TEXT_PREFIX)
+        assert len(stored) < len(text) / 5
+
+        converted, _, _ = backfill(batch_size=1)
+        assert converted == 1
+        assert db.session.execute(raw_sql, {'id': plain.id}).scalar().startswith(COMPRESSED_TEXT_PREFIX)
+
+        db.session.expire_all()
+        for doc in Document.query.options(db.undefer(Document.extracted_text)).all():
+            assert doc.extracted_text == text
+        # Search patterns are compared as plain text, not compressed
+        assert Document.query.filter(Document.extracted_text.ilike('%thermo%')).count() == 0
+
+        # Plain text that happens to start with the marker is read back as written
+        note = Document(user_id=user.id, original_filename='note.txt', stored_filename='note.txt',
+                        year=1, subject='Physics', extracted_text='zlib: notes on compression, ch. 3')
+        db.session.add(note)
+        db.session.commit()
+        db.session.expire_all()
+        assert db.session.get(Document, note.id).extracted_text == 'zlib: notes on compression, ch. 3'
+
+
+def test_listing_routes_batch_load_tags(auth_client):
+    """Rendering a page of tagged documents must not issue one tag query per card."""
+    for i in range(8):
+        auth_client.post('/upload', data={
+            'file': (BytesIO(b'tagged'), f'notes{i}.pdf'),
+            'year': '1',
+            'subject': 'Biology',
+            'tags': f'cells, genetics, topic{i}, extra{i}',
+        }, content_type='multipart/form-data')
+    db.session.expire_all()
+    
+    for url in ['/year/1', '/tag/cells', '/search?q=notes']:
+        with captured_queries() as statements:
+            rv = auth_client.get(url)
+        assert rv.status_code == 200, url
+        assert b'genetics' in rv.data
+        selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+        assert len(selects) <= 6, f'{url} ran {len(selects)} queries'
+
+
+class FakeGeminiModel:
+    """Stand-in for genai.GenerativeModel that counts calls; respond(prompt) may compute (or raise) the answer."""
+
+    def __init__(self, text='stub response', respond=None):
+        self.text = text
+        self.respond = respond
+        self.calls = 0
+
+    def _answer(self, prompt):
+        self.calls += 1
+        return self.respond(prompt) if self.respond else self.text
+
+    def generate_content(self, prompt, **kwargs):
+        return type('Response', (), {'text': self._answer(prompt)})()
+
+    def start_chat(self, history=None):
+        self.history = history
+        return self
+
+    def send_message(self, message, stream=False, **kwargs):
+        text = self._answer(message)
+        if stream:
+            return iter(type('Chunk', (), {'text': word})() for word in re.findall(r'\S+\s*', text))
+        return type('Response', (), {'text': text})()
+
+
+class InlineExecutor:
+    """Executor that runs each job as it is submitted, so background work is done when the request returns."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+@pytest.fixture
+def unlimited_rate_limiter(monkeypatch):
+    """A token bucket that never makes a test wait."""
+    import app as app_module
+    limiter = app_module.TokenBucket(60000)
+    monkeypatch.setattr(app_module, 'llm_rate_limiter', limiter)
+    return limiter
+
+
+@pytest.fixture
+def inline_executor(monkeypatch):
+    """inline_executor('quiz_executor') runs that executor's jobs synchronously for the rest of the test."""
+    import app as app_module
+
+    def install(name):
+        executor = InlineExecutor()
+        monkeypatch.setattr(app_module, name, executor)
+        return executor
+    return install
+
+
+@pytest.fixture
+def fake_llm(monkeypatch, unlimited_rate_limiter):
+    """fake_llm(text) / fake_llm(respond=fn) installs a FakeGeminiModel as Gemini and returns it."""
+    import app as app_module
+
+    def install(text='stub response', respond=None):
+        fake = FakeGeminiModel(text, respond)
+        monkeypatch.setattr(app_module, 'gemini_model', fake)
+        return fake
+    return install
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    """Installs an OpenAI client that answers 'from openai'; returns the list of request kwargs."""
+    import app as app_module
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='from openai'))])
+
+    monkeypatch.setattr(app_module, 'openai_client',
+                        SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+    return calls
+
+
+def add_docx_document(user_id, stored, text, subject='Biology'):
+    """Write a .docx upload and its Document row (call inside an app context); returns the Document."""
+    from docx import Document as DocxDocument
+    docx = DocxDocument()
+    docx.add_paragraph(text)
+    docx.save(os.path.join(app.config['UPLOAD_FOLDER'], stored))
+    doc = Document(user_id=user_id, original_filename=stored, stored_filename=stored, year=1, subject=subject,
+                   mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+    db.session.add(doc)
+    return doc
+
+
+def test_llm_cache_hits_bypass_and_eviction(client, monkeypatch, fake_llm):
+    """Identical summary/tag requests are served from the cache; bypass forces a call."""
+    import app as app_module
+    fake = fake_llm('thermodynamics, entropy, heat')
+    text = 'The second law of thermodynamics states that entropy never decreases. ' * 20
+
+    with app.app_context():
+        first = app_module.generate_summary(text)
+        assert app_module.generate_summary(text) == first
+        assert fake.calls == 1
+        app_module.generate_summary(text, use_cache=False)
+        assert fake.calls == 2
+
+        app_module.generate_smart_tags(text, 'Physics')
+        tags = app_module.generate_smart_tags(text, 'Physics')
+        assert fake.calls == 3
+        assert 'entropy' in tags
+
+        monkeypatch.setitem(app.config, 'LLM_CACHE_MAX_ENTRIES', 2)
+        app_module.generate_summary(text + ' extra')
+        assert app_module.LLMCacheEntry.query.count() == 2
+
+
+def test_llm_cache_files_answers_under_the_answering_provider(auth_client, monkeypatch, fake_llm, fake_openai):
+    """A fallback answer is cached under the fallback's model, without touching the caller's session."""
+    import app as app_module
+
+    def gemini_down(prompt):
+        raise RuntimeError('gemini down')
+
+    fake_llm(respond=gemini_down)
+    monkeypatch.setattr(app_module.gemini_provider, 'breaker', app_module.CircuitBreaker(5, 60))
+    text = 'Entropy measures the number of microstates of a system. ' * 20
+
+    with app.app_context():
+        user = User.query.first()
+        user.name = 'Unsaved edit'  # Pending in the caller's session
+        with db.session.no_autoflush:
+            assert app_module.generate_summary(text) == 'from openai'
+            assert [entry.model for entry in app_module.LLMCacheEntry.query.all()] == [app_module.OPENAI_MODEL_NAME]
+            hits = app_module.llm_cache_stats['hits']
+            assert app_module.generate_summary(text) == 'from openai'  # Served from the cache
+            assert app_module.llm_cache_stats['hits'] == hits + 1
+        db.session.rollback()
+        assert User.query.first().name != 'Unsaved edit'
+
+    assert auth_client.get('/api/ai/cache-stats').status_code == 403
+
+
+def test_bulk_analysis_is_resumable(client, fake_llm):
+    """Bulk analysis processes pending documents in batches and resumes from the stored cursor."""
+    import app as app_module
+    fake_llm('cells, membranes')
+
+    with app.app_context():
+        user = User(email='bulk@example.com', name='Bulk', google_id='bulk-google-id')
+        db.session.add(user)
+        db.session.commit()
+        for i in range(5):
+            add_docx_document(user.id, f'bulk{i}.docx', f'Chapter {i}: the cell membrane controls transport of molecules. ' * 5)
+        db.session.commit()
+
+        run = app_module.AnalysisRun(user_id=user.id)
+        db.session.add(run)
+        db.session.commit()
+
+        # First session stops early, second one resumes from the stored cursor
+        app_module.run_bulk_analysis(run.id, extract_workers=0, llm_workers=2, batch_size=2, limit=2)
+        assert app_module.pending_analysis_query(user.id).count() == 3
+        run = app_module.run_bulk_analysis(run.id, extract_workers=0, llm_workers=2, batch_size=2)
+        assert run.status == 'completed'
+        assert run.processed == 5 and run.succeeded == 5
+        assert run.docs_per_minute > 0
+        assert app_module.pending_analysis_query(user.id).count() == 0
+        assert Document.query.filter(Document.summary.isnot(None)).count() == 5
+
+
+def test_background_jobs_queue_for_rate_limits_outside_the_deadline(client, monkeypatch, fake_llm):
+    """For bulk analysis, waiting on the token bucket and 429 backoff is neither a timeout nor a breaker failure."""
+    import app as app_module
+
+    def rate_limited(prompt):
+        if fake.calls < 3:
+            raise Exception('429 Resource has been exhausted (e.g. check quota).')
+        return 'answer'
+
+    fake = fake_llm(respond=rate_limited)
+    monkeypatch.setattr(app_module.gemini_provider, 'breaker', app_module.CircuitBreaker(1, 60))
+    # One token every 0.5s: each attempt queues locally for longer than the 0.2s deadline
+    monkeypatch.setattr(app_module, 'llm_rate_limiter', app_module.TokenBucket(120, capacity=1))
+    monkeypatch.setitem(app.config, 'AI_PROVIDER', 'gemini')
+    monkeypatch.setitem(app.config, 'AI_TIMEOUT_SECONDS', 0.2)
+    monkeypatch.setitem(app.config, 'AI_BACKOFF_BASE_SECONDS', 0.05)
+    stats = dict(app_module.ai_provider_stats)
+
+    with app.app_context(), app_module.ai_call_scope('bulk_analysis'):
+        app_module.llm_rate_limiter.acquire()  # Bucket starts empty
+        assert app_module.ai_complete('question') == 'answer'
+
+    assert fake.calls == 3
+    assert app_module.gemini_provider.breaker.state == 'closed'
+    assert app_module.gemini_provider.breaker.failures == 0
+    assert app_module.ai_provider_stats['rate_limited'] == stats['rate_limited'] + 2
+    assert app_module.ai_provider_stats['timeouts'] == stats['timeouts']
+
+
+def test_interactive_routes_fail_fast_when_every_call_slot_is_busy(auth_client, monkeypatch, fake_llm):
+    """Waiting for the token bucket or a concurrency slot counts against the deadline of a request."""
+    import app as app_module
+
+    def slow(prompt):
+        time.sleep(2)
+        return 'too late'
+
+    fake = fake_llm(respond=slow)
+    monkeypatch.setattr(app_module.gemini_provider, 'breaker', app_module.CircuitBreaker(1, 60))
+    monkeypatch.setattr(app_module, 'llm_concurrency', app_module.threading.BoundedSemaphore(1))
+    monkeypatch.setitem(app.config, 'AI_PROVIDER', 'gemini')
+    monkeypatch.setitem(app.config, 'AI_TIMEOUT_SECONDS', 0.3)
+    session_id = add_chat_session()
+
+    assert app_module.llm_concurrency.acquire()  # A slow call from another request holds the only slot
+    start = time.monotonic()
+    rv = auth_client.post(f'/chat/{session_id}/message', json={'message': 'What is entropy?'})
+    assert time.monotonic() - start < 1
+    assert rv.get_json()['success'] is False and 'busy' in rv.get_json()['error']
+    assert fake.calls == 0
+    assert app_module.gemini_provider.breaker.state == 'closed'  # Local queueing says nothing about Gemini
+
+    # An empty bucket whose next token is further away than the deadline gives up without sleeping
+    app_module.llm_concurrency.release()
+    monkeypatch.setattr(app_module, 'llm_rate_limiter', app_module.TokenBucket(1, capacity=1))
+    app_module.llm_rate_limiter.acquire()
+    start = time.monotonic()
+    rv = auth_client.post(f'/chat/{session_id}/message', json={'message': 'And enthalpy?'})
+    assert time.monotonic() - start < 1
+    assert rv.get_json()['success'] is False
+    assert fake.calls == 0
+
+
+def test_bulk_analyze_recovers_stale_runs_and_sends_large_runs_to_the_script(auth_client, monkeypatch):
+    """A 'running' run without a heartbeat is marked failed and resumable; big libraries go to bulk_analyze.py."""
+    import app as app_module
+    from datetime import timedelta
+    monkeypatch.setitem(app.config, 'AI_PROVIDER', 'stub')
+    monkeypatch.setitem(app.config, 'BULK_ANALYSIS_WEB_MAX_DOCUMENTS', 0)
+
+    with app.app_context():
+        user_id = User.query.first().id
+        crashed = app_module.AnalysisRun(user_id=user_id, status='running',
+                                         updated_at=datetime.utcnow() - timedelta(hours=2))
+        db.session.add_all([crashed, Document(user_id=user_id, original_filename='a.pdf', stored_filename='a.pdf',
+                                              year=1, subject='Physics')])
+        db.session.commit()
+        crashed_id = crashed.id
+
+    rv = auth_client.post('/api/ai/bulk-analyze', json={})
+    assert rv.status_code == 400
+    assert f'bulk_analyze.py --user-id {user_id} --resume {crashed_id}' in rv.get_json()['error']
+    with app.app_context():
+        assert db.session.get(app_module.AnalysisRun, crashed_id).status == 'failed'
+        db.session.add(app_module.AnalysisRun(user_id=user_id, status='running'))  # Alive: fresh heartbeat
+        db.session.commit()
+    assert auth_client.post('/api/ai/bulk-analyze', json={}).status_code == 409
+
+
+def test_analyze_endpoint_queues_job_and_streams_progress(auth_client, fake_llm):
+    """POST /analyze returns 202 immediately; progress is available as JSON and SSE."""
+    import app as app_module
+    fake_llm('Cell biology overview')
+
+    with app.app_context():
+        doc = add_docx_document(User.query.first().id, 'cell.docx', 'Mitochondria are the powerhouse of the cell. ' * 10)
+        db.session.commit()
+        doc_id = doc.id
+
+    rv = auth_client.post(f'/document/{doc_id}/analyze')
+    assert rv.status_code == 202
+    job_id = rv.get_json()['job_id']
+
+    job = None
+    for _ in range(50):
+        job = auth_client.get(f'/api/analysis-jobs/{job_id}').get_json()['job']
+        if job['status'] in ('done', 'failed'):
+            break
+        time.sleep(0.1)
+    assert job['status'] == 'done'
+    assert job['summary'] == 'Cell biology overview'
+
+    rv = auth_client.get(f'/api/analysis-jobs/{job_id}/events')
+    assert rv.mimetype == 'text/event-stream'
+    body = rv.get_data(as_text=True)
+    assert 'event: done' in body
+    assert '"extracted_text_length"' in body
+    rv.close()
+    assert app_module.stream_slots._value == app.config['STREAM_MAX_CONCURRENT']  # Slot given back
+    with app.app_context():
+        assert app_module.ActivityLog.query.filter_by(activity_type='analysis', document_id=doc_id).count() == 1
+
+
+def add_queued_analysis_job(job_id, age=None):
+    """A queued AnalysisJob for a new document of the logged-in user; returns the document id."""
+    from app import AnalysisJob
+    with app.app_context():
+        user_id = User.query.first().id
+        doc = Document(user_id=user_id, original_filename=f'{job_id}.pdf', stored_filename=f'{job_id}.pdf',
+                       year=1, subject='Physics')
+        db.session.add(doc)
+        db.session.commit()
+        job = AnalysisJob(id=job_id, user_id=user_id, document_id=doc.id)
+        if age is not None:
+            job.updated_at = datetime.utcnow() - age
+        db.session.add(job)
+        db.session.commit()
+        return doc.id
+
+
+def test_stale_queued_analysis_jobs_are_failed(auth_client):
+    """A job still queued long after it was created (lost in a restart) is reported as failed."""
+    from datetime import timedelta
+    add_queued_analysis_job('lost', age=timedelta(hours=1))
+    add_queued_analysis_job('fresh')
+
+    job = auth_client.get('/api/analysis-jobs/lost').get_json()['job']
+    assert job['status'] == 'failed' and 'interrupted' in job['error']
+    assert auth_client.get('/api/analysis-jobs/fresh').get_json()['job']['status'] == 'queued'
+
+
+def test_analysis_events_answer_503_without_a_stream_slot(auth_client, monkeypatch):
+    """With every stream slot taken the progress stream is refused instead of tying up a worker."""
+    import app as app_module
+    add_queued_analysis_job('busy')
+    monkeypatch.setattr(app_module, 'stream_slots', app_module.threading.BoundedSemaphore(1))
+    assert app_module.acquire_stream_slot()  # Someone else's stream
+    assert auth_client.get('/api/analysis-jobs/busy/events').status_code == 503
+
+
+def test_analysis_jobs_are_deleted_with_their_document(auth_client):
+    """Deleting a document removes its jobs; a job already in the executor queue then does nothing."""
+    import app as app_module
+    from app import AnalysisJob
+    doc_id = add_queued_analysis_job('orphan')
+
+    auth_client.post(f'/delete/{doc_id}')
+    with app.app_context():
+        assert db.session.get(Document, doc_id) is None
+        assert AnalysisJob.query.count() == 0
+    app_module.run_analysis_job('orphan')
+
+
+def add_chat_session(title='Thermo', **kwargs):
+    """A chat session of the logged-in user; returns its id."""
+    from app import ChatSession
+    with app.app_context():
+        chat = ChatSession(user_id=User.query.first().id, title=title, **kwargs)
+        db.session.add(chat)
+        db.session.commit()
+        return chat.id
+
+
+def test_chat_stream_emits_tokens_then_done(auth_client, fake_llm):
+    """The streaming chat endpoint sends tokens as SSE and stores the full reply."""
+    from app import ActivityLog, ChatMessage
+    fake = fake_llm('Entropy always increases')
+    session_id = add_chat_session()
+
+    rv = auth_client.post(f'/chat/{session_id}/message/stream', json={'message': 'What is entropy?'})
+    assert rv.mimetype == 'text/event-stream'
+    body = rv.get_data(as_text=True)
+    assert body.count('event: token') == 3
+    assert body.index('event: token') < body.index('event: done')
+    assert '"ttft_ms"' in body
+
+    with app.app_context():
+        activity = ActivityLog.query.filter_by(activity_type='chat').one()
+        assert json.loads(activity.meta_data)['streamed'] is True
+        messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.id).all()
+        assert [(m.role, m.content) for m in messages] == [
+            ('user', 'What is entropy?'),
+            ('assistant', 'Entropy always increases'),
+        ]
+
+    # The JSON endpoint still works and sees the previous turn as history
+    rv = auth_client.post(f'/chat/{session_id}/message', json={'message': 'And enthalpy?'})
+    assert rv.get_json()['ai_message']['content'] == 'Entropy always increases'
+    assert [turn['role'] for turn in fake.history] == ['user', 'model', 'user', 'model']
+
+
+def test_chat_stream_is_refused_without_a_stream_slot(auth_client, monkeypatch, fake_llm):
+    """With every stream slot taken the stream answers 503 before the message is saved."""
+    import app as app_module
+    from app import ChatMessage
+    fake = fake_llm('Entropy always increases')
+    session_id = add_chat_session()
+
+    monkeypatch.setattr(app_module, 'stream_slots', app_module.threading.BoundedSemaphore(1))
+    assert app_module.acquire_stream_slot()
+    rv = auth_client.post(f'/chat/{session_id}/message/stream', json={'message': 'And entropy?'})
+    assert rv.status_code == 503
+    assert fake.calls == 0
+    with app.app_context():
+        assert ChatMessage.query.filter_by(session_id=session_id).count() == 0
+
+
+def test_chat_history_is_windowed_and_summarized(auth_client, monkeypatch, fake_llm, inline_executor):
+    """Long sessions send a bounded prompt: system context, rolling summary and the last turns only."""
+    from app import ChatSession, ChatMessage
+    fake = fake_llm('Noted.')
+    inline_executor('chat_summary_executor')
+    monkeypatch.setitem(app.config, 'CHAT_HISTORY_MESSAGES', 6)
+
+    session_id = add_chat_session('Long chat')
+    with app.app_context():
+        for i in range(40):
+            db.session.add(ChatMessage(session_id=session_id, role='user' if i % 2 == 0 else 'assistant',
+                                       content=f'message {i} ' + 'x' * 200))
+        db.session.commit()
+
+    with captured_queries() as queries:
+        rv = auth_client.post(f'/chat/{session_id}/message', json={'message': 'Quiz me'})
+    assert rv.get_json()['success']
+
+    history_selects = [q for q in queries
+                       if q.lstrip().upper().startswith('SELECT') and 'chat_message.session_id = ?' in q]
+    assert history_selects and all('LIMIT' in q for q in history_selects)
+
+    # Preamble (system prompt + acknowledgement) followed by at most CHAT_HISTORY_MESSAGES turns
+    assert 'AI Study Assistant' in fake.history[0]['parts'][0]
+    assert len(fake.history) <= 2 + 6
+    assert fake.history[2]['role'] == 'user'
+
+    with app.app_context():
+        chat = db.session.get(ChatSession, session_id)
+        assert chat.history_summary
+        window_start = ChatMessage.query.filter_by(session_id=session_id)\
+            .order_by(ChatMessage.id.desc()).offset(5).first().id
+        # Backlogs are folded in bounded batches, never past the start of the window
+        assert 0 < chat.summarized_until_id < window_start
+
+    # The next turn carries the rolling summary in the system context
+    auth_client.post(f'/chat/{session_id}/message', json={'message': 'Again'})
+    assert 'Summary of the earlier conversation' in fake.history[0]['parts'][0]
+
+
+def test_chat_context_retrieves_relevant_chunks(auth_client, fake_llm):
+    """Questions about the end of a long document get that part as context; the index is cached."""
+    fake = fake_llm('Sure.')
+
+    filler = 'Chapter overview of mechanics, forces, motion and momentum in everyday situations. ' * 400
+    chapter7 = 'Chapter 7. Photosynthesis turns light energy into chemical energy inside chloroplasts.'
+    with app.app_context():
+        doc = Document(user_id=User.query.first().id, original_filename='biology.pdf', stored_filename='biology.pdf',
+                       year=1, subject='Biology', mimetype='application/pdf',
+                       extracted_text=filler + chapter7 + ' ' + filler, last_analyzed=datetime.utcnow())
+        db.session.add(doc)
+        db.session.commit()
+        doc_id = doc.id
+    session_id = add_chat_session('Biology', document_id=doc_id)
+
+    auth_client.post(f'/chat/{session_id}/message', json={'message': 'How does photosynthesis use light?'})
+    assert chapter7 in fake.history[0]['parts'][0]
+
+    with captured_queries() as queries:
+        auth_client.post(f'/chat/{session_id}/message', json={'message': 'Where do chloroplasts fit in?'})
+    assert chapter7 in fake.history[0]['parts'][0]
+    assert not any('document.extracted_text' in q for q in queries)
+
+
+ANALYSIS_TEXT = 'Photosynthesis converts light energy into chemical energy in chloroplasts. ' * 20
+
+
+def test_structured_analysis_is_a_single_call(client, fake_llm):
+    """Summary, tags and key terms come from one JSON call."""
+    import app as app_module
+    structured = fake_llm(
+        '```json\n{"summary": "Photosynthesis overview.", "tags": ["Photosynthesis", "chloroplasts"], '
+        '"key_terms": ["chlorophyll"]}\n```'
+    )
+
+    with app.app_context():
+        summary, tags, key_terms = app_module.generate_analysis(ANALYSIS_TEXT, 'Biology', use_cache=False)
+    assert structured.calls == 1
+    assert summary == 'Photosynthesis overview.'
+    assert 'photosynthesis' in tags and 'chloroplasts' in tags
+    assert key_terms == ['chlorophyll']
+
+
+def test_unparsable_structured_analysis_falls_back_to_two_calls(client, fake_llm):
+    """Output that isn't the expected JSON is retried as separate summary and tags calls."""
+    import app as app_module
+    plain = fake_llm('light, energy')
+
+    with app.app_context():
+        summary, tags, key_terms = app_module.generate_analysis(ANALYSIS_TEXT, 'Biology', use_cache=False)
+    assert plain.calls == 3  # failed structured attempt, then summary + tags
+    assert summary == 'light, energy'
+    assert key_terms == []
+    with pytest.raises(ValueError):
+        app_module.parse_structured_analysis('{"summary": "", "tags": []}')
+
+
+def test_structured_analysis_bounds_key_terms(client):
+    """An unbounded key term list is cut to the prompt's 10 terms and always fits the column."""
+    import app as app_module
+    flood = app_module.parse_structured_analysis(json.dumps(
+        {'summary': 's', 'tags': ['t'], 'key_terms': [f'term {i} ' + 'x' * 200 for i in range(300)]}))
+    assert len(flood['key_terms']) == 10
+
+    with app.app_context():
+        doc = Document(user_id=None, original_filename='f.pdf', stored_filename='f.pdf', year=1, subject='Biology')
+        app_module.apply_analysis(doc, ANALYSIS_TEXT, 's', ['t'], flood['key_terms'])
+    assert len(doc.key_terms) <= Document.__table__.c.key_terms.type.length
+    assert doc.key_terms.startswith(flood['key_terms'][0])
+
+
+def test_long_documents_use_map_reduce_summaries(client, fake_llm):
+    """Long text is summarized chunk by chunk; after an edit only the changed chunks are recomputed."""
+    import app as app_module
+    fake = fake_llm('Section summary.')
+
+    lines = [f'Line {i}: the lecture notes discuss topic number {i} in some detail.\n' for i in range(1500)]
+    text = ''.join(lines)
+    chunks = app_module.summary_chunks(text)
+    assert len(chunks) > 3
+    assert ''.join(chunks).replace('\n', '') == text.replace('\n', '')
+
+    with app.app_context():
+        assert app_module.generate_summary(text) == 'Section summary.'
+        assert fake.calls == len(chunks) + 1  # map over every chunk, then one reduce
+
+        lines[700] = 'Line 700: this paragraph was rewritten after the first analysis.\n'
+        edited = ''.join(lines)
+        fake.calls = 0
+        app_module.generate_summary(edited)
+        changed = len(set(app_module.summary_chunks(edited)) - set(chunks))
+        assert 1 <= changed <= 2
+        assert fake.calls == changed  # the reduce input is unchanged, so it is a cache hit too
+
+
+@pytest.fixture
+def quiz_document(auth_client, fake_llm, inline_executor):
+    """(document id, fake model answering every prompt with 10 numbered questions); top-ups run inline."""
+
+    def questions(prompt):
+        return json.dumps({'questions': [{'question': f'Question {fake.calls}.{i}?', 'options': ['a', 'b', 'c', 'd'],
+                                          'correct_answer': i % 4, 'explanation': 'Because.'} for i in range(10)]})
+
+    fake = fake_llm(respond=questions)
+    inline_executor('quiz_executor')
+    with app.app_context():
+        doc = Document(user_id=User.query.first().id, original_filename='bio.pdf', stored_filename='bio.pdf',
+                       year=1, subject='Biology', mimetype='application/pdf',
+                       extracted_text='Cells divide by mitosis and meiosis. ' * 200, last_analyzed=datetime.utcnow())
+        db.session.add(doc)
+        db.session.commit()
+        return doc.id, fake
+
+
+def test_quiz_served_from_bank_and_topped_up(auth_client, quiz_document):
+    """Quizzes are sampled from stored QuizSets; Gemini is only called when the bank is low."""
+    from app import QuizSet
+    doc_id, fake = quiz_document
+
+    # Empty bank: generate once for the request, then the background top-up fills it to the minimum
+    rv = auth_client.post('/chat/quiz/generate', json={'document_id': doc_id, 'num_questions': 5})
+    data = rv.get_json()
+    assert data['source'] == 'generated' and len(data['quiz']['questions']) == 5
+    assert fake.calls == 2
+
+    # Bank is full: later requests are sampled without calling the model
+    for _ in range(3):
+        data = auth_client.post('/chat/quiz/generate', json={'document_id': doc_id, 'num_questions': 5}).get_json()
+        assert data['source'] == 'bank'
+        assert len({q['question'] for q in data['quiz']['questions']}) == 5
+    assert fake.calls == 2
+
+    with app.app_context():
+        sets = QuizSet.query.filter_by(document_id=doc_id, difficulty='medium').all()
+        assert sum(s.question_count for s in sets) == 20
+        assert sum(s.served_count for s in sets) == 20
+        counts = [s.served_count for s in sets]
+        assert max(counts) - min(counts) <= 5  # Least served set first: never more than one request apart
+
+
+def test_quiz_bank_is_dropped_when_the_document_is_reanalyzed(auth_client, quiz_document):
+    """Re-analysis with different text invalidates the bank."""
+    doc_id, fake = quiz_document
+    auth_client.post('/chat/quiz/generate', json={'document_id': doc_id, 'num_questions': 5})
+
+    with app.app_context():
+        doc = db.session.get(Document, doc_id)
+        doc.extracted_text = 'Photosynthesis happens in chloroplasts. ' * 200
+        doc.last_analyzed = datetime.utcnow()
+        db.session.commit()
+
+    data = auth_client.post('/chat/quiz/generate', json={'document_id': doc_id, 'num_questions': 5}).get_json()
+    assert data['source'] == 'generated'
+
+
+def test_quiz_rejects_bad_question_counts(auth_client, quiz_document):
+    """num_questions must be a number from 1 to QUIZ_MAX_QUESTIONS."""
+    doc_id, fake = quiz_document
+    for bad in ('five', 0, 500):
+        rv = auth_client.post('/chat/quiz/generate', json={'document_id': doc_id, 'num_questions': bad})
+        assert rv.status_code == 400
+    assert fake.calls == 0
+
+
+def slow_gemini(prompt):
+    time.sleep(0.5)
+    return 'from gemini'
+
+
+def test_slow_provider_times_out_and_opens_the_breaker(auth_client, monkeypatch, fake_llm, fake_openai):
+    """Slow Gemini calls miss the deadline and fall back to OpenAI; then the open circuit skips Gemini."""
+    import app as app_module
+    slow = fake_llm(respond=slow_gemini)
+    monkeypatch.setattr(app_module.gemini_provider, 'breaker', app_module.CircuitBreaker(2, 60))
+    monkeypatch.setitem(app.config, 'AI_TIMEOUT_SECONDS', 0.1)
+
+    for _ in range(2):
+        assert app_module.ai_complete('Explain entropy') == 'from openai'
+    assert app_module.gemini_provider.breaker.state == 'open'
+
+    start = time.monotonic()
+    assert app_module.ai_complete('Explain enthalpy') == 'from openai'
+    assert time.monotonic() - start < 0.1
+    assert slow.calls == 2 and len(fake_openai) == 3
+
+
+def test_hedged_call_races_the_fallback(auth_client, monkeypatch, fake_llm, fake_openai):
+    """With AI_HEDGE_AFTER_SECONDS set, a slow primary is raced against the fallback."""
+    import app as app_module
+    from concurrent.futures import ThreadPoolExecutor
+    fake_llm(respond=slow_gemini)
+    hedge_executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(app_module, 'ai_hedge_executor', hedge_executor)
+    monkeypatch.setattr(app_module.gemini_provider, 'breaker', app_module.CircuitBreaker(2, 60))
+    monkeypatch.setitem(app.config, 'AI_TIMEOUT_SECONDS', 5)
+    monkeypatch.setitem(app.config, 'AI_HEDGE_AFTER_SECONDS', 0.05)
+
+    start = time.monotonic()
+    assert app_module.ai_complete('Explain heat') == 'from openai'
+    assert time.monotonic() - start < 0.4
+    hedge_executor.shutdown(wait=True)  # The abandoned Gemini call finishes (and is metered) within this test
+
+
+def test_stub_provider_serves_every_ai_route(auth_client, monkeypatch):
+    """AI_PROVIDER=stub answers deterministically without any network."""
+    import app as app_module
+    monkeypatch.setitem(app.config, 'AI_PROVIDER', 'stub')
+    assert app_module.ai_complete('Summarize this') == app_module.ai_complete('Summarize this')
+    with app.app_context():
+        doc = Document(user_id=User.query.first().id, original_filename='stub.pdf', stored_filename='stub.pdf',
+                       year=1, subject='Physics', mimetype='application/pdf',
+                       extracted_text='Thermodynamics studies energy transfer and entropy. ' * 50,
+                       last_analyzed=datetime.utcnow())
+        db.session.add(doc)
+        db.session.commit()
+        summary, tags, key_terms = app_module.generate_analysis(doc.extracted_text, 'Physics', use_cache=False)
+        assert summary.startswith('Stub summary') and tags
+        doc_id = doc.id
+
+    data = auth_client.post('/chat/quiz/generate', json={'document_id': doc_id, 'num_questions': 3,
+                                                         'topic': 'entropy'}).get_json()
+    assert len(data['quiz']['questions']) == 3
+
+
+def test_ai_calls_are_metered_per_route_and_user(auth_client, monkeypatch):
+    """Every provider call and cache hit is recorded; admins see latency percentiles; daily quotas return 429."""
+    import app as app_module
+    from app import AICallMetric, ChatSession
+    
+    monkeypatch.setitem(app.config, 'AI_PROVIDER', 'stub')
+    monkeypatch.setitem(app.config, 'AI_METRICS_FLUSH_SIZE', 1000)
+    monkeypatch.setitem(app.config, 'AI_METRICS_FLUSH_SECONDS', 3600)
+    app_module.ai_metrics_buffer.clear()
+    
+    with app.app_context():
+        user_id = User.query.first().id
+        chat = ChatSession(user_id=user_id, title='Thermo')
+        db.session.add(chat)
+        db.session.commit()
+        session_id = chat.id
+    
+    for question in ('What is entropy?', 'And enthalpy?', 'Give an example'):
+        assert auth_client.post(f'/chat/{session_id}/message', json={'message': question}).status_code == 200
+    
+    # Background work is billed to the scope it runs in; the second summary is a cache hit
+    with app.app_context(), app_module.ai_call_scope('digest', user_id):
+        text = 'Heat flows from hot bodies to cold bodies. ' * 20
+        assert app_module.generate_summary(text) == app_module.generate_summary(text)
+        assert app_module.flush_ai_metrics() == 5
+        
+        rows = AICallMetric.query.order_by(AICallMetric.id).all()
+        assert [(r.route, r.provider, r.cache_hit) for r in rows] == [
+            ('chat_send_message', 'stub', False)] * 3 + [('digest', 'stub', False), ('digest', 'cache', True)]
+        assert all(r.user_id == user_id and r.outcome == 'ok' for r in rows)
+        assert rows[0].tokens_in > 0 and rows[0].chars_out > 0
+        provider_tokens = sum(r.tokens_in + r.tokens_out for r in rows if not r.cache_hit)
+        assert app_module.ai_tokens_today(user_id) == provider_tokens
+    
+    assert auth_client.get('/api/admin/ai-metrics').status_code == 403
+    monkeypatch.setitem(app.config, 'ADMIN_EMAILS', ['student@example.com'])
+    data = auth_client.get('/api/admin/ai-metrics').get_json()
+    chat_route = next(r for r in data['routes'] if r['name'] == 'chat_send_message')
+    assert chat_route['calls'] == 3 and chat_route['failures'] == 0
+    assert chat_route['p50_ms'] <= chat_route['p95_ms'] <= chat_route['p99_ms']
+    digest = next(r for r in data['routes'] if r['name'] == 'digest')
+    assert digest['cache_hits'] == 1
+    assert data['daily_users'][0]['user_id'] == user_id
+    assert data['daily_users'][0]['tokens'] == provider_tokens
+    
+    # Over the daily quota: refused before any provider is called
+    monkeypatch.setitem(app.config, 'AI_DAILY_TOKEN_QUOTA', provider_tokens)
+    rv = auth_client.post(f'/chat/{session_id}/message', json={'message': 'One more?'})
+    assert rv.status_code == 429
+    assert [row['outcome'] for row in app_module.ai_metrics_buffer] == ['quota']
+    app_module.ai_metrics_buffer.clear()
+
+
+def test_keyword_tags_use_library_idf_and_phrases(auth_client):
+    """Local tags favour terms that are distinctive within the user's library and keep two-word phrases."""
+    import app as app_module
+    from app import KeywordStat
+    
+    texts = {
+        'thermo': 'Lecture notes. The heat engine converts heat into work. Entropy of a heat engine rises. ' * 5,
+        'cells': 'Lecture notes. Mitosis splits the cell nucleus. Mitosis and meiosis differ in outcome. ' * 5,
+        'graphs': 'Lecture notes. Dijkstra finds shortest paths. Shortest paths need positive weights. ' * 5,
+    }
+    with app.app_context():
+        user_id = User.query.first().id
+        # Without a library, the boilerplate word ranks as high as the topic
+        assert 'lecture notes' in app_module.keyword_tags(texts['thermo'], count=3, user_id=user_id)
+        
+        docs = {}
+        for name, text in texts.items():
+            doc = Document(user_id=user_id, original_filename=f'{name}.txt', stored_filename=f'{name}.txt',
+                           year=1, subject='Physics', mimetype='text/plain')
+            db.session.add(doc)
+            app_module.apply_analysis(doc, text, None, [])
+            db.session.commit()
+            docs[name] = doc.id
+        
+        stats = dict(db.session.query(KeywordStat.term, KeywordStat.doc_freq).filter_by(user_id=user_id).all())
+        assert stats['lecture notes'] == 3 and stats['heat engine'] == 1
+        
+        tags = app_module.keyword_tags(texts['thermo'], count=3, user_id=user_id)
+        assert tags[0] == 'heat engine'
+        assert 'lecture notes' not in tags and 'heat' not in tags  # no words repeated from a chosen phrase
+        
+        # Re-analysis swaps the document's terms in the statistics
+        app_module.apply_analysis(db.session.get(Document, docs['graphs']), texts['cells'], None, [])
+        db.session.commit()
+        stats = dict(db.session.query(KeywordStat.term, KeywordStat.doc_freq).filter_by(user_id=user_id).all())
+        assert 'shortest paths' not in stats and stats['mitosis'] == 2
+    
+    auth_client.post(f"/delete/{docs['graphs']}")
+    with app.app_context():
+        assert db.session.query(KeywordStat.doc_freq).filter_by(user_id=user_id, term='lecture notes').scalar() == 2
+
+
+def test_fulltext_index_stays_in_sync_and_ranks(auth_client):
+    """Searches go through the FTS index, which follows inserts, edits, analysis and deletes."""
+    import app as app_module
+    
+    with app.app_context():
+        user_id = User.query.first().id
+        docs = {
+            'summary': Document(user_id=user_id, original_filename='thermo.pdf', stored_filename='t.pdf', year=1,
+                                subject='Physics', mimetype='application/pdf', summary='Mentions entropy once.'),
+            'body': Document(user_id=user_id, original_filename='notes.pdf', stored_filename='n.pdf', year=1,
+                             subject='Physics', mimetype='application/pdf',
+                             extracted_text='Entropy, entropy and more entropy. Heat engines. ' * 20),
+            'other': Document(user_id=user_id, original_filename='cells.pdf', stored_filename='c.pdf', year=1,
+                              subject='Biology', mimetype='application/pdf', extracted_text='Mitosis.'),
+        }
+        db.session.add_all(docs.values())
+        db.session.commit()
+        ids = {name: doc.id for name, doc in docs.items()}
+        
+        def search(q):
+            return [doc.id for doc in app_module.search_documents_fulltext(q, user_id)]
+        
+        assert search('entrop') == [ids['body'], ids['summary']]  # prefix match, most relevant first
+        assert search('engine') == [ids['body']]  # stemmed
+        assert search('biology') == [ids['other']]
+        
+        # Edits and re-analysis are re-indexed on flush
+        other = db.session.get(Document, ids['other'])
+        other.summary = 'Entropy of living systems'
+        db.session.commit()
+        assert ids['other'] in search('entropy')
+        app_module.apply_analysis(db.session.get(Document, ids['body']), 'Kinetics only now.', None, [])
+        db.session.commit()
+        assert ids['body'] not in search('entropy') and search('kinetics') == [ids['body']]
+    
+    with captured_queries() as statements:
+        data = auth_client.get('/api/search?q=Entropy').get_json()
+    assert {r['id'] for r in data['results']} == {ids['summary'], ids['other']}
+    assert not any('LIKE' in s.upper() for s in statements)
+    assert b'thermo.pdf' in auth_client.get('/search?q=entropy').data
+    
+    auth_client.post(f"/delete/{ids['summary']}")
+    with app.app_context():
+        assert db.session.execute(db.text('SELECT COUNT(*) FROM document_fts')).scalar() == 2
+        assert [d.id for d in app_module.search_documents_fulltext('entropy', user_id)] == [ids['other']]
+
+
+def test_note_text_is_indexed_on_write(auth_client):
+    """Notes and .txt uploads are searchable by content without reading their files at search time."""
+    auth_client.post('/create-note', data={
+        'title': 'Lecture 3', 'content': 'Photosynthesis happens in the chloroplast.',
+        'year': '1', 'subject': 'Biology', 'tags': ''
+    })
+    auth_client.post('/upload', data={
+        'file': (BytesIO(b'Osmosis moves water across membranes.'), 'osmosis.txt'),
+        'year': '1', 'subject': 'Biology', 'tags': ''
+    }, content_type='multipart/form-data')
+    
+    with app.app_context():
+        docs = Document.query.order_by(Document.id).all()
+        assert [d.extracted_text for d in docs] == [
+            'Photosynthesis happens in the chloroplast.', 'Osmosis moves water across membranes.'
+        ]
+        # Search must not depend on the files still being on local disk
+        for doc in docs:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], doc.stored_filename))
+    
+    assert b'Lecture_3.txt' in auth_client.get('/search?q=chloroplast').data
+    assert b'osmosis.txt' in auth_client.get('/search?q=membranes').data
+    assert b'osmosis.txt' not in auth_client.get('/search?q=chloroplast').data
+
+
+def test_search_ranks_by_field_weight_with_snippets_and_pages(auth_client):
+    """Filename hits outrank tag, summary and body hits; each page carries escaped, highlighted snippets."""
+    with app.app_context():
+        user_id = User.query.first().id
+        docs = {
+            'body': Document(user_id=user_id, original_filename='week1.pdf', stored_filename='b.pdf', year=1,
+                             subject='Chemistry', extracted_text='Titration <b>basics</b>: titration of acids. ' * 5),
+            'summary': Document(user_id=user_id, original_filename='week2.pdf', stored_filename='s.pdf', year=1,
+                                subject='Chemistry', summary='Covers titration curves.'),
+            'tags': Document(user_id=user_id, original_filename='week3.pdf', stored_filename='t.pdf', year=1,
+                             subject='Chemistry', tags='titration'),
+            'filename': Document(user_id=user_id, original_filename='titration.pdf', stored_filename='f.pdf',
+                                 year=1, subject='Chemistry'),
+        }
+        db.session.add_all(docs.values())
+        db.session.commit()
+        ids = {name: doc.id for name, doc in docs.items()}
+    
+    data = auth_client.get('/api/search?q=titration&per_page=3').get_json()
+    assert [r['id'] for r in data['results']] == [ids['filename'], ids['tags'], ids['summary']]
+    assert (data['total'], data['pages'], data['page']) == (4, 2, 1)
+    assert '<mark>titration</mark>' in data['results'][0]['snippet']
+    
+    data = auth_client.get('/api/search?q=titration&per_page=3&page=2').get_json()
+    assert [r['id'] for r in data['results']] == [ids['body']]
+    assert '&lt;b&gt;basics&lt;/b&gt;' in data['results'][0]['snippet']  # Document text is escaped
+    
+    html = auth_client.get('/search?q=titr').data
+    assert html.index(b'titration.pdf') < html.index(b'week3.pdf') < html.index(b'week1.pdf')
+    assert b'<mark>Titration</mark>' in html
+
+
+def test_suggest_index_snapshot_and_change_log(auth_client, monkeypatch):
+    """Typeahead reads an mmap'd snapshot and applies later inserts, edits and deletes from the change log."""
+    import threading
+    import app as app_module
+    monkeypatch.setitem(app.config, 'SUGGEST_REFRESH_SECONDS', 0)
+    
+    with app.app_context():
+        user_id = User.query.first().id
+        other = User(email='other@example.com', name='Other', google_id='other-google-id')
+        db.session.add(other)
+        db.session.commit()
+        docs = {
+            'filename': Document(user_id=user_id, original_filename='Thermodynamics_notes.pdf', stored_filename='a.pdf',
+                                 year=1, subject='Physics'),
+            'summary': Document(user_id=user_id, original_filename='week4.pdf', stored_filename='b.pdf', year=1,
+                                subject='Physics', summary='Heat engines and thermal efficiency.'),
+            'private': Document(user_id=other.id, original_filename='thermo.pdf', stored_filename='c.pdf', year=1,
+                                subject='Physics'),
+        }
+        db.session.add_all(docs.values())
+        db.session.commit()
+        ids = {name: doc.id for name, doc in docs.items()}
+    
+    def suggest(q):
+        return [s['id'] for s in auth_client.get(f'/api/search/suggest?q={q}').get_json()['suggestions']]
+    
+    # No snapshot yet: it is written in the background while the full-text index answers
+    busy = threading.Event()
+    app_module.suggest_executor.submit(busy.wait, 10)
+    assert suggest('therm') == [ids['filename'], ids['summary']]
+    assert suggest('physics heat') == [ids['summary']]
+    assert not os.path.exists(app.config['SUGGEST_INDEX_PATH'])
+    busy.set()
+    app_module.suggest_executor.submit(lambda: None).result()
+    assert os.path.exists(app.config['SUGGEST_INDEX_PATH'])
+    
+    assert suggest('therm') == [ids['filename'], ids['summary']]  # Filename hit ranks above summary hit
+    assert suggest('physics heat') == [ids['summary']]
+    with app.app_context():
+        assert app_module.SearchChange.query.count() == 3  # Covered by the snapshot, kept for the commit window
+    
+    auth_client.post('/create-note', data={
+        'title': 'Thermal physics', 'content': 'x', 'year': '1', 'subject': 'Physics', 'tags': 'exam'
+    })
+    auth_client.post(f"/delete/{ids['filename']}")
+    with app.app_context():
+        note_id = Document.query.filter_by(original_filename='Thermal_physics.txt').one().id
+        summary_doc = db.session.get(Document, ids['summary'])
+        summary_doc.summary = 'Kinetics only.'
+        db.session.commit()
+    
+    assert suggest('therm') == [note_id]
+    assert suggest('exa') == [note_id]  # Tags from the tag table
+    assert suggest('kinet') == [ids['summary']]
+    
+    # A change whose id was allocated earlier but committed later (PostgreSQL sequences) is still applied
+    last_change_id = app_module.get_suggest_index().last_change_id
+    with app.app_context():
+        db.session.add(app_module.SearchChange(id=last_change_id + 2, document_id=note_id))
+        db.session.commit()
+    assert suggest('kinet') == [ids['summary']]
+    assert app_module.get_suggest_index().last_change_id == last_change_id + 2
+    with app.app_context():
+        db.session.execute(db.update(Document).where(Document.id == ids['summary']).values(summary='Optics only.'))
+        db.session.add(app_module.SearchChange(id=last_change_id + 1, document_id=ids['summary']))
+        db.session.commit()
+    assert suggest('optic') == [ids['summary']] and suggest('kinet') == []
+    
+    monkeypatch.setitem(app.config, 'SUGGEST_CHANGE_WINDOW_SECONDS', 0)
+    with app.app_context():
+        app_module.build_suggest_snapshot(app.config['SUGGEST_INDEX_PATH'])
+        assert app_module.SearchChange.query.count() == 0
+    index = app_module.get_suggest_index()
+    assert not index.changed and not index.superseded.any()
+    assert suggest('therm') == [note_id] and suggest('optic') == [ids['summary']]
+
+
+def test_search_includes_documents_shared_directly_or_by_collection(auth_client):
+    """The access index follows shares, revocations and collection membership; search joins against it."""
+    from app import Collection, DocumentAccess, SharePermission
+    
+    with app.app_context():
+        me = User.query.first()
+        owner = User(email='owner@example.com', name='Owner', google_id='owner-google-id')
+        db.session.add(owner)
+        db.session.commit()
+        
+        def make(name):
+            return Document(user_id=owner.id, original_filename=f'{name}.pdf', stored_filename=f'{name}.pdf',
+                            year=1, subject='Astronomy', summary='Orbital mechanics')
+        direct, member, later, private = make('direct'), make('member'), make('later'), make('private')
+        collection = Collection(name='Space', user_id=owner.id)
+        collection.documents.append(member)
+        db.session.add_all([direct, later, private, collection])
+        db.session.commit()
+        db.session.add_all([
+            SharePermission(shared_by_id=owner.id, shared_with_id=me.id, document_id=direct.id),
+            SharePermission(shared_by_id=owner.id, shared_with_id=me.id, collection_id=collection.id),
+        ])
+        db.session.commit()
+        ids = {doc.original_filename: doc.id for doc in (direct, member, later, private)}
+        collection_id = collection.id
+        my_id = me.id
+    
+    def found():
+        return {r['original_filename'] for r in auth_client.get('/api/search?q=orbital').get_json()['results']}
+    
+    assert found() == {'direct.pdf', 'member.pdf'}
+    assert auth_client.get(f"/preview/{ids['direct.pdf']}").status_code == 200
+    assert auth_client.get(f"/preview/{ids['private.pdf']}").status_code == 302
+    
+    with app.app_context():
+        collection = db.session.get(Collection, collection_id)
+        collection.documents.append(db.session.get(Document, ids['later.pdf']))
+        collection.documents.remove(db.session.get(Document, ids['member.pdf']))
+        db.session.commit()
+    assert found() == {'direct.pdf', 'later.pdf'}
+    
+    with app.app_context():
+        share = SharePermission.query.filter_by(document_id=ids['direct.pdf']).one()
+        share_id = share.id
+    auth_client.post(f'/share/revoke/{share_id}')  # Only the owner may revoke
+    assert found() == {'direct.pdf', 'later.pdf'}
+    with app.app_context():
+        db.session.delete(db.session.get(SharePermission, share_id))
+        db.session.delete(db.session.get(Collection, collection_id))
+        db.session.commit()
+        assert DocumentAccess.query.filter_by(user_id=my_id).count() == 0
+        assert DocumentAccess.query.count() == 4  # Owner rows
+    assert found() == set()
+
+
+def test_misspelled_search_falls_back_to_trigram_matches(auth_client, monkeypatch):
+    """A typo finds the document through similar indexed words; exact searches with enough hits skip the lookup."""
+    monkeypatch.setitem(app.config, 'SEARCH_FUZZY_MIN_RESULTS', 1)
+    with app.app_context():
+        user_id = User.query.first().id
+        other = User(email='other@example.com', name='Other', google_id='other-google-id')
+        db.session.add(other)
+        db.session.commit()
+        doc = Document(user_id=user_id, original_filename='week5.pdf', stored_filename='a.pdf', year=1,
+                       subject='Physics', summary='Introduction to thermodynamics and entropy.')
+        private = Document(user_id=other.id, original_filename='diary.pdf', stored_filename='b.pdf', year=1,
+                           subject='Personal', summary='Appointment with the gastroenterologist.')
+        db.session.add_all([doc, private])
+        db.session.commit()
+        doc_id = doc.id
+    
+    data = auth_client.get('/api/search?q=thermodynamcis').get_json()
+    assert [r['id'] for r in data['results']] == [doc_id]
+    assert data['corrections'] == {'thermodynamcis': ['thermodynamics']}
+    assert '<mark>thermodynamics</mark>' in data['results'][0]['snippet']
+    assert b'Including results for' in auth_client.get('/search?q=entropy+thermodynamcis').data
+    
+    with captured_queries() as statements:
+        data = auth_client.get('/api/search?q=thermodynamics').get_json()
+    assert data['corrections'] == {} and [r['id'] for r in data['results']] == [doc_id]
+    assert not any('search_term' in statement for statement in statements)
+    
+    assert auth_client.get('/api/search?q=zzzzqqq').get_json()['total'] == 0
+    
+    # Words from other users' private documents are in the shared vocabulary but never suggested
+    data = auth_client.get('/api/search?q=gastroenterologst').get_json()
+    assert data['corrections'] == {} and data['total'] == 0
+
+
+def test_search_pages_are_sliced_from_cached_ids_until_access_changes(auth_client):
+    """Paging re-uses the cached ranking; inserts, edits and shares bump the reader's generation."""
+    from app import SharePermission
+    with app.app_context():
+        me = User.query.first()
+        other = User(email='other@example.com', name='Other', google_id='other-google-id')
+        db.session.add(other)
+        db.session.commit()
+        my_id, other_id = me.id, other.id
+        docs = [Document(user_id=my_id, original_filename=f'optics_{i}.pdf', stored_filename=f'o{i}.pdf',
+                         year=1, subject='Physics') for i in range(3)]
+        theirs = Document(user_id=other_id, original_filename='optics_lab.pdf', stored_filename='lab.pdf',
+                          year=1, subject='Physics')
+        db.session.add_all(docs + [theirs])
+        db.session.commit()
+        my_doc_ids, theirs_id = [doc.id for doc in docs], theirs.id
+    
+    def result_ids(page=1):
+        data = auth_client.get(f'/api/search?q=optics&per_page=2&page={page}').get_json()
+        return data['total'], [r['id'] for r in data['results']]
+    
+    total, first_page = result_ids()
+    assert total == 3
+    with captured_queries() as statements:
+        assert result_ids(2) == (3, [doc_id for doc_id in my_doc_ids if doc_id not in first_page])
+        assert result_ids() == (3, first_page)
+    assert not any('bm25' in statement for statement in statements)  # Only the page's snippets are fetched
+    
+    with app.app_context():
+        generation = db.session.get(User, my_id).search_generation
+        db.session.get(Document, theirs_id).view_count = 5  # Doesn't change any result
+        db.session.commit()
+        assert db.session.get(User, my_id).search_generation == generation
+        db.session.add(SharePermission(shared_by_id=other_id, shared_with_id=my_id, document_id=theirs_id))
+        db.session.commit()
+        assert db.session.get(User, my_id).search_generation == generation + 1
+    assert result_ids(2)[0] == 4
+    
+    with app.app_context():
+        db.session.get(Document, first_page[0]).original_filename = 'lenses.pdf'
+        db.session.commit()
+    assert result_ids()[0] == 3
+
+
+def test_facet_counts_come_from_one_grouped_query_and_filter_by_index(auth_client):
+    """Search, year and index pages count years, subjects, tags and types in one query; facet links filter exactly."""
+    from app import Tag
+    with app.app_context():
+        user_id = User.query.first().id
+        waves = Tag(name='Waves', slug='waves')
+        docs = [
+            Document(user_id=user_id, original_filename='optics_1.pdf', stored_filename='o1.pdf', year=1,
+                     subject='Physics', mimetype='application/pdf', tag_objects=[waves]),
+            Document(user_id=user_id, original_filename='optics_2.png', stored_filename='o2.png', year=1,
+                     subject='Physics', mimetype='image/png'),
+            Document(user_id=user_id, original_filename='optics_3.pdf', stored_filename='o3.pdf', year=2,
+                     subject='Biology', mimetype='application/pdf', tag_objects=[waves]),
+            Document(user_id=user_id, original_filename='other.pdf', stored_filename='x.pdf', year=3,
+                     subject='Physics Lab', mimetype='application/pdf'),
+        ]
+        db.session.add_all(docs)
+        db.session.commit()
+        ids = [doc.id for doc in docs]
+    
+    with captured_queries() as statements:
+        data = auth_client.get('/api/search?q=optics&facets=1').get_json()
+    assert sum('GROUP BY' in statement for statement in statements) == 1
+    facets = {name: {f['value']: f['count'] for f in values} for name, values in data['facets'].items()}
+    assert facets == {'year': {1: 2, 2: 1}, 'subject': {'Physics': 2, 'Biology': 1},
+                      'mimetype': {'application/pdf': 2, 'image/png': 1}, 'tag': {'waves': 2}}
+    assert data['facets']['tag'][0]['label'] == 'Waves'
+    
+    data = auth_client.get('/api/search?q=optics&facets=1&tag=waves&year=1').get_json()
+    assert [r['id'] for r in data['results']] == [ids[0]]
+    assert data['facets']['subject'] == [{'value': 'Physics', 'label': 'Physics', 'count': 1}]
+    assert b'Subject:' in auth_client.get('/search?q=optics').data
+    
+    html = auth_client.get('/year/1?subject=Physics').data
+    assert b'Physics (2)' in html and b'Waves (1)' in html and b'Physics Lab' not in html
+    assert auth_client.get('/year/3?subject=Physics').data.count(b'other.pdf') == 0  # Exact, not LIKE
+    assert b'2 documents' in auth_client.get('/').data
+
+
+def test_semantic_search_scores_stored_vectors(auth_client, monkeypatch):
+    """Documents get float32 vectors on write once a model is fitted; semantic mode finds related wording."""
+    import app as app_module
+    from app import SemanticModel
+    plants = 'photosynthesis chlorophyll sunlight leaves plants', 'chlorophyll leaves plants green stems'
+    money = 'stock market interest rates bonds', 'bonds interest inflation market prices'
+    model = SemanticModel.fit(list(plants + money) * 3, dimensions=2)
+    model.save(app.config['SEMANTIC_MODEL_PATH'])
+    
+    with app.app_context():
+        user_id = User.query.first().id
+        docs = [Document(user_id=user_id, original_filename=f'notes_{i}.txt', stored_filename=f'n{i}.txt', year=1,
+                         subject='General', extracted_text=text) for i, text in enumerate(plants + money)]
+        db.session.add_all(docs)
+        db.session.commit()
+        ids = [doc.id for doc in docs]
+        vector = db.session.get(Document, ids[1]).content_vector
+        assert isinstance(vector, bytes) and len(vector) == 8 + 4 * 2 and vector[:8] == model.model_id
+    
+    data = auth_client.get('/api/search?q=photosynthesis&mode=semantic').get_json()
+    assert data['mode'] == 'semantic'
+    assert sorted(r['id'] for r in data['results']) == ids[:2]  # The second never says "photosynthesis"
+    assert [r['id'] for r in auth_client.get('/api/search?q=photosynthesis').get_json()['results']] == ids[:1]
+    
+    monkeypatch.setitem(app.config, 'SEMANTIC_ANN_MIN_DOCUMENTS', 2)  # Cluster even this tiny library
+    with app.app_context():
+        db.session.get(Document, ids[3]).extracted_text = 'chlorophyll in leaves'  # Re-embedded, cache dropped
+        db.session.commit()
+    data = auth_client.get('/api/search?q=photosynthesis&mode=semantic&facets=1').get_json()
+    assert sorted(r['id'] for r in data['results']) == [ids[0], ids[1], ids[3]]
+    assert data['facets']['year'] == [{'value': 1, 'label': 1, 'count': 3}]
+    
+    # k-means ran in the background; the index rebuilt after the next edit files vectors under its centroids
+    app_module.semantic_executor.submit(lambda: None).result()
+    with app.app_context():
+        assert app_module.get_semantic_index(user_id, model).clusters is not None
+        db.session.get(Document, ids[2]).extracted_text = 'sunlight on green leaves'
+        db.session.commit()
+        index = app_module.get_semantic_index(user_id, model)
+        assert index.clusters is not None and not index.needs_clustering()
+        assert not app_module.semantic_clustering
+    data = auth_client.get('/api/search?q=photosynthesis&mode=semantic').get_json()
+    assert sorted(r['id'] for r in data['results']) == [ids[0], ids[1], ids[2], ids[3]]
+
+
+def test_first_analysis_fits_the_semantic_model(auth_client, monkeypatch):
+    """Without a model, the first analysis fits one in the background and embeds the library."""
+    import app as app_module
+    monkeypatch.setitem(app.config, 'SEMANTIC_AUTO_FIT', True)
+    with app.app_context():
+        user_id = User.query.first().id
+        db.session.add_all([Document(user_id=user_id, original_filename=f'notes_{i}.txt', stored_filename=f'n{i}.txt',
+                                     year=1, subject='General', extracted_text=text)
+                            for i, text in enumerate(['cells divide by mitosis', 'kings built stone castles',
+                                                      'mitosis copies chromosomes'])])
+        db.session.commit()
+        generation = db.session.get(User, user_id).search_generation
+    
+    app_module.schedule_semantic_model_fit()
+    app_module.semantic_executor.submit(lambda: None).result()
+    assert app_module.get_semantic_model() is not None
+    assert not os.path.exists(app.config['SEMANTIC_MODEL_PATH'] + '.lock')
+    with app.app_context():
+        assert Document.query.filter(Document.content_vector.isnot(None)).count() == 3
+        # Vectors aren't search columns, so the fit drops cached searches and semantic indexes itself
+        assert db.session.get(User, user_id).search_generation > generation
+    with captured_queries() as statements:
+        data = auth_client.get('/api/search?q=chromosomes&mode=semantic').get_json()
+    assert data['mode'] == 'semantic' and data['results']
+    assert sum('content_vector' in sql for sql in statements) == 1  # Only the semantic index load reads vectors
+    with captured_queries() as statements:
+        auth_client.get('/api/search?q=chromosomes')
+    assert not any('content_vector' in sql for sql in statements)
+
+
+def test_recommendations_reuse_the_stored_tfidf_model(auth_client, monkeypatch):
+    """The TF-IDF model is fitted once; later documents are transformed with it and old text is not re-read."""
+    from app import RecommendationModel, RecommendationVector
+    texts = ['cell biology mitosis chromosomes', 'mitosis chromosomes cell division',
+             'medieval history castles kings', 'kings castles feudal history']
+    with app.app_context():
+        user_id = User.query.first().id
+        docs = [Document(user_id=user_id, original_filename=f'notes_{i}.txt', stored_filename=f'n{i}.txt', year=1,
+                         subject='General', extracted_text=text, last_analyzed=datetime.utcnow())
+                for i, text in enumerate(texts)]
+        db.session.add_all(docs)
+        db.session.commit()
+        ids = [doc.id for doc in docs]
+    
+    data = auth_client.get(f'/document/{ids[0]}/recommendations').get_json()
+    assert data['success'] and [r['id'] for r in data['recommendations']] == [ids[1]]
+    with app.app_context():
+        model = db.session.get(RecommendationModel, user_id)
+        assert (model.version, model.fitted_documents, model.changed_documents) == (1, 4, 0)
+        assert RecommendationVector.query.filter_by(user_id=user_id).count() == 4
+    
+    recommendation_cache.clear()  # Another worker: vectors come from the database, the text is not read
+    with captured_queries() as statements:
+        data = auth_client.get(f'/document/{ids[2]}/recommendations').get_json()
+    assert [r['id'] for r in data['recommendations']] == [ids[3]]
+    assert not any('extracted_text' in sql and 'recommendation_vector' not in sql for sql in statements)
+    
+    with app.app_context():
+        doc = Document(user_id=user_id, original_filename='notes_4.txt', stored_filename='n4.txt', year=1,
+                       subject='General', extracted_text='chromosomes mitosis biology', last_analyzed=datetime.utcnow())
+        db.session.add(doc)
+        db.session.commit()
+        new_id = doc.id
+    data = auth_client.get(f'/document/{new_id}/recommendations').get_json()
+    assert sorted(r['id'] for r in data['recommendations']) == ids[:2]
+    with app.app_context():
+        model = db.session.get(RecommendationModel, user_id)
+        assert (model.version, model.changed_documents) == (1, 1)  # Transformed, not refitted
+        
+        db.session.delete(db.session.get(Document, ids[1]))
+        db.session.commit()
+        assert db.session.get(RecommendationVector, ids[1]) is None
+    data = auth_client.get(f'/document/{ids[0]}/recommendations').get_json()
+    assert [r['id'] for r in data['recommendations']] == [new_id]
+    
+    monkeypatch.setitem(app.config, 'RECOMMENDATIONS_REFIT_DRIFT', 0)  # Any change now refits
+    with app.app_context():
+        db.session.get(Document, ids[3]).extracted_text = 'castles kings knights'
+        db.session.commit()
+    auth_client.get(f'/document/{ids[2]}/recommendations')
+    with app.app_context():
+        model = db.session.get(RecommendationModel, user_id)
+        assert (model.version, model.fitted_documents, model.changed_documents) == (2, 4, 0)
+
+
+def test_concurrent_first_recommendation_fits_share_one_model(auth_client, monkeypatch):
+    """A request that loses the race to store a user's first model uses the winner's instead of failing."""
+    import threading
+    import app as app_module
+    from app import RecommendationModel
+    texts = ['cell biology mitosis chromosomes', 'mitosis chromosomes cell division', 'medieval castles kings']
+    with app.app_context():
+        user_id = User.query.first().id
+        docs = [Document(user_id=user_id, original_filename=f'notes_{i}.txt', stored_filename=f'n{i}.txt', year=1,
+                         subject='General', extracted_text=text, last_analyzed=datetime.utcnow())
+                for i, text in enumerate(texts)]
+        db.session.add_all(docs)
+        db.session.commit()
+        ids = [doc.id for doc in docs]
+    
+    fit = app_module.fit_recommendation_model
+    
+    def other_worker():
+        with app.app_context():
+            fit(user_id)
+    
+    def racing_fit(user_id, model=None):
+        if model is None:
+            worker = threading.Thread(target=other_worker)  # Commits first, while this request is fitting
+            worker.start()
+            worker.join()
+        return fit(user_id, model)
+    
+    monkeypatch.setattr(app_module, 'fit_recommendation_model', racing_fit)
+    data = auth_client.get(f'/document/{ids[0]}/recommendations').get_json()
+    assert data['success'] and [r['id'] for r in data['recommendations']] == [ids[1]]
+    with app.app_context():
+        assert db.session.get(RecommendationModel, user_id).version == 1
+
+
+def test_notes_are_not_counted_as_analyzed_until_analysis_runs(auth_client):
+    """Notes store their text at write time; only last_analyzed makes them analyzed for stats and recommendations."""
+    import app as app_module
+    
+    def analyzed_stats():
+        page = auth_client.get('/ai-features').get_data(as_text=True)
+        analyzed = re.search(r'(\d+)\s*</h2>\s*<p class="text-muted mb-0">Analyzed', page).group(1)
+        coverage = re.search(r'(\d+)%\s*</h2>\s*<p class="text-muted mb-0">Coverage', page).group(1)
+        return int(analyzed), int(coverage)
+    
+    rv = auth_client.post('/create-note', data={'title': 'Kinematics', 'content': 'Velocity is displacement over time.',
+                                                'year': '1', 'subject': 'Physics'})
+    assert rv.status_code == 302
+    with app.app_context():
+        note = Document.query.one()
+        assert note.extracted_text
+        user_id, note_id = note.user_id, note.id
+        assert app_module.recommendation_texts(user_id) == []
+    assert analyzed_stats() == (0, 0)
+    
+    with app.app_context():
+        db.session.get(Document, note_id).last_analyzed = datetime.utcnow()
+        db.session.commit()
+        assert [doc_id for doc_id, _ in app_module.recommendation_texts(user_id)] == [note_id]
+    assert analyzed_stats() == (1, 100)